@@ -0,0 +1,21 @@
+""" Access control for the admin endpoints. """
+
+import hmac
+import os
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+
+def check_admin(authorization):
+    """
+    Return the status to refuse an admin request with, or None if its Authorization header has the admin token.
+
+    Requests send `Authorization: Bearer <ADMIN_TOKEN>`. While ADMIN_TOKEN is unset the admin endpoints are disabled
+    and answer 404.
+    """
+    if not ADMIN_TOKEN:
+        return 404
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return 401
+    return None
@@ -0,0 +1,364 @@
+"""
+An asyncio webhook server.
+
+This runs the same pull request pipeline as the Flask app, validating hooks with the same settings,
+but makes its slack and github calls with an async HTTP client so one process can handle
+hundreds of concurrent deliveries. Start it with `python -m app.aio`.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+from werkzeug.exceptions import BadRequest
+
+from app import APP
+from app.admin import check_admin
+from app.clients import GITHUB_API_URL
+from app.clients import HTTP_CONNECT_TIMEOUT
+from app.clients import HTTP_POOL_MAXSIZE
+from app.clients import HTTP_READ_TIMEOUT
+from app.clients import SLACK_API_URL
+from app.clients import finish_slack_response
+from app.dedupe import claim_delivery
+from app.dedupe import release_delivery
+from app.directory import DIRECTORY
+from app.directory import SLACK_USERS_LIST_RETRIES
+from app.directory import SLACK_USERS_PAGE_LIMIT
+from app.directory import SlackDirectoryIndex
+from app.directory import SlackDirectoryUnavailable
+from app.directory import get_retry_after
+from app.directory import read_member_page
+from app.github import PullRequestEvent
+from app.github import expand_team_event
+from app.github import get_cached_full_name
+from app.github import get_full_name_request
+from app.github import get_github_auth
+from app.github import is_valid_pull_request
+from app.github import store_full_name_response
+from app.metrics import STAGE_SECONDS
+from app.ratelimit import RATE_LIMITER
+from app.slack import RESOLUTION_DEADLINE
+from app.slack import SLACK_SEND_RETRIES
+from app.slack import SLACK_SIGNING_SECRET
+from app.slack import fall_back
+from app.slack import format_author
+from app.slack import format_channel
+from app.slack import handle_slack_event
+from app.slack import remember_unmatched
+from app.slack import render_message
+from app.slack import report_send
+from app.slack import resolve_without_lookups
+from app.slack import should_retry_send
+from app.slack import verify_slack_signature
+from app.unmatched import UNMATCHED
+from app.unmatched import UNMATCHED_CACHE_TTL
+
+GITHUB_META_URL = '{}/meta'.format(GITHUB_API_URL)
+GITHUB_META_TTL = 60
+
+_GITHUB_HOOK_NETWORKS = {'networks': None, 'fetched_at': 0}
+_DIRECTORY_REFRESH = {'task': None}
+
+
+def make_app():
+    """ Build the aiohttp application. """
+    aio_app = web.Application()
+    aio_app.router.add_post('/hooks', handle_hook)
+    aio_app.router.add_post('/slack/events', handle_slack_events)
+    aio_app.router.add_get('/admin/unmatched', handle_unmatched)
+    aio_app.router.add_delete('/admin/unmatched', handle_unmatched)
+    aio_app.router.add_delete('/admin/unmatched/{login}', handle_unmatched)
+    aio_app.on_startup.append(_open_http_session)
+    aio_app.on_cleanup.append(_close_http_session)
+    return aio_app
+
+
+async def handle_hook(request):
+    """ Validate a github webhook and handle ping and pull_request events, like the Flask-Hookserver route. """
+    body = await request.read()
+    error = await _check_origin(request)
+    if error is None:
+        error = _check_hook(request, body)
+    if error is not None:
+        return error
+
+    response, event = _parse_hook(request.headers['X-GitHub-Event'], body)
+    if event is None:
+        return response
+
+    keys = claim_delivery(request.headers['X-GitHub-Delivery'], event)
+    if keys is None:
+        return web.Response(text='Duplicate delivery ignored')
+    try:
+        # Team memberships are cached on disk, so listing one rarely leaves the executor waiting on github
+        events = await asyncio.get_event_loop().run_in_executor(None, expand_team_event, event)
+        await asyncio.gather(*[notify_recipient(request.app['http'], member_event) for member_event in events])
+    except Exception:
+        release_delivery(keys)
+        raise
+    return web.Response(text='Recipient Notified')
+
+
+async def _check_origin(request):
+    if not APP.config['VALIDATE_IP']:
+        return None
+    try:
+        is_github_ip = await _is_github_ip(request.app['http'], request.remote)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return web.Response(status=503, text='Error getting GitHub hook IP ranges')
+    if not is_github_ip:
+        return web.Response(status=403, text='Requests must originate from GitHub')
+    return None
+
+
+def _check_hook(request, body):
+    if APP.config['VALIDATE_SIGNATURE']:
+        signature = request.headers.get('X-Hub-Signature')
+        if not signature:
+            return web.Response(status=400, text='Missing signature')
+        if not is_valid_signature(signature, APP.config['GITHUB_WEBHOOKS_KEY'], body):
+            return web.Response(status=400, text='Wrong signature')
+
+    for header in ('X-GitHub-Event', 'X-GitHub-Delivery'):
+        if not request.headers.get(header):
+            return web.Response(status=400, text='Missing header: {}'.format(header))
+    return None
+
+
+def _parse_hook(event_name, body):
+    # Returns the response for a hook that sends no notification, or the PullRequestEvent to notify
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return web.Response(status=400, text='Invalid JSON'), None
+
+    if event_name == 'ping':
+        return web.Response(text='pong'), None
+    if event_name != 'pull_request':
+        return web.Response(text='Hook not used\n'), None
+
+    try:
+        if not is_valid_pull_request(data):
+            return web.Response(text='Action ({}) ignored'.format(data.get('action'))), None
+        return None, PullRequestEvent.from_payload(data)
+    except BadRequest as error:
+        return web.Response(status=400, text=error.description), None
+
+
+async def handle_slack_events(request):
+    """ Receive slack Events API callbacks that keep the cached slack directory current, like the Flask route. """
+    body = await request.read()
+    if not verify_slack_signature(SLACK_SIGNING_SECRET, request.headers.get('X-Slack-Request-Timestamp'), body,
+                                  request.headers.get('X-Slack-Signature')):
+        return web.Response(status=403, text='Invalid slack signature')
+
+    try:
+        payload = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return web.Response(status=400, text='Invalid JSON')
+    if not isinstance(payload, dict):
+        return web.Response(status=400, text='Invalid JSON')
+    return web.Response(text=handle_slack_event(payload))
+
+
+async def handle_unmatched(request):
+    """ List the github logins cached as unmatched, or forget one or all of them, like the Flask route. """
+    status = check_admin(request.headers.get('Authorization'))
+    if status:
+        return web.Response(status=status)
+
+    if request.method == 'DELETE':
+        login = request.match_info.get('login')
+        if login:
+            UNMATCHED.discard(login)
+        else:
+            UNMATCHED.invalidate()
+        return web.Response(status=204)
+    return web.json_response({'ttl': UNMATCHED_CACHE_TTL, 'stats': UNMATCHED.stats(), 'logins': UNMATCHED.entries()})
+
+
+def is_valid_signature(signature, key, body):
+    """ Check a github X-Hub-Signature header against the webhook secret. """
+    if not key:
+        logging.getLogger(__name__).warning('GITHUB_WEBHOOKS_KEY is not set, rejecting signed hook')
+        return False
+    digest = hmac.new(key.encode('utf-8'), body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest('sha1={}'.format(digest), signature)
+
+
+async def notify_recipient(session, event):
+    """ Compile the necessary information and send a slack notification. Returns True once slack accepted it. """
+    pr_metadata = await _get_pull_request_metadata(session, event)
+    payload = render_message(event, pr_metadata)
+    return await _send_slack_message(session, payload)
+
+
+async def _get_pull_request_metadata(session, event):
+    channel = asyncio.ensure_future(_get_notification_channel(session, event))
+    author = asyncio.ensure_future(_get_pull_request_author(session, event))
+    await asyncio.wait([channel, author], timeout=RESOLUTION_DEADLINE)
+
+    return {
+        'channel': _get_resolved(channel, os.environ.get('DEFAULT_NOTIFICATION_CHANNEL'), 'channel'),
+        'author': _get_resolved(author, 'someone', 'author'),
+    }
+
+
+def _get_resolved(task, default, field):
+    if not task.done():
+        task.cancel()
+        return fall_back(field, default)
+    if task.exception() is not None:
+        return fall_back(field, default, task.exception())
+    return task.result()
+
+
+async def _get_notification_channel(session, event):
+    return format_channel(await _get_slack_username_by_github_username(session, event.recipient))
+
+
+async def _get_pull_request_author(session, event):
+    return format_author(await _get_slack_username_by_github_username(session, event.author))
+
+
+async def _get_slack_username_by_github_username(session, github_username):  # pylint: disable=invalid-name
+    resolved, slack_username = resolve_without_lookups(github_username)
+    if resolved:
+        return slack_username
+
+    index = await _get_directory_index(session)
+    slack_username = index.match_username(github_username)
+    full_name = ''
+    if not slack_username:
+        full_name = await _lookup_github_full_name(session, github_username)
+        slack_username = index.match_full_name(full_name)
+    return remember_unmatched(github_username, index, slack_username, full_name)
+
+
+async def _get_directory_index(session):
+    index = DIRECTORY.get_fresh_index()
+    if index is not None:
+        return index
+
+    # Share the in-flight fetch rather than starting another one, serving the stale copy meanwhile if there is one
+    task = _DIRECTORY_REFRESH['task']
+    if task is None or task.done():
+        task = _DIRECTORY_REFRESH['task'] = asyncio.ensure_future(_refresh_directory(session))
+    else:
+        index = DIRECTORY.get_cached_index()
+        if index is not None:
+            return index
+    return await asyncio.shield(task)
+
+
+async def _refresh_directory(session):
+    # Like iter_slack_member_pages, each page is indexed and dropped before the next one is fetched
+    index = SlackDirectoryIndex()
+    DIRECTORY.begin_refresh()
+    cursor = None
+    retries = SLACK_USERS_LIST_RETRIES
+    try:
+        while True:
+            with STAGE_SECONDS.time('users_list'):
+                response = await _slack_api_call(session, 'users.list', limit=SLACK_USERS_PAGE_LIMIT,
+                                                 **({'cursor': cursor} if cursor else {}))
+            members, next_cursor = read_member_page(response, retries)
+            if members is None:
+                retries -= 1
+                await asyncio.sleep(get_retry_after(response))
+                continue
+
+            index.add_page(members)
+            if not next_cursor:
+                return DIRECTORY.replace(index)
+            cursor = next_cursor
+            retries = SLACK_USERS_LIST_RETRIES
+    except SlackDirectoryUnavailable:
+        return DIRECTORY.replace(None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        logging.getLogger(__name__).warning('Unable to refresh the slack directory', exc_info=True)
+        return DIRECTORY.replace(None)
+
+
+async def _lookup_github_full_name(session, gh_username):
+    # The name cache is a sqlite database, so it is read and written in the executor rather than on the event loop
+    loop = asyncio.get_event_loop()
+    with STAGE_SECONDS.time('github_name_lookup'):
+        entry, fresh = await loop.run_in_executor(None, get_cached_full_name, gh_username)
+        if fresh:
+            return entry.value
+
+        url, headers = get_full_name_request(gh_username, entry)
+        async with session.get(url, headers=headers, auth=aiohttp.BasicAuth(*get_github_auth())) as response:
+            user = await response.json(content_type=None) if response.status == 200 else None
+        return await loop.run_in_executor(None, store_full_name_response, gh_username, entry, response.status,
+                                          response.headers, user)
+
+
+async def _send_slack_message(session, payload):
+    for attempt in range(SLACK_SEND_RETRIES + 1):
+        wait = RATE_LIMITER.reserve(payload.get('channel'))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        with STAGE_SECONDS.time('chat_post_message'):
+            response = await _slack_api_call(session, 'chat.postMessage', **payload)
+        if not should_retry_send(response, attempt, payload.get('channel')):
+            break
+    return report_send(response, payload)
+
+
+async def _slack_api_call(session, method, **kwargs):
+    data = {key: _encode_form_value(value) for key, value in kwargs.items()}
+    headers = {'Authorization': 'Bearer {}'.format(os.environ.get('SLACK_BOT_TOKEN'))}
+
+    async with session.post('{}{}'.format(SLACK_API_URL, method), data=data, headers=headers) as response:
+        try:
+            result = await response.json(content_type=None)
+        except ValueError:
+            result = None
+        return finish_slack_response(result, response.status, response.headers)
+
+
+def _encode_form_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+async def _is_github_ip(session, remote):
+    networks = _GITHUB_HOOK_NETWORKS['networks']
+    if networks is None or time.monotonic() - _GITHUB_HOOK_NETWORKS['fetched_at'] > GITHUB_META_TTL:
+        async with session.get(GITHUB_META_URL) as response:
+            meta = await response.json(content_type=None)
+        networks = [ipaddress.ip_network(block) for block in meta.get('hooks', [])]
+        _GITHUB_HOOK_NETWORKS.update(networks=networks, fetched_at=time.monotonic())
+
+    try:
+        address = ipaddress.ip_address(remote)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+async def _open_http_session(aio_app):
+    timeout = aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit_per_host=HTTP_POOL_MAXSIZE)
+    aio_app['http'] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def _close_http_session(aio_app):
+    await aio_app['http'].close()
+
+
+if __name__ == '__main__':
+    web.run_app(make_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,109 @@
+""" A persistent cache for github API responses keyed by ETag. """
+
+from collections import namedtuple
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.environ.get('GITHUB_CACHE_DIR', tempfile.gettempdir())
+CACHE_TTL = int(os.environ.get('GITHUB_CACHE_TTL', 60 * 60 * 24))
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'etag', 'fetched_at'])
+
+
+class EtagCache:  # pylint: disable=too-many-instance-attributes
+    """
+    A sqlite backed cache of github API responses.
+
+    Each entry stores the value along with the ETag github returned for it and the time it was fetched.
+    Fresh entries are served as is. Stale entries should be revalidated with an If-None-Match request,
+    since a 304 from github does not count against the API rate limit.
+    """
+
+    def __init__(self, namespace, path=None, ttl=CACHE_TTL):
+        self._namespace = namespace
+        self._path = path or os.path.join(CACHE_DIR, 'github-cache.sqlite3')
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._hits = 0
+        self._misses = 0
+        self._revalidations = 0
+
+    def get(self, key):
+        """ Return the cached entry for a key, fresh or stale, or None. """
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT value, etag, fetched_at FROM entries WHERE namespace = ? AND key = ?',
+                (self._namespace, key.lower())
+            ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(json.loads(row[0]), row[1], row[2])
+
+    def set(self, key, value, etag=None):
+        """ Store a freshly fetched value. """
+        with self._lock:
+            with self._connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries (namespace, key, value, etag, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                    (self._namespace, key.lower(), json.dumps(value), etag, time.time())
+                )
+
+    def touch(self, key):
+        """ Mark an entry as fresh after github confirmed it has not changed. """
+        with self._lock:
+            self._revalidations += 1
+            with self._connection() as conn:
+                conn.execute(
+                    'UPDATE entries SET fetched_at = ? WHERE namespace = ? AND key = ?',
+                    (time.time(), self._namespace, key.lower())
+                )
+
+    def is_fresh(self, entry):
+        """ Check if an entry is young enough to be served without asking github. """
+        return entry is not None and time.time() - entry.fetched_at < self._ttl
+
+    def record_hit(self):
+        """ Count a lookup that was answered from the cache. """
+        with self._lock:
+            self._hits += 1
+
+    def record_miss(self):
+        """ Count a lookup that needed a request to github. """
+        with self._lock:
+            self._misses += 1
+
+    def clear(self):
+        """ Remove every entry in this cache's namespace and reset the counters. """
+        with self._lock:
+            with self._connection() as conn:
+                conn.execute('DELETE FROM entries WHERE namespace = ?', (self._namespace,))
+            self._hits = 0
+            self._misses = 0
+            self._revalidations = 0
+
+    def stats(self):
+        """ Return the cache counters. """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'revalidations': self._revalidations,
+            }
+
+    def _connection(self):
+        # sqlite connections must not be shared across a fork, so reconnect in each process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, etag TEXT, fetched_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, key))'
+            )
+            self._pid = os.getpid()
+        return self._conn
@@ -0,0 +1,102 @@
+""" Shared, pooled HTTP sessions for the slack, github and octocat feed calls. """
+
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from app.metrics import UPSTREAM_ERRORS
+from app.metrics import UPSTREAM_RATELIMITED
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api/')
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+
+_SESSION_LOCK = threading.Lock()
+_SESSION = {'session': None, 'pid': None}
+
+
+def get_session():
+    """
+    Return the process wide requests session.
+
+    The session keeps a pool of keep-alive connections per host, so every call after the first one to a host
+    skips the TCP and TLS handshakes. A new session is created after a fork since sockets can't be shared.
+    """
+    with _SESSION_LOCK:
+        if _SESSION['session'] is None or _SESSION['pid'] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _SESSION['session'] = session
+            _SESSION['pid'] = os.getpid()
+        return _SESSION['session']
+
+
+def request(method, url, **kwargs):
+    """ Make a request through the shared session, with connect and read timeouts unless others are given. """
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def slack_api_call(method, **kwargs):
+    """
+    Call a slack Web API method and return the decoded response.
+
+    Like SlackClient.api_call, list and dict arguments are sent json encoded
+    and the response headers are included so a Retry-After can be honored.
+    """
+    data = {key: json.dumps(value) if isinstance(value, (dict, list)) else value for key, value in kwargs.items()}
+    headers = {'Authorization': 'Bearer {}'.format(os.environ.get('SLACK_BOT_TOKEN'))}
+    response = request('POST', '{}{}'.format(SLACK_API_URL, method), data=data, headers=headers)
+
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    return finish_slack_response(result, response.status_code, response.headers)
+
+
+def finish_slack_response(result, status, headers):
+    """
+    Add the response headers to a decoded slack Web API response, or None if it was not json, and count errors.
+
+    This is shared by the asyncio server, which decodes its responses itself.
+    """
+    if result is None:
+        result = {'ok': False, 'error': 'invalid_response', 'status': status}
+    # Keep looking headers up case insensitively, whatever case slack sent them in
+    result['headers'] = CaseInsensitiveDict(headers)
+
+    if not result.get('ok'):
+        UPSTREAM_ERRORS.inc('slack', result.get('error'))
+        if result.get('error') == 'ratelimited':
+            UPSTREAM_RATELIMITED.inc('slack')
+    return result
+
+
+def connection_stats():
+    """ Return how many requests each host's connection pool made and how many connections it opened for them. """
+    stats = {}
+    adapters = set(get_session().adapters.values())
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = stats.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            host['requests'] += pool.num_requests
+            host['connections'] += pool.num_connections
+
+    for host in stats.values():
+        host['reused'] = max(host['requests'] - host['connections'], 0)
+    return stats
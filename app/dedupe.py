@@ -0,0 +1,139 @@
+""" Recognize github webhook deliveries that were already handled. """
+
+from collections import OrderedDict
+import os
+import threading
+import time
+
+DEDUPE_DELIVERY_TTL = float(os.environ.get('DEDUPE_DELIVERY_TTL', 86400))
+DEDUPE_CONTENT_TTL = float(os.environ.get('DEDUPE_CONTENT_TTL', 600))
+DEDUPE_MAX_ENTRIES = int(os.environ.get('DEDUPE_MAX_ENTRIES', 10000))
+
+
+class DedupeStore:
+    """
+    A bounded set of recently seen keys.
+
+    Keys are forgotten `ttl` seconds after they were last added, or earlier when more than `max_entries`
+    keys are held, oldest first. Since every key lives for the same ttl and re-adding a key moves it to the back,
+    insertion order is expiry order, so expiring and evicting only ever look at the front of the ordered dict.
+    """
+
+    def __init__(self, ttl, max_entries=DEDUPE_MAX_ENTRIES):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def check_and_add(self, key):
+        """ Return True if the key was seen within the ttl, otherwise remember it and return False. """
+        if not self._enabled():
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            if self._contains(key, now):
+                return True
+            self._add(key, now)
+            return False
+
+    def contains(self, key):
+        """ Return True if the key was added within the ttl. """
+        with self._lock:
+            return self._contains(key, time.monotonic())
+
+    def add(self, key):
+        """ Remember a key for another ttl, whether or not it is held already. """
+        if not self._enabled():
+            return
+
+        with self._lock:
+            self._add(key, time.monotonic())
+
+    def discard(self, key):
+        """
+        Forget a key, e.g. when handling its delivery failed and github should be able to retry it.
+
+        Returns False if it was not held.
+        """
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        """ Forget every key and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            for name in self._counts:
+                self._counts[name] = 0
+
+    def entries(self):
+        """ Return the keys held and the seconds until each is forgotten, soonest first. """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            return [(key, expires_at - now) for key, expires_at in self._entries.items()]
+
+    def stats(self):
+        """ Return the duplicate and new key counts, evictions and the number of keys held. """
+        with self._lock:
+            return dict(self._counts, size=len(self._entries))
+
+    def _enabled(self):
+        return self._ttl > 0 and self._max_entries > 0
+
+    def _contains(self, key, now):
+        self._expire(now)
+        if key in self._entries:
+            self._counts['hits'] += 1
+            return True
+        self._counts['misses'] += 1
+        return False
+
+    def _add(self, key, now):
+        self._expire(now)
+        self._entries.pop(key, None)
+        self._entries[key] = now + self._ttl
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._counts['evictions'] += 1
+
+    def _expire(self, now):
+        while self._entries:
+            key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now:
+                return
+            del self._entries[key]
+
+
+def get_content_key(event):
+    """ Identify the notification a PullRequestEvent would send, regardless of which delivery carried it. """
+    return '{}#{}:{}:{}'.format(event.repo, event.number, event.action, event.recipient or event.team)
+
+
+def claim_delivery(guid, event):
+    """
+    Record a delivery and return the keys it claimed, or None if it duplicates a recent delivery.
+
+    A delivery is a duplicate when github sent its GUID before, e.g. a redelivery,
+    or when another delivery asked for the same notification within DEDUPE_CONTENT_TTL.
+    """
+    if guid and DELIVERIES.check_and_add(guid):
+        return None
+
+    content_key = get_content_key(event)
+    if CONTENT.check_and_add(content_key):
+        return None
+    return guid, content_key
+
+
+def release_delivery(keys):
+    """ Forget the keys claimed by a delivery so a retry of it is handled. """
+    guid, content_key = keys
+    if guid:
+        DELIVERIES.discard(guid)
+    CONTENT.discard(content_key)
+
+
+DELIVERIES = DedupeStore(DEDUPE_DELIVERY_TTL)
+CONTENT = DedupeStore(DEDUPE_CONTENT_TTL)
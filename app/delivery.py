@@ -0,0 +1,189 @@
+""" Deliver slack notifications from a pool of background workers. """
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from app.digest import DIGEST_WINDOW
+from app.digest import Digest
+from app.github import PullRequestEvent
+from app.github import expand_team_event
+from app.metrics import NOTIFICATIONS
+from app.slack import create_slack_message_payloads
+from app.slack import notify_recipient
+from app.slack import send_slack_message
+from app.spool import SPOOL_PATH
+from app.spool import Spool
+
+DELIVERY_MODE = os.environ.get('DELIVERY_MODE', 'sync').lower()
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 4))
+DELIVERY_QUEUE_SIZE = int(os.environ.get('DELIVERY_QUEUE_SIZE', 100))
+DELIVERY_DRAIN_TIMEOUT = int(os.environ.get('DELIVERY_DRAIN_TIMEOUT', 10))
+
+_STOP = object()
+
+
+class DeliveryQueue:
+    """
+    A bounded queue of notification jobs drained by a pool of worker threads.
+
+    Workers are started on the first submitted job so that importing the app,
+    or forking a server process, does not start any threads.
+    """
+
+    def __init__(self, handler, workers=DELIVERY_WORKERS, maxsize=DELIVERY_QUEUE_SIZE):
+        self._handler = handler
+        self._workers = workers
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def submit(self, job):
+        """ Queue a job for delivery. Returns False if the queue is full or shut down. """
+        with self._lock:
+            if self._stopped:
+                return False
+            if not self._threads:
+                self._start()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            logging.getLogger(__name__).warning('Delivery queue is full (%s jobs)', self.depth())
+            return False
+        return True
+
+    def depth(self):
+        """ Return the number of jobs waiting for a worker. """
+        return self._queue.qsize()
+
+    def drain(self, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """
+        Stop accepting jobs, finish the queued ones and stop the workers.
+
+        The timeout bounds the whole drain, however many workers there are. Jobs still running after it are
+        left to the daemon worker threads.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            threads = self._threads
+
+        deadline = time.monotonic() + timeout
+        try:
+            for _thread in threads:
+                self._queue.put(_STOP, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            logging.getLogger(__name__).warning('Delivery queue did not drain within %s seconds', timeout)
+            return
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def _start(self):
+        for number in range(self._workers):
+            thread = threading.Thread(target=self._work, name='delivery-{}'.format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._handler(job)
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Unable to deliver notification')
+            finally:
+                self._queue.task_done()
+
+
+def dispatch(event):
+    """
+    Record a PullRequestEvent in the spool and deliver it.
+
+    Returns True if the notification was queued for a background worker or a digest
+    and False if it was delivered before returning.
+    """
+    spool_id = SPOOL.record(event._asdict()) if SPOOL else None
+    if DELIVERY_MODE == 'async' and DELIVERY_QUEUE.submit((event, spool_id)):
+        return True
+    return deliver(event, spool_id)
+
+
+def deliver(event, spool_id=None):
+    """
+    Send a notification, one per member for a review requested from a team, and mark its spool record done
+    once slack accepted all of them, or failed if it did not.
+
+    Returns True if a notification was added to a digest to be sent later.
+    """
+    events = expand_team_event(event)
+    on_sent = _on_delivered(spool_id, event.action, len(events))
+    if not DIGEST and len(events) == 1:
+        on_sent(notify_recipient(events[0]))
+        return False
+
+    digested = False
+    for payload in create_slack_message_payloads(events):
+        if DIGEST and DIGEST.add(payload, on_sent):
+            digested = True
+        else:
+            on_sent(send_slack_message(payload))
+    return digested
+
+
+def _on_delivered(spool_id, action, count):
+    """
+    Return a callback to call with the outcome of each of count sends.
+
+    Once every send is in, the spool record is marked done if slack accepted all of them, and failed otherwise.
+    """
+    lock = threading.Lock()
+    outcomes = []
+
+    def on_sent(sent):
+        NOTIFICATIONS.inc(action, 'sent' if sent else 'failed')
+        if spool_id is None:
+            return
+        with lock:
+            outcomes.append(sent)
+            finished = len(outcomes) == count
+        if finished and all(outcomes):
+            SPOOL.mark_done(spool_id)
+        elif finished:
+            SPOOL.mark_failed(spool_id)
+
+    return on_sent
+
+
+def replay_spool():
+    """ Deliver the notifications left pending in the spool by a previous run. """
+    if not SPOOL:
+        return
+    pending = SPOOL.pending()
+    if pending:
+        logging.getLogger(__name__).info('Replaying %s pending notifications', len(pending))
+    for spool_id, job in pending:
+        event = PullRequestEvent(**job)
+        if DELIVERY_MODE != 'async' or not DELIVERY_QUEUE.submit((event, spool_id)):
+            deliver(event, spool_id)
+
+
+def shutdown():
+    """ Finish the queued notifications, send the pending digests and close the spool. """
+    DELIVERY_QUEUE.drain()
+    if DIGEST:
+        DIGEST.close()
+    if SPOOL:
+        SPOOL.close()
+
+
+DELIVERY_QUEUE = DeliveryQueue(lambda job: deliver(*job))
+SPOOL = Spool(SPOOL_PATH) if SPOOL_PATH else None
+DIGEST = Digest(send_slack_message) if DIGEST_WINDOW > 0 else None
+atexit.register(shutdown)
@@ -0,0 +1,132 @@
+""" Coalesce bursts of notifications to the same slack channel into a single digest message. """
+
+import logging
+import os
+import threading
+import time
+
+DIGEST_WINDOW = float(os.environ.get('DIGEST_WINDOW', 0))
+DIGEST_MAX_SIZE = int(os.environ.get('DIGEST_MAX_SIZE', 10))
+DIGEST_MAX_LATENCY = float(os.environ.get('DIGEST_MAX_LATENCY', 60))
+
+
+class Digest:  # pylint: disable=too-many-instance-attributes
+    """
+    Hold rendered slack messages per channel and send each channel's messages as one.
+
+    A channel's batch is flushed once no message has been added to it for `window` seconds,
+    `max_latency` seconds after its first message at the latest, or as soon as it holds `max_size` messages.
+    Each message is added with a callback that is called with whether slack accepted the digest it was sent in.
+    """
+
+    def __init__(self, sender, window=DIGEST_WINDOW, max_size=DIGEST_MAX_SIZE, max_latency=DIGEST_MAX_LATENCY):
+        self._sender = sender
+        self._window = window
+        self._max_size = max_size
+        self._max_latency = max_latency
+        self._batches = {}
+        self._changed = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, payload, callback=None):
+        """ Add a rendered message to its channel's batch. Returns False if the digest is closed. """
+        now = time.monotonic()
+        with self._changed:
+            if self._stopped:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='digest', daemon=True)
+                self._thread.start()
+
+            batch = self._batches.setdefault(payload.get('channel'), _Batch(now))
+            batch.add(payload, callback, now)
+            if len(batch.payloads) >= self._max_size:
+                del self._batches[payload.get('channel')]
+            else:
+                batch = None
+            self._changed.notify()
+
+        if batch is not None:
+            self._send(batch)
+        return True
+
+    def pending(self):
+        """ Return the number of messages waiting to be sent. """
+        with self._changed:
+            return sum(len(batch.payloads) for batch in self._batches.values())
+
+    def close(self):
+        """ Stop accepting messages and send every pending batch. """
+        with self._changed:
+            self._stopped = True
+            batches = list(self._batches.values())
+            self._batches.clear()
+            self._changed.notify()
+
+        for batch in batches:
+            self._send(batch)
+
+    def _work(self):
+        while True:
+            with self._changed:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                due = [channel for channel, batch in self._batches.items() if self._due_at(batch) <= now]
+                batches = [self._batches.pop(channel) for channel in due]
+                if not batches:
+                    timeout = min((self._due_at(batch) for batch in self._batches.values()), default=None)
+                    self._changed.wait(None if timeout is None else timeout - now)
+                    continue
+
+            for batch in batches:
+                self._send(batch)
+
+    def _due_at(self, batch):
+        return min(batch.last_added_at + self._window, batch.first_added_at + self._max_latency)
+
+    def _send(self, batch):
+        logger = logging.getLogger(__name__)
+        try:
+            sent = self._sender(combine_payloads(batch.payloads))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Unable to send digest of %s notifications', len(batch.payloads))
+            sent = False
+
+        for callback in batch.callbacks:
+            try:
+                callback(sent)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Digest callback failed')
+
+
+class _Batch:  # pylint: disable=too-few-public-methods
+
+    def __init__(self, now):
+        self.payloads = []
+        self.callbacks = []
+        self.first_added_at = now
+        self.last_added_at = now
+
+    def add(self, payload, callback, now):
+        self.payloads.append(payload)
+        if callback is not None:
+            self.callbacks.append(callback)
+        self.last_added_at = now
+
+
+def combine_payloads(payloads):
+    """ Merge messages to the same channel into one message with every message's text and attachments. """
+    if len(payloads) == 1:
+        return payloads[0]
+
+    texts = []
+    for payload in payloads:
+        if payload.get('text') not in texts:
+            texts.append(payload.get('text'))
+
+    combined = dict(payloads[0])
+    combined['text'] = '\n'.join(texts)
+    combined['attachments'] = [attachment for payload in payloads for attachment in payload.get('attachments', [])]
+    return combined
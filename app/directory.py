@@ -0,0 +1,456 @@
+""" A process-wide cache of the slack workspace directory. """
+
+from collections import namedtuple
+import logging
+import os
+import sys
+import threading
+import time
+
+import requests
+
+from app.clients import slack_api_call
+from app.metrics import STAGE_SECONDS
+
+# With slack events patching the directory as members change, a full refresh is only a safety net.
+# An event only reaches one worker though, so with several the others need the short ttl to catch up.
+DIRECTORY_TTL = int(os.environ.get('SLACK_DIRECTORY_TTL', 86400 if os.environ.get('SLACK_SIGNING_SECRET')
+                                   and os.environ.get('WEB_CONCURRENCY') == '1' else 300))
+SLACK_USERS_PAGE_LIMIT = int(os.environ.get('SLACK_USERS_PAGE_LIMIT', 200))
+SLACK_USERS_LIST_RETRIES = 3
+# After a failed refresh, wait this long (or the ttl, if shorter) before calling users.list again
+DIRECTORY_RETRY_INTERVAL = float(os.environ.get('SLACK_DIRECTORY_RETRY_INTERVAL', 30))
+
+
+class SlackDirectoryUnavailable(Exception):
+    """ Raised when a page of the slack member list could not be fetched. """
+
+
+class SlackDirectory:  # pylint: disable=too-many-instance-attributes
+    """
+    A cached copy of the slack workspace member list.
+
+    The member list is fetched with users.list at most once per ttl window.
+    When the cache is stale, the first caller refreshes it. Concurrent callers are served the stale copy
+    meanwhile, or wait for that single in-flight fetch if there is none, instead of calling the slack API.
+    When a refresh fails the last good copy is served, and the next refresh waits for the retry interval.
+
+    The loader returns an iterable of member pages. Each page is compacted and indexed as it arrives,
+    so only one page of the raw users.list response is held at a time however large the workspace is.
+    """
+
+    def __init__(self, loader=None, ttl=DIRECTORY_TTL):
+        self._loader = loader or iter_slack_member_pages
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._refreshing = False
+        # Members patched in while a refresh is in flight, to patch into its result too. None between refreshes.
+        self._pending = None
+        self._snapshot = None
+        self._fetched_at = 0
+        self._retry_at = 0
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+        self._listeners = []
+        self._fingerprint = _EMPTY_INDEX.fingerprint
+
+    def add_listener(self, listener):
+        """
+        Call listener() after a refresh or an event changed who is in the directory or what they are called.
+
+        Refreshes that fetch the same members do not call it.
+        """
+        self._listeners.append(listener)
+
+    def get_members(self):
+        """ Return the cached list of SlackMembers, refreshing it if it is missing or stale. """
+        return self._get_snapshot().members
+
+    def get_index(self):
+        """ Return the match index for the cached member list, refreshing it if it is missing or stale. """
+        return self._get_snapshot()
+
+    def get_fresh_index(self):
+        """ Return the match index if the cached member list is fresh, or None, without refreshing it. """
+        with self._lock:
+            if not self._is_stale():
+                self._hits += 1
+                return self._snapshot or _EMPTY_INDEX
+            self._misses += 1
+        return None
+
+    def get_cached_index(self):
+        """ Return the match index of the cached member list, even if it is stale, or None if there is none. """
+        with self._lock:
+            if self._snapshot is not None:
+                self._hits += 1
+            return self._snapshot
+
+    def begin_refresh(self):
+        """ Note that the caller, e.g. the asyncio server, started filling an index it will pass to replace(). """
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+
+    def replace(self, index):
+        """
+        Store an index the caller filled, e.g. the asyncio server, and return it.
+
+        Members patched in since begin_refresh() are patched into the index too.
+        If index is None the fetch failed, and the index of the last good copy is returned.
+        """
+        with self._lock:
+            if index is not None:
+                self._store(index)
+            else:
+                self._fail()
+            current = self._snapshot or _EMPTY_INDEX
+            changed = self._check_changed()
+        if changed:
+            self._notify_listeners()
+        return current
+
+    def apply_member(self, member):
+        """
+        Patch a single member, e.g. from a team_join or user_change event, into the cached directory.
+
+        This costs a few dictionary updates rather than a users.list call. Returns False if there is no
+        cached directory to patch, in which case the next refresh will include the member anyway.
+        """
+        with self._lock:
+            if self._pending is not None:
+                # The in-flight refresh may have listed the member before the change
+                self._pending.append(member)
+            if self._snapshot is None:
+                return self._pending is not None
+            applied = self._snapshot.upsert(member) is not None
+            changed = self._check_changed()
+        if changed:
+            self._notify_listeners()
+        return applied
+
+    def _get_snapshot(self):
+        with self._lock:
+            if self._refreshing and self._snapshot is not None:
+                # Serve the stale copy rather than holding up resolutions until the in-flight fetch completes
+                self._hits += 1
+                return self._snapshot
+            if self._refreshing:
+                # With nothing to serve, share the in-flight fetch rather than starting another one
+                while self._refreshing:
+                    self._refreshed.wait()
+                self._hits += 1
+                return self._snapshot or _EMPTY_INDEX
+            if not self._is_stale():
+                self._hits += 1
+                return self._snapshot or _EMPTY_INDEX
+            self._misses += 1
+            self._refreshing = True
+            self._pending = []
+
+        snapshot = None
+        try:
+            pages = self._loader()
+            if pages is not None:
+                snapshot = SlackDirectoryIndex()
+                for page in pages:
+                    snapshot.add_page(page)
+        except SlackDirectoryUnavailable:
+            snapshot = None
+        except (requests.RequestException, ValueError):
+            logging.getLogger(__name__).warning('Unable to refresh the slack directory', exc_info=True)
+            snapshot = None
+        finally:
+            with self._lock:
+                self._refreshing = False
+                if snapshot is not None:
+                    self._store(snapshot)
+                else:
+                    self._fail()
+                self._refreshed.notify_all()
+                changed = self._check_changed()
+
+        if changed:
+            self._notify_listeners()
+        # Serve the last good copy rather than failing the notification
+        return self._snapshot or _EMPTY_INDEX
+
+    def invalidate(self):
+        """ Drop the cached member list so the next lookup fetches a fresh copy. """
+        with self._lock:
+            self._snapshot = None
+            self._fetched_at = 0
+            self._retry_at = 0
+
+    def stats(self):
+        """ Return the cache counters and the size of the cached directory. """
+        with self._lock:
+            snapshot = self._snapshot or _EMPTY_INDEX
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'errors': self._errors,
+                'members': len(snapshot.members),
+                'bytes': snapshot.footprint(),
+                'age': time.monotonic() - self._fetched_at if self._snapshot is not None else None,
+            }
+
+    def _check_changed(self):
+        fingerprint = (self._snapshot or _EMPTY_INDEX).fingerprint
+        if fingerprint == self._fingerprint:
+            return False
+        self._fingerprint = fingerprint
+        return True
+
+    def _notify_listeners(self):
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Unable to notify %s of a directory change', listener)
+
+    def _store(self, snapshot):
+        for member in self._pending or ():
+            snapshot.upsert(member)
+        self._pending = None
+        self._snapshot = snapshot
+        self._fetched_at = time.monotonic()
+
+    def _fail(self):
+        # Keep serving the last good copy, and back off rather than calling users.list on every lookup of an outage
+        self._pending = None
+        self._errors += 1
+        self._retry_at = time.monotonic() + min(self._ttl, DIRECTORY_RETRY_INTERVAL)
+
+    def _is_stale(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            return False
+        return self._snapshot is None or now - self._fetched_at >= self._ttl
+
+
+class SlackMember(namedtuple('SlackMember', ['id', 'name', 'name_key', 'display_key', 'real_key'])):
+    """
+    The parts of a slack member needed to match it, with its keys lowercased.
+
+    Strings are interned, so a name and display name that are the same are only stored once.
+    A deleted member keeps its place in the directory but has no keys, so it does not match.
+    """
+
+    __slots__ = ()
+
+    @property
+    def keys(self):
+        """ The username, display name and real name keys, in the order of the index tables. """
+        return self[2:]
+
+    @classmethod
+    def from_member(cls, member):
+        """ Create a SlackMember from a users.list member or an event's user, or None if it is not a member. """
+        if not isinstance(member, dict) or not member.get('name'):
+            return None
+
+        name = sys.intern(member['name'])
+        member_id = sys.intern(member.get('id') or name)
+        if member.get('deleted'):
+            return cls(member_id, name, None, None, None)
+
+        display_name = (member.get('profile') or {}).get('display_name')
+        real_name = (member.get('real_name') or '').strip()
+        return cls(
+            member_id,
+            name,
+            sys.intern(name.lower()),
+            sys.intern(display_name.lower()) if display_name else None,
+            sys.intern(real_name.lower()) if real_name else None,
+        )
+
+
+class SlackDirectoryIndex:
+    """
+    Compact slack members in users.list order, and normalized lookup tables over them.
+
+    Each table maps a lowercased key to the position of the member (in users.list order) that has it,
+    so a match resolves with a few dictionary lookups while still returning the same user
+    a linear scan over the member list would. Members can be added a page at a time while users.list
+    is walked, then changed or removed one at a time, for example from slack events, without rebuilding the tables.
+    """
+
+    def __init__(self, members=()):
+        self.members = []
+        self._positions = {}
+        self._by_name = {}
+        self._by_display_name = {}
+        self._by_real_name = {}
+        self._footprint = None
+        # An xor of the members' hashes, so it is updated in constant time as members change
+        self.fingerprint = 0
+        self.add_page(members)
+
+    def add_page(self, members):
+        """ Add a page of users.list members. """
+        for member in members:
+            self.upsert(member)
+
+    def upsert(self, member):
+        """
+        Add a new member, or replace the entries of a member whose profile changed or who was deleted.
+
+        Returns the member's position in users.list order, new members going last, or None if it is not a member.
+        """
+        record = SlackMember.from_member(member)
+        if record is None:
+            return None
+
+        position = self._positions.get(record.id)
+        if position is None:
+            position = len(self.members)
+            self.members.append(record)
+            self._swap(None, record, position)
+            self._positions[record.id] = position
+        else:
+            previous = self.members[position]
+            self._swap(previous, record, position)
+            self.fingerprint ^= hash(previous)
+        self.fingerprint ^= hash(record)
+        self._footprint = None
+        return position
+
+    def match_username(self, github_username):
+        """ Find the slack username whose username or display name matches the github username. """
+        if not github_username:
+            return None
+        key = github_username.lower()
+        matches = [match for match in (_best(self._by_name, key), _best(self._by_display_name, key))
+                   if match is not None]
+        if matches:
+            return self.members[min(matches)].name
+        return None
+
+    def match_full_name(self, full_name):
+        """ Find the slack username whose full name matches. """
+        if not full_name:
+            return None
+        match = _best(self._by_real_name, full_name.strip().lower())
+        return self.members[match].name if match is not None else None
+
+    def footprint(self):
+        """ Return the bytes taken by the members and tables, counting strings shared between them once. """
+        if self._footprint is None:
+            seen = set()
+            self._footprint = sum(_deep_sizeof(table, seen) for table in (
+                self.members, self._positions, self._by_name, self._by_display_name, self._by_real_name))
+        return self._footprint
+
+    def _swap(self, previous, record, position):
+        # Matches read the tables without the directory lock, so the new keys are added before the old ones are
+        # dropped and a key the member keeps is left alone. A concurrent match never misses the member.
+        old_keys = previous.keys if previous is not None else (None, None, None)
+        changes = [(table, old_key, new_key) for table, old_key, new_key
+                   in zip((self._by_name, self._by_display_name, self._by_real_name), old_keys, record.keys)
+                   if old_key != new_key]
+        for table, _, new_key in changes:
+            if new_key:
+                _add_entry(table, new_key, position)
+        self.members[position] = record
+        for table, old_key, _ in changes:
+            if old_key:
+                _discard_entry(table, old_key, position)
+
+
+# A key held by one member maps to its position, and a key shared by several members to a list of positions.
+# Shared keys are rare, so this saves a list per key without losing the runners up when the first member changes.
+def _add_entry(table, key, position):
+    current = table.get(key)
+    if current is None:
+        table[key] = position
+    elif isinstance(current, list):
+        table[key] = current + [position]
+    else:
+        table[key] = [current, position]
+
+
+def _discard_entry(table, key, position):
+    current = table.get(key)
+    if isinstance(current, list):
+        remaining = [entry for entry in current if entry != position]
+        table[key] = remaining[0] if len(remaining) == 1 else remaining
+    elif current == position:
+        del table[key]
+
+
+def _best(table, key):
+    current = table.get(key)
+    if isinstance(current, list):
+        return min(current)
+    return current
+
+
+_EMPTY_INDEX = SlackDirectoryIndex()
+
+
+def iter_slack_member_pages(limit=SLACK_USERS_PAGE_LIMIT):
+    """
+    Yield the pages of the slack member list, following users.list cursors until the last page.
+
+    Each page is retried up to SLACK_USERS_LIST_RETRIES times while slack rate limits it.
+    Raises SlackDirectoryUnavailable if a page could not be fetched.
+    """
+    cursor = None
+    retries = SLACK_USERS_LIST_RETRIES
+    while True:
+        with STAGE_SECONDS.time('users_list'):
+            response = slack_api_call('users.list', limit=limit, **({'cursor': cursor} if cursor else {}))
+        members, next_cursor = read_member_page(response, retries)
+        if members is None:
+            retries -= 1
+            time.sleep(get_retry_after(response))
+            continue
+
+        yield members
+        if not next_cursor:
+            return
+        cursor = next_cursor
+        retries = SLACK_USERS_LIST_RETRIES
+
+
+def read_member_page(response, retries):
+    """
+    Return the members of a users.list response and the cursor of the next page, which is empty after the last one.
+
+    The members are None if slack rate limited the call and retries are left, in which case the page should be
+    requested again after get_retry_after(response). Raises SlackDirectoryUnavailable if the page could not be fetched.
+    """
+    members = response.get('members')
+    if members is None:
+        if response.get('error') == 'ratelimited' and retries:
+            # users.list is a tier 2 method, so a large workspace can hit its rate limit part way through
+            return None, None
+        logging.getLogger(__name__).warning('Unable to list slack users. Response: %s', response)
+        raise SlackDirectoryUnavailable(response.get('error'))
+    return members, (response.get('response_metadata') or {}).get('next_cursor')
+
+
+def get_retry_after(response):
+    """ Return the seconds slack asked to wait in the Retry-After header of a rate limited response. """
+    try:
+        return float(response.get('headers', {}).get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(key, seen) + _deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+DIRECTORY = SlackDirectory()
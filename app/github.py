@@ -1,13 +1,26 @@
 """ Code related to github webhooks and API calls. """
 
-import copy
+from collections import namedtuple
+import logging
+import math
 import os
+from types import MappingProxyType
 
 import requests
 from werkzeug.exceptions import BadRequest
 
+from app.cache import EtagCache
+from app.clients import GITHUB_API_URL
+from app.clients import request
+from app.metrics import STAGE_SECONDS
+from app.metrics import UPSTREAM_ERRORS
+from app.metrics import UPSTREAM_RATELIMITED
 
 IGNORED_USERS = os.environ.get('IGNORED_USERS', '').split(',')
+GITHUB_TEAM_CACHE_TTL = int(os.environ.get('GITHUB_TEAM_CACHE_TTL', 60 * 60))
+GITHUB_TEAM_PAGE_SIZE = 100
+NAME_CACHE = EtagCache('users')
+TEAM_CACHE = EtagCache('team_pages', ttl=GITHUB_TEAM_CACHE_TTL)
 
 
 def is_valid_pull_request(data):
@@ -33,9 +46,9 @@ def _validate_pull_request(data):
     return True
 
 
-def get_recipient_github_username_by_action(data):
-    """ Parse and return the recipient username by action type. """
-    payload_parser = GithubWebhookPayloadParser(data)
+def get_recipient_github_username_by_action(data, payload_parser=None):
+    """ Parse and return the recipient username by action type, reusing the payload's parser if given one. """
+    payload_parser = payload_parser or GithubWebhookPayloadParser(data)
 
     if data.get('action') == 'review_requested':
         username = payload_parser.get_request_reviewer_username()
@@ -47,54 +60,268 @@ def get_recipient_github_username_by_action(data):
     return username
 
 
+@STAGE_SECONDS.time('github_name_lookup')
 def lookup_github_full_name(gh_username):
-    """ Retrieve a github user's full name by username. """
-    url = 'https://api.github.com/users/{}'.format(gh_username)
-    request = requests.get(url, auth=(os.environ.get('GITHUB_API_USER', ''), os.environ.get('GITHUB_API_TOKEN', '')))
-    user = request.json()
-    return user.get('name', '')
+    """
+    Retrieve a github user's full name by username.
+
+    Names are cached locally. Stale names are revalidated with a conditional request, and logins github does
+    not know are cached with an empty name. Returns None if github could not answer and no name was cached.
+    """
+    entry, fresh = get_cached_full_name(gh_username)
+    if fresh:
+        return entry.value
+
+    url, headers = get_full_name_request(gh_username, entry)
+    response = request('GET', url, headers=headers, auth=get_github_auth())
+    user = response.json() if response.status_code == 200 else None
+    return store_full_name_response(gh_username, entry, response.status_code, response.headers, user)
+
+
+def get_cached_full_name(gh_username):
+    """ Return the cached name entry of a github user, or None, and whether it is fresh enough to serve as is. """
+    entry = NAME_CACHE.get(gh_username)
+    if entry is not None and entry.value is None:
+        # Names cached before null names were normalized
+        entry = entry._replace(value='')
+    fresh = NAME_CACHE.is_fresh(entry)
+    if fresh:
+        NAME_CACHE.record_hit()
+    else:
+        NAME_CACHE.record_miss()
+    return entry, fresh
+
+
+def get_full_name_request(gh_username, entry):
+    """ Return the url and headers to ask github for a user's name, revalidating a stale cached entry. """
+    url = '{}/users/{}'.format(GITHUB_API_URL, gh_username)
+    headers = {'If-None-Match': entry.etag} if entry and entry.etag else {}
+    return url, headers
+
+
+def store_full_name_response(gh_username, entry, status, headers, user=None):
+    """
+    Cache github's answer to a get_full_name_request and return the name, like lookup_github_full_name.
+
+    `user` is the decoded body of a 200 response. This is shared by the asyncio server, which makes its own request.
+    """
+    if status == 304 and entry:
+        NAME_CACHE.touch(gh_username)
+        return entry.value
+
+    if status != 200:
+        _record_github_error(status, headers)
+        if status == 404:
+            # Remember logins github does not know, rather than asking about them for every delivery
+            NAME_CACHE.set(gh_username, '')
+            return ''
+        return entry.value if entry else None
+
+    # Github answers with a null name for users who did not set one, which most bots have not
+    name = user.get('name') or ''
+    NAME_CACHE.set(gh_username, name, headers.get('ETag'))
+    return name
+
+
+def lookup_github_team_members(team):
+    """
+    Retrieve the usernames of a github team's members, given as 'org/team-slug'.
+
+    Memberships are cached locally for GITHUB_TEAM_CACHE_TTL. Stale memberships are revalidated with a
+    conditional request for each of their pages. If github can't list the team, the stale membership is used.
+    """
+    entry = TEAM_CACHE.get(team)
+    if TEAM_CACHE.is_fresh(entry):
+        TEAM_CACHE.record_hit()
+        return _get_team_members(entry.value)
+
+    TEAM_CACHE.record_miss()
+    cached_pages = entry.value if entry else []
+    try:
+        pages = _list_team_pages(team, cached_pages)
+    except requests.HTTPError as error:
+        logging.getLogger(__name__).warning('Unable to list members of team %s: %s', team,
+                                            error.response.status_code)
+        return _get_team_members(cached_pages)
+
+    if entry and pages == cached_pages:
+        TEAM_CACHE.touch(team)
+    else:
+        TEAM_CACHE.set(team, pages)
+    return _get_team_members(pages)
+
+
+def _list_team_pages(team, cached_pages):
+    # Each page is revalidated with its own ETag, since a member joining or leaving may only change a later page
+    org, slug = team.split('/', 1)
+    url = '{}/orgs/{}/teams/{}/members'.format(GITHUB_API_URL, org, slug)
+    pages = []
+    while True:
+        cached = cached_pages[len(pages)] if len(pages) < len(cached_pages) else None
+        headers = {'If-None-Match': cached['etag']} if cached and cached['etag'] else {}
+        response = request('GET', url, headers=headers, params={'per_page': GITHUB_TEAM_PAGE_SIZE,
+                                                                'page': len(pages) + 1}, auth=get_github_auth())
+
+        if response.status_code == 304 and cached:
+            page = cached
+            # A full page that did not change may still be followed by a new one
+            has_next = ('next' in response.links or len(pages) + 1 < len(cached_pages)
+                        or len(page['members']) >= GITHUB_TEAM_PAGE_SIZE)
+        elif response.status_code == 200:
+            page = {'etag': response.headers.get('ETag'),
+                    'members': [member.get('login') for member in response.json()]}
+            has_next = 'next' in response.links
+        else:
+            _record_github_error(response.status_code, response.headers)
+            response.raise_for_status()
+            raise requests.HTTPError('Unexpected status {}'.format(response.status_code), response=response)
+
+        pages.append(page)
+        if not has_next or not page['members']:
+            return pages
+
+
+def _get_team_members(pages):
+    return [member for page in pages for member in page['members']]
+
+
+def expand_team_event(event):
+    """
+    Return one event per member of the team a review was requested from, or just the event itself.
+
+    The pull request author is left out. If the team can't be listed, the event is returned as is
+    and falls through to the default channel.
+    """
+    if not event.team:
+        return [event]
+
+    try:
+        members = lookup_github_team_members(event.team)
+    except (requests.RequestException, ValueError):
+        logging.getLogger(__name__).warning('Unable to list members of team %s', event.team, exc_info=True)
+        members = []
+
+    members = [member for member in members if member and member != event.author]
+    if not members:
+        return [event]
+    return [event._replace(recipient=member, reviewer=member) for member in members]
+
+
+def _record_github_error(status, headers):
+    UPSTREAM_ERRORS.inc('github', str(status))
+    if status == 429 or headers.get('X-RateLimit-Remaining') == '0':
+        UPSTREAM_RATELIMITED.inc('github')
+
+
+def get_github_auth():
+    """ Return the user and token to authenticate github API calls with. """
+    return os.environ.get('GITHUB_API_USER', ''), os.environ.get('GITHUB_API_TOKEN', '')
+
+
+class PullRequestEvent(namedtuple('PullRequestEvent', [
+        'action', 'recipient', 'reviewer', 'url', 'title', 'repo', 'number', 'author', 'author_image', 'description',
+        'team',
+])):
+    """
+    The parts of a pull request webhook needed to send a notification.
+
+    This is a compact, immutable record that can be queued or spooled in place of the full payload.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_payload(cls, data):
+        """ Extract an event from a webhook payload in a single pass. """
+        pull_request = data.get('pull_request', {})
+        author = pull_request.get('user', {})
+        payload_parser = GithubWebhookPayloadParser(data)
+
+        return cls(
+            action=data.get('action'),
+            recipient=get_recipient_github_username_by_action(data, payload_parser),
+            reviewer=data.get('requested_reviewer', {}).get('login'),
+            url=pull_request.get('html_url'),
+            title=pull_request.get('title') or 'Unknown Title',
+            repo=data.get('repository', {}).get('full_name') or 'Unknown',
+            number=data.get('number') or math.pi,
+            author=author.get('login'),
+            author_image=author.get('avatar_url'),
+            description=pull_request.get('body'),
+            team=payload_parser.get_requested_team(),
+        )
+
+
+PullRequestEvent.__new__.__defaults__ = (None,) * len(PullRequestEvent._fields)
 
 
 class GithubWebhookPayloadParser:
-    """ A class to parse a github payload and return specific elements. """
+    """
+    A class to parse a github payload and return specific elements.
+
+    The parser is a read-only view over the payload: it does not copy it, and each element is only looked up once.
+    """
 
     def __init__(self, data=None):
         if data is None:
             data = {}
-        self._data = copy.deepcopy(data)
+        self._data = MappingProxyType(data)
+        self._cache = {}
 
     def get_request_reviewer_username(self):
         """ Parse and retrieve the requested reviewer username. """
-        return self._data.get('requested_reviewer', {}).get('login')
+        return self._lookup('requested_reviewer', 'login')
+
+    def get_requested_team(self):
+        """ Parse and retrieve the team a review was requested from, as 'org/team-slug'. """
+        slug = self._lookup('requested_team', 'slug')
+        if not slug:
+            return None
+        org = self._lookup('organization', 'login') or self._lookup('repository', 'owner', 'login')
+        return '{}/{}'.format(org, slug)
 
     def get_assignee_username(self):
         """ Parse and retrieve the assignee's username. """
-        return self._data.get('assignee', {}).get('login')
+        return self._lookup('assignee', 'login')
 
     def get_pull_request_title(self):
         """ Parse and retrieve the pull request title. """
-        return self._data.get('pull_request', {}).get('title')
+        return self._lookup('pull_request', 'title')
 
     def get_pull_request_url(self):
         """ Parse and retrieve the pull request html url. """
-        return self._data.get('pull_request', {}).get('html_url')
+        return self._lookup('pull_request', 'html_url')
 
     def get_pull_request_repo(self):
         """ Parse and retrieve the pull request repository name. """
-        return self._data.get('repository', {}).get('full_name')
+        return self._lookup('repository', 'full_name')
 
     def get_pull_request_number(self):
         """ Parse and retrieve the pull request number. """
-        return self._data.get('number')
+        return self._lookup('number')
 
     def get_pull_request_author(self):
         """ Parse and retrieve the pull request author. """
-        return self._data.get('pull_request', {}).get('user', {}).get('login')
+        return self._lookup('pull_request', 'user', 'login')
 
     def get_pull_request_author_image(self):
         """ Parse and retrieve the pull request author image. """
-        return self._data.get('pull_request', {}).get('user', {}).get('avatar_url')
+        return self._lookup('pull_request', 'user', 'avatar_url')
 
     def get_pull_request_description(self):
         """ Parse and retrieve the pull request repository description. """
-        return self._data.get('pull_request', {}).get('body')
+        return self._lookup('pull_request', 'body')
+
+    def _lookup(self, *path):
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+
+        value = self._data
+        for key in path[:-1]:
+            value = value.get(key, {})
+        value = value.get(path[-1])
+
+        self._cache[path] = value
+        return value
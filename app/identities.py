@@ -0,0 +1,155 @@
+""" An optional static map of github logins to slack usernames, reloaded when its file changes. """
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from app.metrics import IDENTITY_LOOKUPS
+
+try:
+    import yaml
+except ImportError:  # PyYAML is only needed to read yaml identity maps
+    yaml = None
+
+IDENTITY_MAP_PATH = os.environ.get('IDENTITY_MAP_PATH')
+IDENTITY_MAP_RELOAD_INTERVAL = float(os.environ.get('IDENTITY_MAP_RELOAD_INTERVAL', 10))
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+
+class IdentityMap:  # pylint: disable=too-many-instance-attributes
+    """
+    Github logins mapped to slack usernames, read from a json or yaml file or a sqlite table.
+
+    A lookup is a single dictionary get, so a mapped user is resolved without any slack or github calls.
+    A background thread, started on the first lookup so that every forked worker has its own, checks the
+    file's mtime and swaps in a freshly loaded map when it changed. If the file can not be read the previous
+    map is kept.
+    """
+
+    def __init__(self, path, interval=IDENTITY_MAP_RELOAD_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._identities = {}
+        self._version = ()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._reloads = 0
+        self._errors = 0
+
+    def lookup(self, github_login):
+        """ Return the slack username mapped to a github login, or None. """
+        if self._thread is None:
+            self._start()
+        if not github_login:
+            return None
+
+        slack_username = self._identities.get(github_login.lower())
+        IDENTITY_LOOKUPS.inc('mapped' if slack_username else 'unmapped')
+        return slack_username
+
+    def reload(self):
+        """ Load the map again if its file changed since it was last loaded. Returns True if it was reloaded. """
+        logger = logging.getLogger(__name__)
+        try:
+            version = _get_version(self._path)
+        except OSError:
+            version = None
+        if version == self._version:
+            return False
+
+        # Remember the version even if loading fails, so a broken file is only reported once
+        self._version = version
+        try:
+            identities = load_identities(self._path)
+        except Exception:  # pylint: disable=broad-except
+            self._errors += 1
+            logger.warning('Unable to load the identity map from %s, keeping %s identities',
+                           self._path, len(self._identities), exc_info=True)
+            return False
+
+        self._identities = identities
+        self._reloads += 1
+        logger.info('Loaded %s identities from %s', len(identities), self._path)
+        return True
+
+    def stop(self):
+        """ Stop watching the file for changes. """
+        self._stopped.set()
+
+    def stats(self):
+        """ Return the number of mapped logins and how often the map was loaded. """
+        return {'entries': len(self._identities), 'reloads': self._reloads, 'errors': self._errors}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.reload()
+            self._thread = threading.Thread(target=self._watch, name='identity-map', daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.reload()
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Unable to check the identity map for changes')
+
+
+def load_identities(path):
+    """
+    Read a map of github logins to slack usernames.
+
+    Json and yaml files hold a single object, e.g. `{"octocat": "mona"}`. A sqlite database has an `identities`
+    table with `github_login` and `slack_username` columns. Logins are matched case insensitively and a leading
+    @ is dropped from usernames.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in SQLITE_EXTENSIONS:
+        identities = _load_sqlite(path)
+    elif extension in YAML_EXTENSIONS:
+        if yaml is None:
+            raise RuntimeError('PyYAML must be installed to read {}'.format(path))
+        with open(path, encoding='utf-8') as source:
+            identities = yaml.safe_load(source) or {}
+    else:
+        with open(path, encoding='utf-8') as source:
+            identities = json.load(source)
+
+    if not isinstance(identities, dict):
+        raise ValueError('{} must map github logins to slack usernames'.format(path))
+    return {
+        sys.intern(str(login).lower()): sys.intern(str(slack_username).lstrip('@'))
+        for login, slack_username in identities.items() if login and slack_username
+    }
+
+
+def _load_sqlite(path):
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        return dict(conn.execute('SELECT github_login, slack_username FROM identities'))
+    finally:
+        conn.close()
+
+
+def _get_version(path):
+    # A sqlite database in WAL mode is changed by writing to its -wal file before the database itself
+    versions = []
+    for name in (path, '{}-wal'.format(path)):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            if name == path:
+                raise
+            continue
+        versions.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(versions)
+
+
+IDENTITIES = IdentityMap(IDENTITY_MAP_PATH) if IDENTITY_MAP_PATH else None
@@ -0,0 +1,257 @@
+"""
+Lightweight in-process metrics, exposed in the Prometheus text format.
+
+Recording is lock-free: every thread records into its own shard of a metric, and the shards are only summed
+when the metrics are rendered. While recording, the only lock is taken once per thread and metric, when the shard
+is created.
+The shards of threads that exited are folded into the shard of the thread that renders, so threads coming
+and going do not grow a metric.
+"""
+
+import bisect
+from contextlib import ContextDecorator
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Metric:
+    """ A named metric family with per thread shards of values keyed by label values. """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def collect(self):
+        """ Return the value for every set of label values seen, summed across threads. """
+        shard = self._shard()
+        with self._lock:
+            live = []
+            for thread, other in self._shards:
+                if thread.is_alive():
+                    live.append((thread, other))
+                else:
+                    # Nothing writes to a dead thread's shard, and only this thread writes to its own
+                    self._merge(shard, other)
+            self._shards = live
+            shards = [other for _thread, other in live]
+
+        totals = {}
+        for other in shards:
+            # Only the owning thread writes to a shard, and copying a dict is atomic under the GIL
+            self._merge(totals, other.copy())
+        return totals
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _merge(self, totals, shard):
+        raise NotImplementedError
+
+    def _format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs))
+
+    def render(self, extra=()):
+        """ Return the metric's lines in the Prometheus text format, adding the extra label pairs to every sample. """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self._render_samples(list(extra)))
+        return lines
+
+    def _render_samples(self, extra):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """ A monotonically increasing count per set of label values. """
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """ Add to the count for the label values. """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, *labels):
+        """ Return the total count for the label values. """
+        return self.collect().get(labels, 0)
+
+    def values(self):
+        """ Return the total count for every set of label values seen. """
+        return self.collect()
+
+    def _merge(self, totals, shard):
+        for labels, count in shard.items():
+            totals[labels] = totals.get(labels, 0) + count
+
+    def _render_samples(self, extra):
+        for labels, count in sorted(self.values().items(), key=_label_order):
+            yield '{}{} {}'.format(self.name, self._format_labels(labels, extra), _format_value(count))
+
+
+class Histogram(_Metric):
+    """ Count observations per set of label values into cumulative upper-bound buckets. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """ Record a single observation. """
+        shard = self._shard()
+        row = shard.get(labels)
+        if row is None:
+            # One count per bucket, one for +Inf, then the sum
+            row = shard[labels] = [0] * (len(self._buckets) + 2)
+        row[bisect.bisect_left(self._buckets, value)] += 1
+        row[-1] += value
+
+    def time(self, *labels):
+        """ Return a context manager, also usable as a decorator, that observes the seconds its block took. """
+        return _Timer(self, labels)
+
+    def snapshot(self, *labels):
+        """ Return the cumulative bucket counts, the total count and the sum of observations for the label values. """
+        return self._snapshots().get(labels, self._cumulative([0] * (len(self._buckets) + 2)))
+
+    def _snapshots(self):
+        return {labels: self._cumulative(row) for labels, row in self.collect().items()}
+
+    def _merge(self, totals, shard):
+        for labels, row in shard.items():
+            total = totals.setdefault(labels, [0] * len(row))
+            for position, count in enumerate(list(row)):
+                total[position] += count
+
+    def _cumulative(self, row):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self._buckets + (math.inf,), row):
+            running += count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'count': running, 'sum': row[-1]}
+
+    def _render_samples(self, extra):
+        for labels, snapshot in sorted(self._snapshots().items(), key=_label_order):
+            for bound, count in snapshot['buckets']:
+                bucket_labels = self._format_labels(labels, extra + [('le', _format_value(bound))])
+                yield '{}_bucket{} {}'.format(self.name, bucket_labels, count)
+            yield '{}_sum{} {}'.format(self.name, self._format_labels(labels, extra), _format_value(snapshot['sum']))
+            yield '{}_count{} {}'.format(self.name, self._format_labels(labels, extra), snapshot['count'])
+
+
+class _Timer(ContextDecorator):
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._started = threading.local()
+
+    def __enter__(self):
+        self._started.at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started.at, *self._labels)
+        return False
+
+
+class Registry:
+    """
+    The metrics to expose, plus collectors for values that are read from elsewhere when rendering.
+
+    Metrics are kept per process. With a process label, every sample is labelled with the process id, so the
+    series of different gunicorn workers can be told apart and summed when they are scraped.
+    """
+
+    def __init__(self, process_label=None):
+        self._metrics = []
+        self._collectors = []
+        self._process_label = process_label
+
+    def register(self, metric):
+        """ Add a metric and return it. """
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """
+        Add a function called on every render.
+
+        It returns (name, kind, documentation, samples) tuples, where samples are (labels dict, value) pairs.
+        """
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        """ Return every metric in the Prometheus text format. """
+        extra = [(self._process_label, os.getpid())] if self._process_label else []
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(extra))
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in samples:
+                    label_text = ','.join('{}="{}"'.format(key, _escape(val))
+                                          for key, val in sorted(dict(labels, **dict(extra)).items()))
+                    lines.append('{}{} {}'.format(name, '{{{}}}'.format(label_text) if label_text else '',
+                                                  _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _label_order(item):
+    return tuple(str(value) for value in item[0])
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+REGISTRY = Registry(process_label='pid')
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'notifier_stage_seconds', 'Seconds spent in each stage of handling a pull request hook', ['stage']))
+HOOK_RESULTS = REGISTRY.register(Counter(
+    'notifier_hooks_total', 'Pull request hooks received, by action and outcome', ['action', 'outcome']))
+NOTIFICATIONS = REGISTRY.register(Counter(
+    'notifier_notifications_total', 'Slack notifications, by action and whether slack accepted them',
+    ['action', 'outcome']))
+FALLBACKS = REGISTRY.register(Counter(
+    'notifier_fallbacks_total', 'Notifications sent to the default channel or without an author, and why',
+    ['field', 'reason']))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    'notifier_upstream_errors_total', 'Failed calls to slack, github and the octocat feed', ['service', 'error']))
+UPSTREAM_RATELIMITED = REGISTRY.register(Counter(
+    'notifier_upstream_ratelimited_total', 'Calls slack or github refused because of rate limits', ['service']))
+IDENTITY_LOOKUPS = REGISTRY.register(Counter(
+    'notifier_identity_map_lookups_total', 'Github logins looked up in the static identity map, and whether they were '
+    'mapped', ['outcome']))
@@ -1,37 +1,119 @@
 """ Get an octocat image. """
 
 from datetime import datetime
+import logging
 import os
 import random
 import re
-import shutil
-import urllib.request
+import tempfile
+import threading
+import time
 
 import feedparser
 
-RSS_FILE = '/tmp/octocats.rss'
-
+from app.clients import HTTP_CONNECT_TIMEOUT
+from app.clients import request
+from app.metrics import STAGE_SECONDS
+from app.metrics import UPSTREAM_ERRORS
 
+RSS_FILE = '/tmp/octocats.rss'
+RSS_URL = os.environ.get('OCTOCAT_FEED_URL', 'http://feeds.feedburner.com/Octocats')
+RSS_TIMEOUT = float(os.environ.get('OCTOCAT_FEED_TIMEOUT', 10))
+RSS_RETRY_INTERVAL = int(os.environ.get('OCTOCAT_FEED_RETRY_INTERVAL', 60 * 5))
+
+# Served until the RSS file has been downloaded, or if it can not be
+FALLBACK_OCTOCATS = (
+    'https://octodex.github.com/images/original.png',
+    'https://octodex.github.com/images/catstello.png',
+    'https://octodex.github.com/images/octobiwan.jpg',
+    'https://octodex.github.com/images/labtocat.png',
+    'https://octodex.github.com/images/minertocat.png',
+    'https://octodex.github.com/images/spidertocat.png',
+    'https://octodex.github.com/images/dojocat.jpg',
+    'https://octodex.github.com/images/privateinvestocat.jpg',
+    'https://octodex.github.com/images/inflatocat.png',
+)
+
+_REFRESH_LOCK = threading.Lock()
+_REFRESH = {'thread': None, 'attempted_at': None}
+
+
+@STAGE_SECONDS.time('octocat')
 def get_random_octocat_image():
     """
     Retrieve the URL for a random octocat image.
 
     This will retrieve this list of octocats from http://feeds.feedburner.com/Octocats
     It will download that file locally and store it for a week.
-    It will parse that file, and get a list of octocat images.
+    It will parse that file once, and keep the list of octocat images in memory until the file changes.
     It will then return 1 of those images.
+
+    The file is downloaded in the background. Until it is available, a bundled list of octocats is used.
     """
 
-    _retrieve_rss_file()
-    octocats = _get_octocats_from_rss()
-    return random.choice(octocats)
+    _refresh_rss_file_in_background()
+    return random.choice(OCTOCAT_POOL.get_octocats() or FALLBACK_OCTOCATS)
+
+
+class OctocatPool:
+    """ The octocat images parsed from the RSS file, reparsed only when the file's mtime changes. """
+
+    def __init__(self, path=RSS_FILE):
+        self._path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._octocats = ()
+
+    def get_octocats(self):
+        """ Return a tuple of octocat image URLs, empty if the RSS file has not been downloaded. """
+        try:
+            mtime = os.path.getmtime(self._path)
+        except OSError:
+            return ()
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._octocats = tuple(_get_octocats_from_rss(self._path))
+                    self._mtime = mtime
+        return self._octocats
+
+    def clear(self):
+        """ Forget the parsed octocats so the file is parsed again. """
+        with self._lock:
+            self._mtime = None
+            self._octocats = ()
+
+
+def _refresh_rss_file_in_background():
+    """ Start downloading the RSS file if it is stale, unless a download is running or recently failed. """
+    if not _should_retrieve_rss_file():
+        return
+    attempted_at = _REFRESH['attempted_at']
+    if attempted_at is not None and time.monotonic() - attempted_at < RSS_RETRY_INTERVAL:
+        return
+
+    with _REFRESH_LOCK:
+        thread = _REFRESH['thread']
+        if thread is not None and thread.is_alive():
+            return
+        _REFRESH['attempted_at'] = time.monotonic()
+        _REFRESH['thread'] = threading.Thread(target=_retrieve_rss_file, name='octocat-refresh', daemon=True)
+        _REFRESH['thread'].start()
 
 
 def _retrieve_rss_file():
-    """ Download the RSS file locally. """
-    if _should_retrieve_rss_file():
-        with urllib.request.urlopen('http://feeds.feedburner.com/Octocats') as response, open(RSS_FILE, 'wb') as feed:
-            shutil.copyfileobj(response, feed)
+    """ Download the RSS file locally, replacing the old file only once the download is complete. """
+    feed = tempfile.NamedTemporaryFile(dir=os.path.dirname(RSS_FILE), delete=False)
+    try:
+        with feed, request('GET', RSS_URL, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, RSS_TIMEOUT)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(64 * 1024):
+                feed.write(chunk)
+        os.replace(feed.name, RSS_FILE)
+    except Exception as error:  # pylint: disable=broad-except
+        logging.getLogger(__name__).warning('Unable to download the octocat feed', exc_info=True)
+        UPSTREAM_ERRORS.inc('octocat_feed', type(error).__name__)
+        os.remove(feed.name)
 
 
 def _should_retrieve_rss_file():
@@ -53,11 +135,14 @@ def _is_file_older_than_7_days(path):
     return age_delta.days >= 7
 
 
-def _get_octocats_from_rss():
+def _get_octocats_from_rss(path=RSS_FILE):
     """ Parse the RSS looking for the octocat images. """
     octocats = []
-    feed = feedparser.parse(RSS_FILE)
+    feed = feedparser.parse(path)
     entries = feed.get('entries', [])
     for entry in entries:
         octocats.extend(re.findall('http.?://octodex[^\'"]*', entry.get('summary')))
     return octocats
+
+
+OCTOCAT_POOL = OctocatPool()
@@ -0,0 +1,102 @@
+""" Token bucket rate limiting for slack API calls. """
+
+import os
+import threading
+import time
+
+from app.metrics import REGISTRY
+from app.metrics import Histogram
+
+SLACK_CHANNEL_RATE = float(os.environ.get('SLACK_CHANNEL_RATE', 1))
+SLACK_CHANNEL_BURST = float(os.environ.get('SLACK_CHANNEL_BURST', 3))
+SLACK_GLOBAL_RATE = float(os.environ.get('SLACK_GLOBAL_RATE', 10))
+SLACK_GLOBAL_BURST = float(os.environ.get('SLACK_GLOBAL_BURST', 20))
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket.
+
+    Tokens are reserved rather than polled: a caller always gets a token,
+    along with how long it must wait before using it.
+    """
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        # Tokens are refilled from this time on, which is in the future while the bucket is paused
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token and return the number of seconds to wait before using it. """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+            return wait + max(self._updated - now, 0)
+
+    def pause(self, seconds):
+        """
+        Hold back every caller for a number of seconds, e.g. when slack sends a Retry-After.
+
+        Callers held back by a pause are spread out at the bucket's rate after it, rather than all let through at once.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._updated = max(self._updated, now + seconds)
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+
+class RateLimiter:
+    """ A global token bucket plus one token bucket per slack channel. """
+
+    def __init__(self, channel_rate=SLACK_CHANNEL_RATE, channel_burst=SLACK_CHANNEL_BURST,
+                 global_rate=SLACK_GLOBAL_RATE, global_burst=SLACK_GLOBAL_BURST):
+        self._channel_rate = channel_rate
+        self._channel_burst = channel_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._channels = {}
+        self._lock = threading.Lock()
+        self.wait_time = Histogram('notifier_slack_ratelimit_wait_seconds',
+                                   'Seconds messages were held back by the slack rate limiter')
+
+    def acquire(self, channel=None):
+        """ Block until a message may be sent to the channel. Returns the time waited. """
+        wait = self.reserve(channel)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self, channel=None):
+        """ Reserve a message to the channel and return how long to wait before sending it, without waiting. """
+        wait = self._global.reserve()
+        if channel:
+            wait = max(wait, self._channel_bucket(channel).reserve())
+        self.wait_time.observe(wait)
+        return wait
+
+    def pause(self, seconds, channel=None):
+        """ Hold back messages to the channel, or to every channel when none is given. """
+        if channel:
+            self._channel_bucket(channel).pause(seconds)
+        else:
+            self._global.pause(seconds)
+
+    def _channel_bucket(self, channel):
+        with self._lock:
+            bucket = self._channels.get(channel)
+            if bucket is None:
+                bucket = self._channels[channel] = TokenBucket(self._channel_rate, self._channel_burst)
+            return bucket
+
+
+RATE_LIMITER = RateLimiter()
+REGISTRY.register(RATE_LIMITER.wait_time)
@@ -1,51 +1,94 @@
 """ Code related to slack webhooks and API calls. """
 
+import concurrent.futures
 import datetime
+import hashlib
+import hmac
 import logging
-import math
 import os
+import random
+import time
 
-from slackclient import SlackClient
-
-from app.github import GithubWebhookPayloadParser
-from app.github import get_recipient_github_username_by_action
+from app.clients import slack_api_call
+from app.directory import DIRECTORY
 from app.github import lookup_github_full_name
+from app.identities import IDENTITIES
+from app.metrics import FALLBACKS
+from app.metrics import STAGE_SECONDS
 from app.octocats import get_random_octocat_image
+from app.ratelimit import RATE_LIMITER
+from app.unmatched import UNMATCHED
+
+SLACK_SEND_RETRIES = int(os.environ.get('SLACK_SEND_RETRIES', 3))
+SLACK_RETRY_BACKOFF = float(os.environ.get('SLACK_RETRY_BACKOFF', 0.5))
+RETRYABLE_ERRORS = ('ratelimited', 'request_timeout', 'service_unavailable', 'internal_error', 'fatal_error')
+RESOLUTION_DEADLINE = float(os.environ.get('RESOLUTION_DEADLINE', 5))
+RESOLUTION_WORKERS = int(os.environ.get('RESOLUTION_WORKERS', 8))
+SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
+SLACK_SIGNATURE_MAX_AGE = 300
+SLACK_MEMBER_EVENTS = ('team_join', 'user_change')
+
+_RESOLVER = concurrent.futures.ThreadPoolExecutor(RESOLUTION_WORKERS)
+
+
+def notify_recipient(event):
+    """
+    Compile the necessary information and send a slack notification for a PullRequestEvent.
+
+    Returns True once slack accepted it.
+    """
+    payload = create_slack_message_payload(event)
+    return send_slack_message(payload)
+
 
+def create_slack_message_payload(event):
+    """ Resolve the slack users of a PullRequestEvent and render its message. """
+    pr_metadata = _get_pull_request_metadata(event)
+    return render_message(event, pr_metadata)
 
-def notify_recipient(data):
-    """ Compile the necessary information and send a slack notification. """
-    payload = _create_slack_message_payload(data)
-    _send_slack_message(payload)
 
+def create_slack_message_payloads(events):
+    """
+    Resolve the slack users of several events for one pull request, e.g. one per team member, and render them.
 
-def _create_slack_message_payload(data):
-    pr_metadata = _get_pull_request_metadata(data)
+    The author is resolved once and the recipients all at once, under a single deadline.
+    """
+    if len(events) == 1:
+        return [create_slack_message_payload(events[0])]
+    return [render_message(event, pr_metadata)
+            for event, pr_metadata in zip(events, _get_pull_requests_metadata(events))]
 
-    msg_text = _get_message(pr_metadata, data)
-    message = _build_payload(msg_text, pr_metadata)
+
+@STAGE_SECONDS.time('render')
+def render_message(event, pr_metadata):
+    """ Render the slack message payload for an event and its resolved channel and author. """
+    msg_text = _get_message(pr_metadata, event)
+    message = _build_payload(msg_text, pr_metadata, event)
 
     return message
 
 
-def _get_message(pr_metadata, data):
+def _get_message(pr_metadata, event):
 
-    if data.get('action') == 'review_requested':
+    if event.action == 'review_requested' and event.team:
+        action_msg = 'asked by {author} to review a pull request for {team}'.format(
+            author=pr_metadata.get('author'), team=event.team)
+    elif event.action == 'review_requested':
         action_msg = 'asked by {author} to review a pull request'.format(author=pr_metadata.get('author'))
-    elif data.get('action') == 'assigned':
+    elif event.action == 'assigned':
         action_msg = 'assigned a pull request by {author}'.format(author=pr_metadata.get('author'))
     else:
         action_msg = 'pinged'
 
     msg_text = "You've been {action}. Lucky you!".format(action=action_msg)
     if pr_metadata.get('channel') == os.environ.get('DEFAULT_NOTIFICATION_CHANNEL'):
-        github_username = _get_unmatched_username(data)
+        github_username = _get_unmatched_username(event)
         msg_text = '{}! {}'.format(github_username, msg_text)
 
     return msg_text
 
 
-def _build_payload(msg_text, pr_metadata):
+def _build_payload(msg_text, pr_metadata, event):
     message = {
         "text": msg_text,
         "as_user": True,
@@ -53,17 +96,17 @@ def _build_payload(msg_text, pr_metadata):
         "channel": pr_metadata.get('channel'),
         "attachments": [
             {
-                "fallback": "<{}|{}>".format(pr_metadata.get('url'), pr_metadata.get('title')),
+                "fallback": "<{}|{}>".format(event.url, event.title),
                 "color": "#36a64f",
-                "author_name": "{} pull request #{}".format(pr_metadata.get('repo'), pr_metadata.get('number')),
-                "author_link": pr_metadata.get('url'),
+                "author_name": "{} pull request #{}".format(event.repo, event.number),
+                "author_link": event.url,
                 "author_icon": "https://github.com/favicon.ico",
-                "title": pr_metadata.get('title'),
-                "title_link": pr_metadata.get('url'),
-                "text": pr_metadata.get('description'),
+                "title": event.title,
+                "title_link": event.url,
+                "text": event.description,
                 "thumb_url": get_random_octocat_image(),
                 "footer": "Github PR Notifier",
-                "footer_icon": pr_metadata.get('author_image'),
+                "footer_icon": event.author_image,
                 "ts": int(datetime.datetime.now().timestamp())
             }
         ]
@@ -71,90 +114,198 @@ def _build_payload(msg_text, pr_metadata):
     return message
 
 
-def _get_pull_request_metadata(data):
-    pull_request_data = {}
-    payload_parser = GithubWebhookPayloadParser(data)
+def _get_pull_request_metadata(event):
+    """
+    Resolve the recipient's channel and the author's slack username in parallel.
+
+    Each lookup may need users.list and a github API call, so they run concurrently and are joined
+    by a per-event deadline. A lookup that runs late or fails falls back to the default channel or 'someone'.
+    """
+    return _get_pull_requests_metadata([event])[0]
+
+
+def _get_pull_requests_metadata(events):
+    deadline = time.monotonic() + RESOLUTION_DEADLINE
+    channels = [_RESOLVER.submit(_get_notification_channel, event) for event in events]
+    author = _RESOLVER.submit(_get_pull_request_author, events[0])
+
+    author = _get_resolved(author, deadline, 'someone', 'author')
+    return [{
+        'channel': _get_resolved(channel, deadline, os.environ.get('DEFAULT_NOTIFICATION_CHANNEL'), 'channel'),
+        'author': author,
+    } for channel in channels]
+
 
-    pull_request_data['url'] = payload_parser.get_pull_request_url()
-    pull_request_data['title'] = payload_parser.get_pull_request_title() or 'Unknown Title'
-    pull_request_data['repo'] = payload_parser.get_pull_request_repo() or 'Unknown'
-    pull_request_data['number'] = payload_parser.get_pull_request_number() or math.pi
-    pull_request_data['author_image'] = payload_parser.get_pull_request_author_image()
-    pull_request_data['description'] = payload_parser.get_pull_request_description()
-    pull_request_data['channel'] = _get_notification_channel(data)
+def _get_resolved(future, deadline, default, field):
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except concurrent.futures.TimeoutError:
+        return fall_back(field, default)
+    except Exception as error:  # pylint: disable=broad-except
+        return fall_back(field, default, error)
 
-    pull_request_author = _get_slack_username_by_github_username(payload_parser.get_pull_request_author())
 
-    if pull_request_author:
-        pull_request_author = '@{}'.format(pull_request_author)
+def fall_back(field, default, error=None):
+    """ Log and count a resolution that missed the deadline, or failed with error, and return its default. """
+    logger = logging.getLogger(__name__)
+    if error is None:
+        logger.warning('Slack user resolution missed the %s second deadline, using %s', RESOLUTION_DEADLINE, default)
+        FALLBACKS.inc(field, 'deadline')
     else:
-        pull_request_author = 'someone'
+        logger.warning('Slack user resolution failed, using %s', default, exc_info=error)
+        FALLBACKS.inc(field, 'error')
+    return default
+
 
-    pull_request_data['author'] = pull_request_author
+def _get_pull_request_author(event):
+    return format_author(_get_slack_username_by_github_username(event.author))
 
-    return pull_request_data
 
+def _get_notification_channel(event):
+    return format_channel(_get_slack_username_by_github_username(event.recipient))
 
-def _get_notification_channel(data):
-    github_username = get_recipient_github_username_by_action(data)
-    slack_username = _get_slack_username_by_github_username(github_username)
 
+def format_author(slack_username):
+    """ Return how a message names the pull request author, given the author's slack username or None. """
     if slack_username:
-        channel = '@{}'.format(slack_username)
-    else:
-        channel = os.environ.get('DEFAULT_NOTIFICATION_CHANNEL')
+        return '@{}'.format(slack_username)
+    FALLBACKS.inc('author', 'unmatched')
+    return 'someone'
 
-    return channel
+
+def format_channel(slack_username):
+    """ Return the channel to notify the recipient in, given the recipient's slack username or None. """
+    if slack_username:
+        return '@{}'.format(slack_username)
+    FALLBACKS.inc('channel', 'unmatched')
+    return os.environ.get('DEFAULT_NOTIFICATION_CHANNEL')
 
 
 def _get_slack_username_by_github_username(github_username):  # pylint: disable=invalid-name
-    slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
-    response = slack_client.api_call("users.list")
-    users = response.get('members', [])
-
-    if github_username:
-        slack_username = _match_slack_github_username(users, github_username)
-        if not slack_username:
-            full_name = lookup_github_full_name(github_username)
-            slack_username = _match_slack_un_by_fullname(users, full_name)
+    resolved, slack_username = resolve_without_lookups(github_username)
+    if resolved:
         return slack_username
-    return None
+
+    index = DIRECTORY.get_index()
+    slack_username = index.match_username(github_username)
+    full_name = ''
+    if not slack_username:
+        full_name = lookup_github_full_name(github_username)
+        slack_username = index.match_full_name(full_name)
+    return remember_unmatched(github_username, index, slack_username, full_name)
+
+
+def resolve_without_lookups(github_username):
+    """
+    Resolve a github login that needs neither users.list nor a github lookup.
+
+    Returns whether the login was resolved, and its slack username, which is None for a missing login or one that
+    recently matched nobody.
+    """
+    if not github_username:
+        return True, None
+    slack_username = IDENTITIES.lookup(github_username) if IDENTITIES else None
+    if slack_username:
+        return True, slack_username
+    # Logins that matched nobody a moment ago go straight to the fallbacks
+    if UNMATCHED.contains(github_username):
+        return True, None
+    return False, None
 
 
-def _match_slack_github_username(users, github_username):
-    for user in users:
-        if isinstance(user, dict) and (
-                user.get('name').lower() == github_username.lower()
-                or user.get('profile', {}).get('display_name', '').lower() == github_username.lower()
-        ):
-            return user.get('name')
-    return None
+def remember_unmatched(github_username, index, slack_username, full_name):
+    """ Return the slack username a login was matched to in the index, remembering the login if it matched nobody. """
+    # An empty directory means users.list failed, and no full name that github could not be asked,
+    # not that the login has no slack user
+    if not slack_username and index.members and full_name is not None:
+        UNMATCHED.add(github_username)
+    return slack_username
 
 
-def _match_slack_un_by_fullname(users, full_name):
-    if full_name:
-        for user in users:
-            if isinstance(user, dict) and user.get('real_name', '').strip().lower() == full_name.strip().lower():
-                return user.get('name')
-    return None
+def _get_unmatched_username(event):
+    if event.reviewer is not None:
+        return '@{}'.format(event.reviewer)
 
+    return 'Hey you, tech people'
 
-def _get_unmatched_username(data):
-    payload_parser = GithubWebhookPayloadParser(data)
-    github_username = payload_parser.get_request_reviewer_username()
 
-    if github_username is not None:
-        return '@{}'.format(github_username)
+def send_slack_message(payload):
+    """ Post a message, retrying when slack is rate limiting or unavailable. Returns True once slack accepted it. """
+    for attempt in range(SLACK_SEND_RETRIES + 1):
+        RATE_LIMITER.acquire(payload.get('channel'))
+        with STAGE_SECONDS.time('chat_post_message'):
+            response = slack_api_call("chat.postMessage", **payload)
+        if not should_retry_send(response, attempt, payload.get('channel')):
+            break
+    return report_send(response, payload)
 
-    return 'Hey you, tech people'
 
+def should_retry_send(response, attempt, channel=None):
+    """
+    Return True if a chat.postMessage call should be retried after its response, pausing the rate limiter until then.
 
-def _send_slack_message(payload):
-    slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
-    response = slack_client.api_call("chat.postMessage", **payload)
+    A rate limited message only holds back its channel, since slack limits posting per channel. Other errors mean
+    slack itself is struggling, so they hold back every channel.
+    """
+    if response.get('ok') or response.get('error') not in RETRYABLE_ERRORS or attempt == SLACK_SEND_RETRIES:
+        return False
 
+    delay = get_retry_delay(response, attempt)
+    logging.getLogger(__name__).info('Slack responded with %s, retrying in %.2f seconds', response.get('error'), delay)
+    RATE_LIMITER.pause(delay, channel if response.get('error') == 'ratelimited' else None)
+    return True
+
+
+def report_send(response, payload):
+    """ Log the final response to a chat.postMessage call and return True if slack accepted the message. """
     logger = logging.getLogger(__name__)
-    if not response.get('ok'):
-        logger.warning('Unable to send message. Response: %s\nPayload:\n%s', response, payload)
-    else:
+    if response.get('ok'):
         logger.info('Success!')
+        return True
+    logger.warning('Unable to send message. Response: %s\nPayload:\n%s', response, payload)
+    return False
+
+
+def get_retry_delay(response, attempt):
+    """ Honor slack's Retry-After header, backing off exponentially with jitter on top of it. """
+    try:
+        retry_after = float(response.get('headers', {}).get('Retry-After', 0))
+    except (TypeError, ValueError):
+        retry_after = 0
+    return retry_after + random.uniform(0, SLACK_RETRY_BACKOFF * 2 ** attempt)
+
+
+def verify_slack_signature(signing_secret, timestamp, body, signature, now=None):
+    """
+    Check the X-Slack-Signature of a request slack sent, e.g. an Events API callback.
+
+    Requests older than five minutes are refused so a captured request cannot be replayed.
+    """
+    if not signing_secret or not timestamp or not signature:
+        return False
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return False
+    if age > SLACK_SIGNATURE_MAX_AGE:
+        return False
+
+    basestring = b'v0:' + timestamp.encode('utf-8') + b':' + body
+    expected = 'v0=' + hmac.new(signing_secret.encode('utf-8'), basestring, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def handle_slack_event(payload):
+    """
+    Handle a verified Events API request and return the text to respond with.
+
+    Members who joined or changed their profile are patched into the cached directory,
+    so it stays current without listing the whole workspace again.
+    """
+    if payload.get('type') == 'url_verification':
+        return payload.get('challenge', '')
+
+    event = payload.get('event') or {}
+    if payload.get('type') == 'event_callback' and event.get('type') in SLACK_MEMBER_EVENTS:
+        DIRECTORY.apply_member(event.get('user'))
+    return ''
@@ -0,0 +1,203 @@
+""" A durable on-disk spool of pending notifications. """
+
+from collections import OrderedDict
+from collections import namedtuple
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+SPOOL_PATH = os.environ.get('SPOOL_PATH')
+SPOOL_FSYNC_INTERVAL = float(os.environ.get('SPOOL_FSYNC_INTERVAL', 0.01))
+SPOOL_COMPACT_THRESHOLD = int(os.environ.get('SPOOL_COMPACT_THRESHOLD', 1000))
+SPOOL_MAX_ATTEMPTS = int(os.environ.get('SPOOL_MAX_ATTEMPTS', 5))
+SPOOL_MAX_AGE = float(os.environ.get('SPOOL_MAX_AGE', 6 * 60 * 60))
+
+_PendingJob = namedtuple('_PendingJob', ['job', 'recorded_at', 'attempts'])
+
+
+class Spool:  # pylint: disable=too-many-instance-attributes
+    """
+    A write-ahead log of notification jobs.
+
+    Jobs are appended to a json lines file before they are processed and a done record
+    is appended once slack accepted them, so anything still pending after a restart can be replayed.
+    A failed delivery appends a failed record. A job that failed `max_attempts` times, or was recorded more than
+    `max_age` seconds ago, is dropped rather than replayed, so a notification slack will never accept, or one
+    that is stale, does not stay in the file forever.
+
+    Writers are committed in groups: the first writer waiting for durability sleeps for the fsync interval
+    and then issues one fsync that covers every record written in the meantime.
+    Once enough jobs are done the file is rewritten with only the pending jobs so it stays bounded.
+    """
+
+    def __init__(self, path, fsync_interval=SPOOL_FSYNC_INTERVAL, compact_threshold=SPOOL_COMPACT_THRESHOLD,
+                 max_attempts=SPOOL_MAX_ATTEMPTS, max_age=SPOOL_MAX_AGE):
+        self._path = path
+        self._fsync_interval = fsync_interval
+        self._compact_threshold = compact_threshold
+        self._max_attempts = max_attempts
+        self._max_age = max_age
+        self._synced = threading.Condition()
+        self._fd = None
+        self._pending = OrderedDict()
+        self._done = 0
+        self._written = 0
+        self._durable = 0
+        self._syncing = False
+
+    def record(self, job):
+        """ Durably record a job before it is processed and return its id. """
+        job_id = uuid.uuid4().hex
+        recorded_at = time.time()
+        with self._synced:
+            self._open()
+            self._pending[job_id] = _PendingJob(job, recorded_at, 0)
+            sequence = self._write({'id': job_id, 'job': job, 'recorded_at': recorded_at})
+        self._wait_until_durable(sequence)
+        return job_id
+
+    def mark_done(self, job_id):
+        """ Record that a job was delivered so it is not replayed. """
+        with self._synced:
+            self._open()
+            if job_id in self._pending:
+                self._drop(job_id)
+
+    def mark_failed(self, job_id):
+        """
+        Record that delivering a job failed. Returns True if it was dropped, after too many attempts or
+        because it is too old.
+        """
+        with self._synced:
+            self._open()
+            pending = self._pending.get(job_id)
+            if pending is None:
+                return False
+            pending = self._pending[job_id] = pending._replace(attempts=pending.attempts + 1)
+            if pending.attempts < self._max_attempts and not self._is_expired(pending):
+                self._write({'failed': job_id})
+                return False
+            logging.getLogger(__name__).warning('Dropping notification after %s failed attempts: %s',
+                                                pending.attempts, pending.job)
+            self._drop(job_id)
+            return True
+
+    def pending(self):
+        """ Return the (id, job) pairs that have not been marked done, dropping any that are too old. """
+        with self._synced:
+            self._open()
+            for job_id, pending in list(self._pending.items()):
+                if self._is_expired(pending):
+                    logging.getLogger(__name__).warning('Dropping notification recorded %.0f seconds ago: %s',
+                                                        time.time() - pending.recorded_at, pending.job)
+                    self._drop(job_id)
+            return [(job_id, pending.job) for job_id, pending in self._pending.items()]
+
+    def close(self):
+        """ Flush and close the spool file. """
+        with self._synced:
+            while self._syncing:
+                self._synced.wait()
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+    def _open(self):
+        if self._fd is not None:
+            return
+        if os.path.exists(self._path):
+            self._load()
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _load(self):
+        valid_length = 0
+        loaded_at = time.time()
+        with open(self._path, encoding='utf-8') as spool_file:
+            for line in spool_file:
+                try:
+                    record = json.loads(line) if line.endswith('\n') else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    # A torn write from a crash can only be the last line
+                    logging.getLogger(__name__).warning('Skipping corrupt spool record: %r', line)
+                    break
+                valid_length += len(line.encode())
+                if 'done' in record:
+                    self._pending.pop(record['done'], None)
+                    self._done += 1
+                elif 'failed' in record:
+                    pending = self._pending.get(record['failed'])
+                    if pending is not None:
+                        self._pending[record['failed']] = pending._replace(attempts=pending.attempts + 1)
+                else:
+                    # Jobs recorded before their time was kept are aged from now
+                    self._pending[record['id']] = _PendingJob(record['job'], record.get('recorded_at', loaded_at),
+                                                              record.get('attempts', 0))
+
+        if valid_length != os.path.getsize(self._path):
+            os.truncate(self._path, valid_length)
+
+    def _is_expired(self, pending):
+        return time.time() - pending.recorded_at > self._max_age
+
+    def _drop(self, job_id):
+        del self._pending[job_id]
+        self._write({'done': job_id})
+        self._done += 1
+        if self._done >= self._compact_threshold and not self._syncing:
+            self._compact()
+
+    def _write(self, record):
+        # Unbuffered, so a record is in the OS's hands as soon as it is written
+        os.write(self._fd, (json.dumps(record) + '\n').encode())
+        self._written += 1
+        return self._written
+
+    def _wait_until_durable(self, sequence):
+        while True:
+            with self._synced:
+                while self._syncing and self._durable < sequence:
+                    self._synced.wait()
+                if self._durable >= sequence:
+                    return
+                # This writer syncs for everyone who writes until it wakes up
+                self._syncing = True
+
+            target = 0
+            try:
+                time.sleep(self._fsync_interval)
+                with self._synced:
+                    target = self._written
+                # The file is neither closed nor compacted while syncing
+                os.fsync(self._fd)
+            finally:
+                with self._synced:
+                    self._durable = max(self._durable, target)
+                    self._syncing = False
+                    self._synced.notify_all()
+
+    def _compact(self):
+        temp_path = '{}.compact'.format(self._path)
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            for job_id, pending in self._pending.items():
+                temp_file.write(json.dumps({'id': job_id, 'job': pending.job, 'recorded_at': pending.recorded_at,
+                                            'attempts': pending.attempts}) + '\n')
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        os.close(self._fd)
+        os.replace(temp_path, self._path)
+        # The rename is only durable once the directory entry is
+        directory = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        self._durable = self._written
+        self._done = 0
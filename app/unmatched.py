@@ -0,0 +1,49 @@
+""" Remember github logins that matched no slack user, so their notifications skip straight to the fallbacks. """
+
+import os
+
+from app.dedupe import DedupeStore
+from app.directory import DIRECTORY
+
+UNMATCHED_CACHE_TTL = float(os.environ.get('UNMATCHED_CACHE_TTL', 900))
+UNMATCHED_CACHE_MAX_ENTRIES = int(os.environ.get('UNMATCHED_CACHE_MAX_ENTRIES', 10000))
+
+
+class UnmatchedCache(DedupeStore):
+    """
+    A bounded set of github logins that recently failed to match a slack user.
+
+    Logins are matched case insensitively, and forgotten like the keys of a DedupeStore. Every login is also
+    forgotten as soon as the slack directory changes, since a new or renamed member may match it.
+    The cache is per process, like the directory, so with several workers each one holds its own logins.
+    """
+
+    def __init__(self, ttl=UNMATCHED_CACHE_TTL, max_entries=UNMATCHED_CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries=max_entries)
+        self._counts['invalidations'] = 0
+
+    def contains(self, key):
+        """ Return True if the login failed to match within the ttl. """
+        return super().contains(key.lower())
+
+    def add(self, key):
+        """ Remember that a login matched no slack user. """
+        super().add(key.lower())
+
+    def discard(self, key):
+        """ Forget a login, e.g. once its slack user was set up. Returns False if it was not held. """
+        return super().discard(key.lower())
+
+    def invalidate(self):
+        """ Forget every login, keeping the counters. """
+        with self._lock:
+            self._entries.clear()
+            self._counts['invalidations'] += 1
+
+    def entries(self):
+        """ Return the logins held and the seconds until each is forgotten, soonest first. """
+        return [{'login': login, 'expires_in': expires_in} for login, expires_in in super().entries()]
+
+
+UNMATCHED = UnmatchedCache()
+DIRECTORY.add_listener(UNMATCHED.invalidate)
@@ -1,9 +1,39 @@
 #! /usr/bin/env python
 """ Our github hook receiving server. """
 
+import time
+
+from flask import Response
+from flask import abort
+from flask import g
+from flask import has_request_context
+from flask import jsonify
+from flask import request
+
+from app import APP
 from app import HOOKS
+from app.admin import check_admin
+from app.clients import connection_stats
+from app.dedupe import CONTENT
+from app.dedupe import DELIVERIES
+from app.dedupe import claim_delivery
+from app.dedupe import release_delivery
+from app.delivery import DELIVERY_QUEUE
+from app.delivery import dispatch
+from app.directory import DIRECTORY
+from app.github import NAME_CACHE
+from app.github import TEAM_CACHE
+from app.github import PullRequestEvent
 from app.github import is_valid_pull_request
-from app.slack import notify_recipient
+from app.identities import IDENTITIES
+from app.metrics import HOOK_RESULTS
+from app.metrics import REGISTRY
+from app.metrics import STAGE_SECONDS
+from app.slack import SLACK_SIGNING_SECRET
+from app.slack import handle_slack_event
+from app.slack import verify_slack_signature
+from app.unmatched import UNMATCHED
+from app.unmatched import UNMATCHED_CACHE_TTL
 
 
 @HOOKS.hook('ping')
@@ -12,19 +42,133 @@ def ping(_data, _guid):
 
 
 @HOOKS.hook('pull_request')
-def pull_request(data, _guid):
+def pull_request(data, guid):
     """
     Handle a pull request webhook and notify the reviewer on slack.
 
     This will validate the request making sure it is an action that is written to be handled,
     then will kick off apropriate actions for the hook such as sending slack notifications
     to the requested reviewer.
+
+    A review requested from a team notifies each of its members, listed when the notification is delivered.
+    In async delivery mode the notification is queued and the hook returns a 202 right away.
+    If the queue is full the notification is sent before returning.
+    Redeliveries, and deliveries asking for a notification that was just sent, are acknowledged without
+    doing any work.
     """
 
     if is_valid_pull_request(data):
-        notify_recipient(data)
+        event = PullRequestEvent.from_payload(data)
+        _observe_validation()
+        keys = claim_delivery(guid, event)
+        if keys is None:
+            HOOK_RESULTS.inc(event.action, 'duplicate')
+            return 'Duplicate delivery ignored'
+
+        try:
+            queued = dispatch(event)
+        except Exception:
+            release_delivery(keys)
+            HOOK_RESULTS.inc(event.action, 'error')
+            raise
+        if queued:
+            HOOK_RESULTS.inc(event.action, 'queued')
+            return 'Recipient Queued', 202
+        HOOK_RESULTS.inc(event.action, 'notified')
         result = 'Recipient Notified'
     else:
+        HOOK_RESULTS.inc(data.get('action'), 'ignored')
         result = 'Action ({}) ignored'.format(data.get('action'))
 
     return result
+
+
+@APP.route('/slack/events', methods=['POST'])
+def slack_events():
+    """
+    Receive slack Events API callbacks that keep the cached slack directory current.
+
+    Requests must be signed with SLACK_SIGNING_SECRET, and are refused while it is unset.
+    """
+    if not verify_slack_signature(SLACK_SIGNING_SECRET, request.headers.get('X-Slack-Request-Timestamp'),
+                                  request.get_data(), request.headers.get('X-Slack-Signature')):
+        abort(403, 'Invalid slack signature')
+
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        abort(400, 'Invalid JSON')
+    return handle_slack_event(payload)
+
+
+@APP.route('/admin/unmatched', methods=['GET', 'DELETE'])
+@APP.route('/admin/unmatched/<login>', methods=['DELETE'])
+def unmatched_logins(login=None):
+    """
+    List the github logins cached as matching no slack user, or forget one or all of them.
+
+    Requests need the ADMIN_TOKEN as a bearer token. The endpoint is disabled while it is unset.
+    The cache is per process, so this only lists or forgets the logins of the worker that handles the request.
+    """
+    status = check_admin(request.headers.get('Authorization'))
+    if status:
+        abort(status)
+
+    if request.method == 'DELETE':
+        if login:
+            UNMATCHED.discard(login)
+        else:
+            UNMATCHED.invalidate()
+        return '', 204
+    return jsonify(ttl=UNMATCHED_CACHE_TTL, stats=UNMATCHED.stats(), logins=UNMATCHED.entries())
+
+
+@APP.route('/metrics')
+def metrics():
+    """ Expose this process's metrics in the Prometheus text format. """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@APP.before_request
+def _start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+def _observe_validation():
+    """ Record the time from receiving the hook until its IP, signature and payload were validated. """
+    if has_request_context() and 'request_started_at' in g:
+        STAGE_SECONDS.observe(time.perf_counter() - g.request_started_at, 'validation')
+
+
+@REGISTRY.register_collector
+def _collect_cache_stats():
+    caches = {
+        'slack_directory': DIRECTORY.stats(),
+        'github_users': NAME_CACHE.stats(),
+        'github_teams': TEAM_CACHE.stats(),
+        'dedupe_deliveries': DELIVERIES.stats(),
+        'dedupe_content': CONTENT.stats(),
+        'unmatched_logins': UNMATCHED.stats(),
+    }
+    yield ('notifier_cache_hits_total', 'counter', 'Lookups served from a cache',
+           [({'cache': name}, stats['hits']) for name, stats in sorted(caches.items())])
+    yield ('notifier_cache_misses_total', 'counter', 'Lookups a cache could not serve',
+           [({'cache': name}, stats['misses']) for name, stats in sorted(caches.items())])
+    yield ('notifier_cache_hit_ratio', 'gauge', 'Share of lookups served from a cache',
+           [({'cache': name}, stats['hits'] / max(stats['hits'] + stats['misses'], 1))
+            for name, stats in sorted(caches.items())])
+    yield ('notifier_delivery_queue_depth', 'gauge', 'Notifications waiting for a delivery worker',
+           [({}, DELIVERY_QUEUE.depth())])
+    yield ('notifier_slack_directory_members', 'gauge', 'Members in the cached slack directory',
+           [({}, caches['slack_directory']['members'])])
+    yield ('notifier_slack_directory_bytes', 'gauge', 'Memory taken by the cached slack directory and its index',
+           [({}, caches['slack_directory']['bytes'])])
+    connections = connection_stats()
+    yield ('notifier_http_requests_total', 'counter', 'Requests made to each upstream host',
+           [({'host': host}, stats['requests']) for host, stats in sorted(connections.items())])
+    yield ('notifier_http_connections_total', 'counter', 'Connections opened to each upstream host',
+           [({'host': host}, stats['connections']) for host, stats in sorted(connections.items())])
+    yield ('notifier_http_connections_reused_total', 'counter', 'Requests to each upstream host that reused a '
+           'kept-alive connection', [({'host': host}, stats['reused']) for host, stats in sorted(connections.items())])
+    if IDENTITIES:
+        yield ('notifier_identity_map_entries', 'gauge', 'Github logins in the static identity map',
+               [({}, IDENTITIES.stats()['entries'])])
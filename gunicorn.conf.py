@@ -0,0 +1,56 @@
+""" Gunicorn settings for serving the github hook server in production. """
+# pylint: disable=invalid-name
+import logging
+import multiprocessing
+import os
+import threading
+
+bind = os.environ.get('BIND', '0.0.0.0:{}'.format(os.environ.get('PORT', 5000)))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# The spool is one file per process. Several workers would each replay the same pending notifications,
+# and compacting it in one worker would replace the file the others are appending to.
+if os.environ.get('SPOOL_PATH'):
+    workers = 1
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+worker_class = 'gthread'
+accesslog = '-'
+
+# Each worker imports the app itself, so no threads, sockets or sqlite connections are inherited across the fork
+preload_app = False
+
+
+def on_starting(server):
+    """ Run a single worker when the spool is enabled, even if more were asked for on the command line. """
+    if os.environ.get('SPOOL_PATH') and server.num_workers > 1:
+        server.log.warning('SPOOL_PATH is set, so running 1 worker instead of %s. Scale with WEB_THREADS instead.',
+                           server.num_workers)
+        server.num_workers = 1
+
+
+def post_worker_init(_worker):
+    """ Warm the per worker caches and replay any spooled notifications without holding up requests. """
+    from app.delivery import replay_spool  # pylint: disable=import-outside-toplevel
+
+    threading.Thread(target=_warm_caches, name='warm-caches', daemon=True).start()
+    threading.Thread(target=replay_spool, name='replay-spool', daemon=True).start()
+
+
+def worker_exit(_server, _worker):
+    """ Finish queued notifications before the worker exits. """
+    from app.delivery import shutdown  # pylint: disable=import-outside-toplevel
+
+    shutdown()
+
+
+def _warm_caches():
+    from app.directory import DIRECTORY  # pylint: disable=import-outside-toplevel
+    from app.octocats import get_random_octocat_image  # pylint: disable=import-outside-toplevel
+
+    try:
+        DIRECTORY.get_index()
+        get_random_octocat_image()
+    except Exception:  # pylint: disable=broad-except
+        logging.getLogger(__name__).warning('Unable to warm caches', exc_info=True)
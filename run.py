@@ -1,6 +1,9 @@
 #! /usr/bin/env python
 """ Our github hook receiving server. """
+import threading
 
 from app import APP
+from app.delivery import replay_spool
 
+threading.Thread(target=replay_spool, name='replay-spool', daemon=True).start()
 APP.run(host='0.0.0.0')
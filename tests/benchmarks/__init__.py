@@ -0,0 +1 @@
+""" Offline benchmarks for the notification hot path. """
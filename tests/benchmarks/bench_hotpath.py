@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+"""
+Benchmark the per event CPU path of a notification, offline.
+
+Run with `python -m tests.benchmarks.bench_hotpath [--quick] [--output results.json] [--compare baseline.json]`.
+Times payload parsing up to a 1MB pull request body, building and matching the slack directory index for
+workspaces of 100 to 50k synthetic members, parsing the octocat feed and rendering the slack message.
+No network calls are made: the feed is a local file and the octocat image lookup is stubbed.
+
+The report also includes the memory footprint of the directory index for each workspace size, next to that of
+the users.list members it was built from.
+
+Results are printed and, with --output, saved as json. With --compare, each result is compared against a
+saved run and the exit status is 1 if any benchmark got slower by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from unittest.mock import patch
+
+from app import octocats
+from app import slack
+from app.directory import SlackDirectoryIndex
+from app.directory import _deep_sizeof
+from app.github import PullRequestEvent
+from tests.benchmarks.bench_parser import build_payload
+from tests.benchmarks.fake_services import build_feed
+from tests.benchmarks.fake_services import build_members
+from tests.test_github import FULL_NAME
+from tests.test_github import GENERIC_USERNAME
+
+BODY_SIZES = (1000, 100000, 1000000)
+WORKSPACE_SIZES = (100, 1000, 10000, 50000)
+FEED_SIZES = (50, 500)
+QUICK_SIZES = {'body': (1000, 100000), 'workspace': (100, 1000), 'feed': (50,)}
+
+
+def bench_parse(body_size):
+    payload = build_payload(body_size)
+    return lambda: PullRequestEvent.from_payload(payload)
+
+
+def bench_index_build(members):
+    return lambda: SlackDirectoryIndex(members)
+
+
+def bench_match_username(members):
+    index = SlackDirectoryIndex(members)
+    return lambda: index.match_username(GENERIC_USERNAME.upper())
+
+
+def bench_match_full_name(members):
+    index = SlackDirectoryIndex(members)
+    return lambda: (index.match_username('not-a-member'), index.match_full_name(FULL_NAME.upper()))
+
+
+def bench_octocat_feed(entries):
+    """ Parse a feed of the given number of entries, written to the patched RSS_FILE. """
+    path = octocats.RSS_FILE
+    with open(path, 'w', encoding='utf-8') as feed:
+        feed.write(build_feed(entries))
+    # The default path is bound when the module is imported, so pass the patched one
+    parsed = octocats._get_octocats_from_rss(path)  # pylint: disable=protected-access
+    assert len(parsed) == entries, 'parsed {} of {} octocats from {}'.format(len(parsed), entries, path)
+    return lambda: octocats._get_octocats_from_rss(path)  # pylint: disable=protected-access
+
+
+def bench_render(body_size):
+    event = PullRequestEvent.from_payload(build_payload(body_size))
+    pr_metadata = {'channel': '@{}'.format(GENERIC_USERNAME), 'author': '@someone'}
+    return lambda: slack.render_message(event, pr_metadata)
+
+
+def collect(quick):
+    """ Yield the name and function of every benchmark. """
+    sizes = QUICK_SIZES if quick else {'body': BODY_SIZES, 'workspace': WORKSPACE_SIZES, 'feed': FEED_SIZES}
+
+    for body_size in sizes['body']:
+        yield 'parse_payload[body={}]'.format(body_size), bench_parse(body_size)
+        yield 'render_message[body={}]'.format(body_size), bench_render(body_size)
+
+    for count in sizes['workspace']:
+        members = build_members(count)
+        yield 'index_build[members={}]'.format(count), bench_index_build(members)
+        yield 'match_username[members={}]'.format(count), bench_match_username(members)
+        yield 'match_full_name[members={}]'.format(count), bench_match_full_name(members)
+
+    for entries in sizes['feed']:
+        yield 'parse_octocat_feed[entries={}]'.format(entries), bench_octocat_feed(entries)
+
+
+def measure_footprints(quick):
+    """ Return the bytes taken by the users.list members and by their index, for each workspace size. """
+    footprints = {}
+    for count in QUICK_SIZES['workspace'] if quick else WORKSPACE_SIZES:
+        members = build_members(count)
+        footprints['members={}'.format(count)] = {
+            'members_bytes': _deep_sizeof(members, set()),
+            'index_bytes': SlackDirectoryIndex(members).footprint(),
+        }
+    return footprints
+
+
+def measure(func, repeat, min_time=0.2):
+    """ Return the best time per call in seconds, calling the function enough times per run to take min_time. """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 10
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(quick=False, repeat=5):
+    """ Run every benchmark and return the results keyed by name. """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            patch('app.octocats.RSS_FILE', os.path.join(tmpdir, 'octocats.rss')), \
+            patch('app.slack.get_random_octocat_image', lambda: 'https://octodex.github.com/images/octocat.png'):
+        for name, func in collect(quick):
+            seconds = measure(func, repeat)
+            results[name] = {'usec': seconds * 1e6}
+            print('{:<40} {:>14.1f}'.format(name, seconds * 1e6), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print each result against the baseline and return the names that regressed beyond the tolerance. """
+    regressions = []
+    print('{:<40} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline usec', 'usec', 'ratio'))
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print('{:<40} {:>14} {:>14.1f} {:>8}'.format(name, '-', result['usec'], 'new'))
+            continue
+        ratio = result['usec'] / before['usec']
+        flag = ' slower' if ratio > 1 + tolerance else ''
+        print('{:<40} {:>14.1f} {:>14.1f} {:>7.2f}x{}'.format(name, before['usec'], result['usec'], ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    """ Run the benchmarks, then save them and compare them against a baseline as asked. """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='only run the smaller sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='save the results to this json file')
+    parser.add_argument('--compare', help='compare the results against this saved json file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed before failing, e.g. 0.2')
+    args = parser.parse_args()
+
+    results = run(args.quick, args.repeat)
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'results': results,
+              'footprints': measure_footprints(args.quick)}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.tolerance)
+        if regressions:
+            print('{} benchmarks regressed: {}'.format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
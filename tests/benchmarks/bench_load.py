@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+"""
+Load test the real /hooks endpoint against local stand-ins for slack, github and the octocat feed.
+
+Run with `python -m tests.benchmarks.bench_load [gunicorn|dev|aio] [--rate 50] [--requests 1000]`.
+The server is started with its upstream URLs pointed at `fake_services`, then sent signed pull_request
+deliveries at the target rate from a pool of client threads. It reports p50/p95/p99 latency, the error rate
+and how many calls each upstream endpoint got per delivery.
+
+Deliveries are generated from the sample payload unless --deliveries names a recorded file. That file has a
+json object per line, like requests.jsonl, with the delivery's `payload` and optionally its `event` name,
+`guid`, and `offset` in seconds from the first delivery, which --replay-timing uses instead of --rate.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import threading
+import time
+import uuid
+
+import requests
+
+from tests.benchmarks.bench_server import PORT
+from tests.benchmarks.bench_server import SERVERS
+from tests.benchmarks.bench_server import sign
+from tests.benchmarks.bench_server import start_server
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.fake_services import build_members
+from tests.test_github import SAMPLE_GITHUB_PAYLOAD
+
+
+def generate_deliveries(count, members):
+    """ Build review requests for different pull requests and reviewers. """
+    deliveries = []
+    for number in range(count):
+        payload = copy.deepcopy(SAMPLE_GITHUB_PAYLOAD)
+        payload['number'] = number + 1
+        payload['requested_reviewer']['login'] = members[number % len(members)]['name']
+        deliveries.append({'event': 'pull_request', 'payload': payload})
+    return deliveries
+
+
+def load_deliveries(path):
+    """ Read recorded deliveries, one json object per line. """
+    with open(path, encoding='utf-8') as recorded:
+        return [json.loads(line) for line in recorded if line.strip()]
+
+
+def send_delivery(session, delivery):
+    """ Send a signed delivery and return its status code, or None if it failed, and its latency. """
+    body = json.dumps(delivery['payload']).encode()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': delivery.get('event', 'pull_request'),
+        'X-GitHub-Delivery': delivery.get('guid') or str(uuid.uuid4()),
+        'X-Hub-Signature': sign(body),
+    }
+    start = time.perf_counter()
+    try:
+        status = session.post('http://127.0.0.1:{}/hooks'.format(PORT), data=body, headers=headers).status_code
+    except requests.RequestException:
+        status = None
+    return status, time.perf_counter() - start
+
+
+def percentile(values, percent):
+    """ Return the nearest rank percentile of sorted values. """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def run(args):
+    """ Start the fakes and the server, send the deliveries and return the report. """
+    members = build_members(args.members)
+    deliveries = load_deliveries(args.deliveries) if args.deliveries else generate_deliveries(args.requests, members)
+    services = FakeServices(members, slack_latency=args.slack_latency, ratelimit_rate=args.ratelimit_rate,
+                            page_size=args.page_size).start()
+    environ = dict(services.environ(), SLACK_BOT_TOKEN='xoxb-load-test', DEFAULT_NOTIFICATION_CHANNEL='#load-test',
+                   DELIVERY_MODE=args.delivery_mode)
+
+    process = start_server(args.server, environ)
+    try:
+        time.sleep(args.warmup)
+        services.reset()
+        results, elapsed = send_deliveries(args, deliveries)
+        time.sleep(args.settle)
+    finally:
+        process.terminate()
+        process.wait(30)
+        services.stop()
+    return build_report(args, results, elapsed, services.calls)
+
+
+def send_deliveries(args, deliveries):
+    """ Send the deliveries at the requested rate and return their (status, latency) pairs and the seconds taken. """
+    local = threading.local()
+    results = []
+
+    def send(delivery):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        results.append(send_delivery(local.session, delivery))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for number, delivery in enumerate(deliveries):
+            due = delivery.get('offset', 0) if args.replay_timing else number / args.rate
+            time.sleep(max(start + due - time.perf_counter(), 0))
+            executor.submit(send, delivery)
+    return results, time.perf_counter() - start
+
+
+def build_report(args, results, elapsed, calls):
+    """ Summarize the deliveries' statuses and latencies and the upstream calls they made. """
+    latencies = sorted(latency for _status, latency in results)
+    errors = sum(1 for status, _latency in results if status is None or status >= 400)
+    return {
+        'server': args.server,
+        'deliveries': len(results),
+        'rate': len(results) / elapsed,
+        'error_rate': errors / max(len(results), 1),
+        'statuses': {str(status): sum(1 for result in results if result[0] == status)
+                     for status in sorted({status for status, _latency in results}, key=str)},
+        'latency_ms': {'p{}'.format(percent): percentile(latencies, percent) * 1000 for percent in (50, 95, 99)},
+        'upstream_calls': dict(calls),
+        'upstream_calls_per_delivery': {name: count / max(len(results), 1) for name, count in calls.items()},
+    }
+
+
+def main():
+    """ Run the load test and print its report. """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('server', nargs='?', default='gunicorn', choices=sorted(SERVERS))
+    parser.add_argument('--requests', type=int, default=1000, help='deliveries to generate')
+    parser.add_argument('--deliveries', help='replay the deliveries recorded in this jsonl file')
+    parser.add_argument('--replay-timing', action='store_true', help='send recorded deliveries at their offsets')
+    parser.add_argument('--rate', type=float, default=50, help='deliveries per second')
+    parser.add_argument('--concurrency', type=int, default=64, help='client threads')
+    parser.add_argument('--members', type=int, default=1000, help='members in the fake slack workspace')
+    parser.add_argument('--page-size', type=int, default=200, help='largest users.list page')
+    parser.add_argument('--slack-latency', type=float, default=0.05, help='seconds added to every slack call')
+    parser.add_argument('--ratelimit-rate', type=float, default=0, help='share of messages answered with a 429')
+    parser.add_argument('--delivery-mode', default='sync', choices=('sync', 'async'))
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to let the server warm its caches')
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait for background deliveries')
+    parser.add_argument('--output', help='save the report to this json file')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+"""
+Benchmark the allocations made parsing a webhook payload.
+
+Run with `python -m tests.benchmarks.bench_parser`.
+Every event builds a parser three times, so this measures three parsers over the same payload,
+against a parser that deep copies the payload the way it used to.
+"""
+import copy
+import time
+import tracemalloc
+
+from app.github import GithubWebhookPayloadParser
+from tests.test_github import SAMPLE_GITHUB_PAYLOAD
+
+PARSERS_PER_EVENT = 3
+ITERATIONS = 200
+
+
+class DeepCopyPayloadParser(GithubWebhookPayloadParser):
+    """ The parser as it was before it became a read-only view. """
+
+    def __init__(self, data=None):
+        super().__init__(copy.deepcopy(data or {}))
+
+
+def build_payload(body_size):
+    """ Build a payload shaped like a real pull_request delivery with a body of the given size. """
+    payload = copy.deepcopy(SAMPLE_GITHUB_PAYLOAD)
+    payload['pull_request']['body'] = 'x' * body_size
+    for side in ('head', 'base'):
+        payload['pull_request'][side] = {
+            'label': 'example:{}'.format(side),
+            'ref': side,
+            'sha': '0' * 40,
+            'repo': {'{}_url'.format(number): 'https://api.github.com/repos/example/{}'.format(number)
+                     for number in range(80)},
+        }
+    payload['pull_request']['labels'] = [{'id': number, 'name': 'label {}'.format(number)} for number in range(20)]
+    return payload
+
+
+def run_event(parser_class, payload):
+    """ Parse a payload the way a single event does. """
+    for _ in range(PARSERS_PER_EVENT):
+        parser = parser_class(payload)
+        parser.get_pull_request_title()
+        parser.get_pull_request_author()
+        parser.get_request_reviewer_username()
+
+
+def measure(parser_class, payload):
+    """ Return the peak bytes allocated and the seconds spent per event. """
+    tracemalloc.start()
+    run_event(parser_class, payload)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        run_event(parser_class, payload)
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+    return peak, elapsed
+
+
+def main():
+    """ Print the allocations and time per event for both parsers. """
+    print('{:>10} {:>24} {:>14} {:>14}'.format('body', 'parser', 'peak bytes', 'usec/event'))
+    for body_size in (1000, 30000, 100000):
+        payload = build_payload(body_size)
+        for parser_class in (DeepCopyPayloadParser, GithubWebhookPayloadParser):
+            peak, elapsed = measure(parser_class, payload)
+            print('{:>10} {:>24} {:>14} {:>14.1f}'.format(body_size, parser_class.__name__, peak, elapsed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
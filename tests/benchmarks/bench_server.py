@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+"""
+Benchmark requests per second of the dev server against the production gunicorn and asyncio servers.
+
+Run with `python -m tests.benchmarks.bench_server [--requests 2000] [--concurrency 32] [dev|gunicorn|aio ...]`.
+Each server is started on a local port with the given webhook secret,
+then sent signed ping deliveries from a pool of client threads.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PORT = 5000
+SECRET = 'benchmark-secret'
+SERVERS = {
+    'dev': [sys.executable, 'run.py'],
+    'gunicorn': ['gunicorn', '--config', 'gunicorn.conf.py', 'app:APP'],
+    'aio': [sys.executable, '-m', 'app.aio'],
+}
+
+
+def sign(body, secret=SECRET):
+    """ Return the X-Hub-Signature github would send for a body. """
+    return 'sha1={}'.format(hmac.new(secret.encode(), body, hashlib.sha1).hexdigest())
+
+
+def start_server(name, environ=None):
+    """ Start a server, with any extra environment variables, and wait until it accepts connections. """
+    env = dict(os.environ, GITHUB_WEBHOOKS_KEY=SECRET, GIT_HOOK_VALIDATE_IP='false',
+               BIND='127.0.0.1:{}'.format(PORT), PORT=str(PORT), PYTHONPATH=ROOT)
+    env.update(environ or {})
+    process = subprocess.Popen(SERVERS[name], cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', PORT), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} server did not start'.format(name))
+
+
+def send_ping(session):
+    """ Send a signed ping delivery and return its latency. """
+    body = json.dumps({'zen': 'Keep it logically awesome.'}).encode()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': 'ping',
+        'X-GitHub-Delivery': str(uuid.uuid4()),
+        'X-Hub-Signature': sign(body),
+    }
+    start = time.perf_counter()
+    response = session.post('http://127.0.0.1:{}/hooks'.format(PORT), data=body, headers=headers)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run(name, total, concurrency):
+    """ Benchmark one server and return its requests per second and median latency. """
+    process = start_server(name)
+    try:
+        sessions = [requests.Session() for _ in range(concurrency)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = sorted(executor.map(lambda number: send_ping(sessions[number % concurrency]), range(total)))
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait(30)
+    return total / elapsed, latencies[len(latencies) // 2]
+
+
+def main():
+    """ Print requests per second for each server. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('servers', nargs='*', default=sorted(SERVERS), choices=sorted(SERVERS))
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>14}'.format('server', 'req/s', 'p50 ms'))
+    for name in args.servers:
+        rps, median = run(name, args.requests, args.concurrency)
+        print('{:>10} {:>10.1f} {:>14.2f}'.format(name, rps, median * 1000))
+
+
+if __name__ == '__main__':
+    main()
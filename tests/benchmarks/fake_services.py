@@ -0,0 +1,188 @@
+"""
+Local stand-ins for the slack, github and octocat feed APIs.
+
+A threaded HTTP server answers all three under different path prefixes, so the real server can be
+pointed at it with SLACK_API_URL, GITHUB_API_URL and OCTOCAT_FEED_URL (see `FakeServices.environ`).
+It counts every call it answers so a load test can report upstream calls per event.
+"""
+from collections import Counter
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from tests.test_github import FULL_NAME
+from tests.test_github import GENERIC_USERNAME
+
+
+class FakeServices:  # pylint: disable=too-many-instance-attributes
+    """
+    Fake slack, github and octocat feed APIs listening on a local port.
+
+    `slack_latency` seconds are added to every slack call, a `ratelimit_rate` share of chat.postMessage calls
+    get a 429 with a Retry-After of `retry_after` seconds, and users.list returns pages of `page_size`
+    members when the caller asks for a limit.
+    """
+
+    def __init__(self, members, *, port=0, slack_latency=0,  # pylint: disable=too-many-arguments
+                 ratelimit_rate=0, retry_after=1, page_size=200, team_size=5):
+        self.members = members
+        self.slack_latency = slack_latency
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.team = ['member.{}'.format(number) for number in range(team_size)]
+        self.feed = build_feed(50).encode('utf-8')
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.services = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """ Return the base url of the server. """
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def environ(self):
+        """ Return the environment variables pointing the app at these services. """
+        return {
+            'SLACK_API_URL': '{}/slack/api/'.format(self.url),
+            'GITHUB_API_URL': '{}/github'.format(self.url),
+            'OCTOCAT_FEED_URL': '{}/octocats.rss'.format(self.url),
+        }
+
+    def start(self):
+        """ Serve requests from a background thread. """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-services', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and close the socket. """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, name):
+        """ Count a call to an upstream endpoint. """
+        with self._lock:
+            self.calls[name] += 1
+
+    def reset(self):
+        """ Forget the counted calls. """
+        with self._lock:
+            self.calls.clear()
+
+
+def build_members(count):
+    """ Build slack members, with the sample github user matching the last one. """
+    members = [{
+        'id': 'U{:08d}'.format(number),
+        'name': 'member.{}'.format(number),
+        'real_name': 'Member Number {}'.format(number),
+        'profile': {'display_name': 'member{}'.format(number)},
+    } for number in range(count - 1)]
+    members.append({'id': 'U99999999', 'name': GENERIC_USERNAME, 'real_name': FULL_NAME,
+                    'profile': {'display_name': GENERIC_USERNAME}})
+    return members
+
+
+def build_feed(entries):
+    """ Build an octocat feed with the given number of entries. """
+    items = ''.join('<item><title>Octocat {0}</title><description>&lt;img src="https://octodex.github.com/'
+                    'images/octocat-{0}.png"&gt;</description></item>'.format(number) for number in range(entries))
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Octodex</title>{}'
+            '</channel></rss>'.format(items))
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    services = None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name,too-many-return-statements
+        """ Serve the octocat feed and the github API calls the app makes. """
+        services = self.server.services
+        path = urlsplit(self.path).path
+
+        if path == '/octocats.rss':
+            services.count('feed')
+            return self._respond(200, services.feed, content_type='application/rss+xml')
+        if path == '/github/meta':
+            services.count('github meta')
+            return self._respond_json(200, {'hooks': ['127.0.0.0/8']})
+
+        match = re.match(r'^/github/users/([^/]+)$', path)
+        if match:
+            services.count('github users')
+            etag = '"{}"'.format(match.group(1))
+            if self.headers.get('If-None-Match') == etag:
+                return self._respond(304, b'')
+            name = FULL_NAME if match.group(1).lower() == GENERIC_USERNAME else match.group(1)
+            return self._respond_json(200, {'login': match.group(1), 'name': name}, {'ETag': etag})
+
+        match = re.match(r'^/github/orgs/([^/]+)/teams/([^/]+)/members$', path)
+        if match:
+            services.count('github teams')
+            etag = '"{}"'.format(match.group(2))
+            if self.headers.get('If-None-Match') == etag:
+                return self._respond(304, b'')
+            return self._respond_json(200, [{'login': login} for login in services.team], {'ETag': etag})
+
+        return self._respond_json(404, {'message': 'Not Found'})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Serve the slack API calls the app makes. """
+        services = self.server.services
+        path = urlsplit(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+
+        if not path.startswith('/slack/api/'):
+            return self._respond_json(404, {'message': 'Not Found'})
+        method = path[len('/slack/api/'):]
+        services.count('slack {}'.format(method))
+        if services.slack_latency:
+            time.sleep(services.slack_latency)
+
+        if method == 'users.list':
+            return self._respond_json(200, self._list_users(services, form))
+        if method == 'chat.postMessage':
+            if random.random() < services.ratelimit_rate:
+                return self._respond_json(429, {'ok': False, 'error': 'ratelimited'},
+                                          {'Retry-After': str(services.retry_after)})
+            return self._respond_json(200, {'ok': True, 'channel': form.get('channel'), 'ts': str(time.time())})
+        return self._respond_json(200, {'ok': False, 'error': 'unknown_method'})
+
+    @staticmethod
+    def _list_users(services, form):
+        if not form.get('limit'):
+            return {'ok': True, 'members': services.members}
+
+        start = int(form.get('cursor') or 0)
+        end = start + min(int(form['limit']), services.page_size)
+        next_cursor = str(end) if end < len(services.members) else ''
+        return {'ok': True, 'members': services.members[start:end], 'response_metadata': {'next_cursor': next_cursor}}
+
+    def _respond_json(self, status, body, headers=None):
+        self._respond(status, json.dumps(body).encode('utf-8'), headers, 'application/json')
+
+    def _respond(self, status, body, headers=None, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
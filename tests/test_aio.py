@@ -0,0 +1,212 @@
+# pylint: disable=invalid-name, protected-access
+""" Tests for the asyncio server. """
+import hashlib
+import hmac
+import asyncio
+import json
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from aiohttp.test_utils import AioHTTPTestCase
+from aiohttp.test_utils import unittest_run_loop
+
+from app import APP
+from app import aio
+from app.dedupe import CONTENT
+from app.dedupe import DELIVERIES
+from app.directory import SlackDirectory
+from app.metrics import UPSTREAM_ERRORS
+from tests.test_github import SAMPLE_GITHUB_PAYLOAD
+from tests.test_github import patch_cache
+
+SECRET = 'secret'
+
+
+def _sign(body, secret=SECRET):
+    return 'sha1={}'.format(hmac.new(secret.encode('utf-8'), body, hashlib.sha1).hexdigest())
+
+
+class SignatureTest(TestCase):
+    """ Tests for the X-Hub-Signature check. """
+
+    def test_valid_signature(self):
+        body = b'{"zen": "Keep it logically awesome."}'
+        self.assertTrue(aio.is_valid_signature(_sign(body), SECRET, body))
+
+    def test_wrong_signature(self):
+        body = b'{"zen": "Keep it logically awesome."}'
+        self.assertFalse(aio.is_valid_signature(_sign(body, 'other'), SECRET, body))
+
+    def test_missing_key(self):
+        self.assertFalse(aio.is_valid_signature(_sign(b''), None, b''))
+
+    def test_encode_form_value(self):
+        self.assertEqual(aio._encode_form_value(True), 'true')
+        self.assertEqual(aio._encode_form_value(3), '3')
+        self.assertEqual(json.loads(aio._encode_form_value([{'a': 1}])), [{'a': 1}])
+
+
+class DirectoryRefreshTest(TestCase):
+    """ Tests for listing the slack directory without blocking. """
+
+    def test_refresh_directory_pages(self):
+        """ Every users.list page should be indexed. """
+        responses = [
+            {'ok': True, 'members': [{'id': 'U1', 'name': 'bob'}], 'response_metadata': {'next_cursor': 'page2'}},
+            {'ok': True, 'members': [{'id': 'U2', 'name': 'leia'}], 'response_metadata': {'next_cursor': ''}},
+        ]
+        calls = []
+
+        async def slack_api_call(_session, method, **kwargs):
+            calls.append((method, kwargs))
+            return responses.pop(0)
+
+        with patch('app.aio._slack_api_call', slack_api_call), patch('app.aio.DIRECTORY', SlackDirectory()):
+            index = asyncio.get_event_loop().run_until_complete(aio._refresh_directory(None))
+
+        self.assertEqual(index.match_username('leia'), 'leia')
+        self.assertEqual(calls[1], ('users.list', {'limit': aio.SLACK_USERS_PAGE_LIMIT, 'cursor': 'page2'}))
+
+    def test_refresh_directory_intermittent_ratelimits(self):
+        """ A rate limited page should be retried with its own cursor and retries. """
+        ratelimited = {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '0'}}
+        responses = []
+        for number in range(6):
+            responses.append(ratelimited)
+            responses.append({'ok': True, 'members': [{'id': 'U{}'.format(number), 'name': 'member.{}'.format(number)}],
+                              'response_metadata': {'next_cursor': str(number + 1) if number < 5 else ''}})
+        cursors = []
+
+        async def slack_api_call(_session, _method, **kwargs):
+            cursors.append(kwargs.get('cursor'))
+            return responses.pop(0)
+
+        with patch('app.aio._slack_api_call', slack_api_call), patch('app.aio.DIRECTORY', SlackDirectory()):
+            index = asyncio.get_event_loop().run_until_complete(aio._refresh_directory(None))
+
+        self.assertEqual(len(index.members), 6)
+        self.assertEqual(cursors[2:4], ['1', '1'])
+
+
+class FakeResponse:
+    """ Stands in for an aiohttp response to a github API call. """
+
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self._body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def json(self, content_type=None):  # pylint: disable=unused-argument
+        """ Return the decoded body. """
+        return self._body
+
+
+class GithubLookupTest(TestCase):
+    """ Tests for looking up github names without blocking. """
+
+    def setUp(self):
+        self.name_cache = patch_cache(self, 'app.github.NAME_CACHE', 'users')
+
+    def _lookup(self, *responses):
+        session = MagicMock()
+        session.get.side_effect = list(responses)
+        return asyncio.get_event_loop().run_until_complete(aio._lookup_github_full_name(session, 'octocat'))
+
+    def test_lookup_github_full_name(self):
+        """ A name should be cached like the Flask app caches it, and served from the cache next time. """
+        self.assertEqual(self._lookup(FakeResponse(200, {'name': 'Mona Lisa'}, {'ETag': '"abc"'})), 'Mona Lisa')
+        self.assertEqual(self.name_cache.get('octocat').etag, '"abc"')
+        self.assertEqual(self._lookup(), 'Mona Lisa')
+        self.assertEqual(self.name_cache.stats(), {'hits': 1, 'misses': 1, 'revalidations': 0})
+
+    def test_lookup_github_full_name_error(self):
+        """ An error should be counted and not cached. """
+        before = UPSTREAM_ERRORS.value('github', '502')
+        self.assertIsNone(self._lookup(FakeResponse(502, {'message': 'Server Error'})))
+        self.assertIsNone(self.name_cache.get('octocat'))
+        self.assertEqual(UPSTREAM_ERRORS.value('github', '502'), before + 1)
+
+
+class HookTest(AioHTTPTestCase):
+    """ Tests for the webhook route. """
+
+    async def get_application(self):
+        return aio.make_app()
+
+    def setUp(self):
+        config = {'GITHUB_WEBHOOKS_KEY': SECRET, 'VALIDATE_IP': False, 'VALIDATE_SIGNATURE': True}
+        patcher = patch.dict(APP.config, config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        DELIVERIES.clear()
+        CONTENT.clear()
+        self.notified = []
+
+        async def notify_recipient(_session, event):
+            self.notified.append(event)
+            return True
+
+        patcher = patch('app.aio.notify_recipient', notify_recipient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def _post(self, event, payload, signature=None, guid='72d3162e-cc78-11e3-81ab-4c9367dc0958'):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': guid,
+            'X-Hub-Signature': signature or _sign(body),
+        }
+        return self.client.post('/hooks', data=body, headers=headers)
+
+    @unittest_run_loop
+    async def test_ping(self):
+        response = await self._post('ping', {'zen': 'Design for failure.'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), 'pong')
+
+    @unittest_run_loop
+    async def test_wrong_signature(self):
+        response = await self._post('ping', {}, signature='sha1=0000')
+        self.assertEqual(response.status, 400)
+        self.assertEqual(self.notified, [])
+
+    @unittest_run_loop
+    async def test_missing_header(self):
+        response = await self.client.post('/hooks', data=b'{}', headers={'X-Hub-Signature': _sign(b'{}')})
+        self.assertEqual(response.status, 400)
+        self.assertEqual(await response.text(), 'Missing header: X-GitHub-Event')
+
+    @unittest_run_loop
+    async def test_unused_event(self):
+        response = await self._post('push', {})
+        self.assertEqual(await response.text(), 'Hook not used\n')
+
+    @unittest_run_loop
+    async def test_pull_request(self):
+        response = await self._post('pull_request', SAMPLE_GITHUB_PAYLOAD)
+        self.assertEqual(await response.text(), 'Recipient Notified')
+        self.assertEqual(self.notified[0].action, 'review_requested')
+
+    @unittest_run_loop
+    async def test_redelivery(self):
+        """ A redelivered hook should be acknowledged without notifying again. """
+        await self._post('pull_request', SAMPLE_GITHUB_PAYLOAD)
+        response = await self._post('pull_request', SAMPLE_GITHUB_PAYLOAD)
+        self.assertEqual(await response.text(), 'Duplicate delivery ignored')
+        self.assertEqual(len(self.notified), 1)
+
+    @unittest_run_loop
+    async def test_ignored_action(self):
+        response = await self._post('pull_request', dict(SAMPLE_GITHUB_PAYLOAD, action='closed'))
+        self.assertEqual(await response.text(), 'Action (closed) ignored')
+        self.assertEqual(self.notified, [])
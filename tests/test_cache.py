@@ -0,0 +1,58 @@
+# pylint: disable=protected-access
+""" Tests for the github response cache. """
+import os
+import tempfile
+from unittest import TestCase
+
+from app.cache import EtagCache
+
+
+class EtagCacheTest(TestCase):
+    """ Test the persistent ETag cache. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.sqlite3')
+        self.cache = EtagCache('users', path=self.path, ttl=60)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_set_and_get(self):
+        """ Stored entries should be returned with their etag. """
+        self.assertIsNone(self.cache.get('bob'))
+        self.cache.set('Bob', 'Bob Barker', '"abc"')
+        entry = self.cache.get('bob')
+        self.assertEqual(entry.value, 'Bob Barker')
+        self.assertEqual(entry.etag, '"abc"')
+        self.assertTrue(self.cache.is_fresh(entry))
+
+    def test_persistence(self):
+        """ Entries should survive a new cache instance on the same file. """
+        self.cache.set('bob', 'Bob Barker')
+        self.assertEqual(EtagCache('users', path=self.path).get('bob').value, 'Bob Barker')
+        self.assertIsNone(EtagCache('teams', path=self.path).get('bob'))
+
+    def test_is_fresh(self):
+        """ Entries older than the ttl should be stale. """
+        self.assertFalse(self.cache.is_fresh(None))
+        self.cache.set('bob', 'Bob Barker')
+        self.cache._ttl = 0
+        self.assertFalse(self.cache.is_fresh(self.cache.get('bob')))
+
+    def test_touch(self):
+        """ Touching an entry should refresh it and count a revalidation. """
+        self.cache.set('bob', 'Bob Barker')
+        fetched_at = self.cache.get('bob').fetched_at
+        self.cache.touch('bob')
+        self.assertGreaterEqual(self.cache.get('bob').fetched_at, fetched_at)
+        self.assertEqual(self.cache.stats()['revalidations'], 1)
+
+    def test_clear(self):
+        """ Clearing should drop the entries and reset the counters. """
+        self.cache.set('bob', 'Bob Barker')
+        self.cache.record_hit()
+        self.cache.record_miss()
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('bob'))
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 0, 'revalidations': 0})
@@ -0,0 +1,92 @@
+# pylint: disable=protected-access
+""" Tests for the shared HTTP clients. """
+import http.server
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+import responses
+
+from app import clients
+
+
+class ClientsTest(TestCase):
+    """ Test the pooled HTTP sessions. """
+
+    def test_get_session_is_shared(self):
+        """ Every call in a process should share one session. """
+        self.assertIs(clients.get_session(), clients.get_session())
+
+    def test_get_session_after_fork(self):
+        """ A forked process should get its own session. """
+        session = clients.get_session()
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(clients.get_session(), session)
+        clients._SESSION['session'] = None
+
+    @patch.object(clients, 'HTTP_READ_TIMEOUT', 7)
+    def test_request_timeouts(self):
+        """ Requests should have a connect and read timeout by default. """
+        with patch.object(clients.get_session(), 'request') as session_request:
+            clients.request('GET', 'https://api.github.com')
+            clients.request('GET', 'https://api.github.com', timeout=1)
+        self.assertEqual(session_request.call_args_list[0][1]['timeout'], (clients.HTTP_CONNECT_TIMEOUT, 7))
+        self.assertEqual(session_request.call_args_list[1][1]['timeout'], 1)
+
+    def test_slack_api_call(self):
+        """ Slack calls should json encode structured arguments and return the headers. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('POST', 'https://slack.com/api/chat.postMessage', json={'ok': False, 'error': 'ratelimited'},
+                     status=429, headers={'Retry-After': '3'})
+            response = clients.slack_api_call('chat.postMessage', channel='#general', attachments=[{'text': 'hi'}])
+
+            body = rsps.calls[0].request.body
+            self.assertIn('channel=%23general', body)
+            self.assertIn('attachments=%5B%7B%22text%22%3A+%22hi%22%7D%5D', body)
+            self.assertTrue(rsps.calls[0].request.headers['Authorization'].startswith('Bearer '))
+        self.assertEqual(response['error'], 'ratelimited')
+        self.assertEqual(response['headers']['Retry-After'], '3')
+
+    def test_finish_slack_response_headers(self):
+        """ Headers should be looked up case insensitively, whatever case they were sent in. """
+        response = clients.finish_slack_response({'ok': False, 'error': 'ratelimited'}, 429, {'retry-after': '3'})
+        self.assertEqual(response['headers']['Retry-After'], '3')
+
+    def test_slack_api_call_invalid_response(self):
+        """ A response that isn't json should be reported as a failure. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('POST', 'https://slack.com/api/users.list', body='<html>', status=502)
+            response = clients.slack_api_call('users.list')
+        self.assertFalse(response['ok'])
+        self.assertEqual(response['status'], 502)
+
+    def test_connection_stats(self):
+        """ Requests to the same host should reuse a kept-alive connection, and be reported as reused. """
+        server = http.server.HTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        clients._SESSION['session'] = None
+        self.addCleanup(clients._SESSION.update, session=None)
+
+        url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        for _ in range(2):
+            clients.request('GET', url).raise_for_status()
+
+        stats = clients.connection_stats()['127.0.0.1']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['connections'], 1)
+        self.assertGreaterEqual(stats['reused'], 1)
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
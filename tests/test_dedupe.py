@@ -0,0 +1,66 @@
+""" Tests for recognizing duplicate deliveries. """
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import dedupe
+from app.dedupe import DedupeStore
+from app.github import PullRequestEvent
+
+
+class DedupeStoreTest(TestCase):
+    """ Test the bounded store of seen keys. """
+
+    def test_check_and_add(self):
+        store = DedupeStore(ttl=60, max_entries=10)
+        self.assertFalse(store.check_and_add('guid-1'))
+        self.assertTrue(store.check_and_add('guid-1'))
+        self.assertEqual(store.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1})
+
+    @patch('app.dedupe.time.monotonic')
+    def test_expiry(self, monotonic):
+        """ Keys should be forgotten after the ttl. """
+        store = DedupeStore(ttl=60, max_entries=10)
+        monotonic.return_value = 1000
+        store.check_and_add('guid-1')
+        monotonic.return_value = 1061
+        self.assertFalse(store.check_and_add('guid-1'))
+        self.assertEqual(store.stats()['size'], 1)
+
+    def test_eviction(self):
+        """ The oldest key should be forgotten once the store is full. """
+        store = DedupeStore(ttl=60, max_entries=2)
+        for key in ('guid-1', 'guid-2', 'guid-3'):
+            store.check_and_add(key)
+        self.assertEqual(store.stats()['evictions'], 1)
+        self.assertFalse(store.check_and_add('guid-1'))
+        self.assertTrue(store.check_and_add('guid-3'))
+
+    def test_disabled(self):
+        store = DedupeStore(ttl=0)
+        store.check_and_add('guid-1')
+        self.assertFalse(store.check_and_add('guid-1'))
+
+
+class ClaimDeliveryTest(TestCase):
+    """ Test recognizing redeliveries and repeated notifications. """
+
+    EVENT = PullRequestEvent(action='assigned', recipient='luke', repo='rebels/x-wing', number=1)
+
+    def setUp(self):
+        dedupe.DELIVERIES.clear()
+        dedupe.CONTENT.clear()
+
+    def test_redelivery(self):
+        self.assertIsNotNone(dedupe.claim_delivery('guid-1', self.EVENT))
+        self.assertIsNone(dedupe.claim_delivery('guid-1', self.EVENT))
+
+    def test_same_notification(self):
+        """ A new delivery asking for the same notification should be a duplicate. """
+        self.assertIsNotNone(dedupe.claim_delivery('guid-1', self.EVENT))
+        self.assertIsNone(dedupe.claim_delivery('guid-2', self.EVENT))
+        self.assertIsNotNone(dedupe.claim_delivery('guid-3', self.EVENT._replace(recipient='leia')))
+
+    def test_release(self):
+        keys = dedupe.claim_delivery('guid-1', self.EVENT)
+        dedupe.release_delivery(keys)
+        self.assertIsNotNone(dedupe.claim_delivery('guid-1', self.EVENT))
@@ -0,0 +1,156 @@
+# pylint: disable=protected-access
+""" Tests for the background delivery queue. """
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import delivery
+from app.delivery import DeliveryQueue
+from app.digest import Digest
+from app.github import PullRequestEvent
+from app.spool import Spool
+
+
+class DeliveryQueueTest(TestCase):
+    """ Test the delivery queue and its workers. """
+
+    def setUp(self):
+        self.handler = MagicMock()
+        self.delivery_queue = DeliveryQueue(self.handler, workers=2, maxsize=2)
+
+    def tearDown(self):
+        self.delivery_queue.drain(timeout=5)
+
+    def test_submit_and_drain(self):
+        """ Submitted jobs should all be handled before drain returns. """
+        self.assertEqual(self.delivery_queue._threads, [])
+        self.assertTrue(self.delivery_queue.submit({'job': 1}))
+        self.assertTrue(self.delivery_queue.submit({'job': 2}))
+        self.delivery_queue.drain(timeout=5)
+
+        self.assertEqual(self.handler.call_count, 2)
+        self.assertEqual(self.delivery_queue.depth(), 0)
+        self.assertFalse(self.delivery_queue.submit({'job': 3}))
+
+    def test_submit_when_full(self):
+        """ A full queue should refuse new jobs. """
+        release = threading.Event()
+        self.handler.side_effect = lambda job: release.wait(5)
+        self.delivery_queue = DeliveryQueue(self.handler, workers=1, maxsize=1)
+        submitted = [self.delivery_queue.submit({'job': number}) for number in range(5)]
+        release.set()
+
+        self.assertIn(False, submitted)
+        self.assertLessEqual(self.delivery_queue.depth(), 1)
+
+    def test_drain_deadline(self):
+        """ The drain timeout should bound the whole drain rather than each worker in turn. """
+        release = threading.Event()
+        self.handler.side_effect = lambda job: release.wait(5)
+        self.delivery_queue = DeliveryQueue(self.handler, workers=4, maxsize=8)
+        for number in range(4):
+            self.delivery_queue.submit({'job': number})
+
+        started = time.monotonic()
+        self.delivery_queue.drain(timeout=0.2)
+        self.assertLess(time.monotonic() - started, 0.6)
+        release.set()
+
+    def test_handler_errors_are_logged(self):
+        """ A failing job should be logged and not stop the worker. """
+        self.handler.side_effect = [ValueError('boom'), None]
+        with self.assertLogs('app.delivery', level='ERROR'):
+            self.delivery_queue.submit({'job': 1})
+            self.delivery_queue.submit({'job': 2})
+            self.delivery_queue.drain(timeout=5)
+        self.assertEqual(self.handler.call_count, 2)
+
+
+class DispatchTest(TestCase):
+    """ Test recording and delivering notifications. """
+
+    EVENT = PullRequestEvent(action='assigned', recipient='luke')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = Spool(os.path.join(self.tmpdir.name, 'spool.jsonl'), fsync_interval=0)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmpdir.cleanup()
+
+    @patch('app.delivery.notify_recipient')
+    def test_dispatch_sync(self, notifier):
+        """ A notification should be delivered and marked done in sync mode. """
+        notifier.return_value = True
+        with patch('app.delivery.SPOOL', self.spool):
+            self.assertFalse(delivery.dispatch(self.EVENT))
+        notifier.assert_called_once_with(self.EVENT)
+        self.assertEqual(self.spool.pending(), [])
+
+    @patch('app.delivery.notify_recipient')
+    def test_dispatch_failure_stays_pending(self, notifier):
+        """ A notification slack did not accept should stay in the spool until it used up its attempts. """
+        notifier.return_value = False
+        self.spool._max_attempts = 2
+        with patch('app.delivery.SPOOL', self.spool):
+            delivery.dispatch(self.EVENT)
+            self.assertEqual([job for _id, job in self.spool.pending()], [self.EVENT._asdict()])
+            with self.assertLogs('app.spool', level='WARNING'):
+                delivery.replay_spool()
+        self.assertEqual(self.spool.pending(), [])
+
+    @patch('app.delivery.DELIVERY_MODE', 'async')
+    @patch('app.delivery.DELIVERY_QUEUE')
+    def test_dispatch_async(self, delivery_queue):
+        """ A notification should be queued with its spool id in async mode. """
+        delivery_queue.submit.return_value = True
+        with patch('app.delivery.SPOOL', self.spool):
+            self.assertTrue(delivery.dispatch(self.EVENT))
+        spool_id, _job = self.spool.pending()[0]
+        delivery_queue.submit.assert_called_once_with((self.EVENT, spool_id))
+
+    @patch('app.delivery.notify_recipient')
+    def test_replay_spool(self, notifier):
+        """ Pending notifications should be delivered again. """
+        notifier.return_value = True
+        self.spool.record(self.EVENT._asdict())
+        with patch('app.delivery.SPOOL', self.spool):
+            delivery.replay_spool()
+        notifier.assert_called_once_with(self.EVENT)
+        self.assertEqual(self.spool.pending(), [])
+
+    @patch('app.delivery.send_slack_message')
+    @patch('app.delivery.create_slack_message_payloads')
+    def test_dispatch_digest(self, renderer, sender):
+        """ A notification added to a digest should be marked done once the digest is sent. """
+        renderer.return_value = [{'channel': '@luke', 'text': 'Lucky you!', 'attachments': []}]
+        sender.return_value = True
+        digest = Digest(sender, window=60, max_size=10, max_latency=60)
+        with patch('app.delivery.SPOOL', self.spool), patch('app.delivery.DIGEST', digest):
+            self.assertTrue(delivery.dispatch(self.EVENT))
+            self.assertEqual(len(self.spool.pending()), 1)
+            digest.close()
+        sender.assert_called_once_with(renderer.return_value[0])
+        self.assertEqual(self.spool.pending(), [])
+
+    @patch('app.delivery.send_slack_message')
+    @patch('app.delivery.create_slack_message_payloads')
+    @patch('app.delivery.expand_team_event')
+    def test_dispatch_team(self, expander, renderer, sender):
+        """ A team is expanded on delivery, and its record is done once every member was notified. """
+        event = self.EVENT._replace(action='review_requested', team='jedi')
+        expander.side_effect = lambda event: [event._replace(recipient=name) for name in ('leia', 'yoda')]
+        renderer.side_effect = lambda events: [{'channel': '@' + event.recipient} for event in events]
+        sender.side_effect = [True, False, True, True]
+        with patch('app.delivery.SPOOL', self.spool):
+            self.assertFalse(delivery.dispatch(event))
+            self.assertEqual(len(self.spool.pending()), 1)
+            delivery.replay_spool()
+        expander.assert_called_with(event)
+        self.assertEqual([call[0][0]['channel'] for call in sender.call_args_list], ['@leia', '@yoda'] * 2)
+        self.assertEqual(self.spool.pending(), [])
@@ -0,0 +1,103 @@
+""" Tests for coalescing notifications into digests. """
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from app.digest import Digest
+from app.digest import combine_payloads
+
+
+def _payload(channel, title, text="You've been pinged. Lucky you!"):
+    return {'channel': channel, 'text': text, 'attachments': [{'title': title}]}
+
+
+class DigestTest(TestCase):
+    """ Test batching messages per channel. """
+
+    def setUp(self):
+        self.sent = threading.Event()
+        self.sender = MagicMock(return_value=True, side_effect=lambda payload: self.sent.set() or True)
+
+    def test_flushes_after_window(self):
+        """ Messages to the same channel within the window should be sent as one. """
+        digest = Digest(self.sender, window=0.05, max_size=10, max_latency=5)
+        callback = MagicMock()
+        digest.add(_payload('@luke', 'one'), callback)
+        digest.add(_payload('@luke', 'two'), callback)
+
+        self.assertTrue(self.sent.wait(5))
+        digest.close()
+        self.sender.assert_called_once()
+        attachments = self.sender.call_args[0][0]['attachments']
+        self.assertEqual([attachment['title'] for attachment in attachments], ['one', 'two'])
+        self.assertEqual(callback.call_count, 2)
+        callback.assert_called_with(True)
+
+    def test_flushes_at_max_size(self):
+        """ A full batch should be sent right away. """
+        digest = Digest(self.sender, window=60, max_size=2, max_latency=60)
+        digest.add(_payload('@luke', 'one'))
+        self.assertEqual(digest.pending(), 1)
+        digest.add(_payload('@luke', 'two'))
+
+        self.sender.assert_called_once()
+        self.assertEqual(digest.pending(), 0)
+        digest.close()
+
+    def test_flushes_at_max_latency(self):
+        """ A batch that keeps growing should still be sent after the max latency. """
+        digest = Digest(self.sender, window=60, max_size=100, max_latency=0.05)
+        digest.add(_payload('@luke', 'one'))
+
+        self.assertTrue(self.sent.wait(5))
+        digest.close()
+        self.sender.assert_called_once()
+
+    def test_channels_are_batched_separately(self):
+        """ Each channel should get its own digest. """
+        digest = Digest(self.sender, window=60, max_size=10, max_latency=60)
+        digest.add(_payload('@luke', 'one'))
+        digest.add(_payload('@leia', 'two'))
+        digest.close()
+
+        channels = sorted(call[0][0]['channel'] for call in self.sender.call_args_list)
+        self.assertEqual(channels, ['@leia', '@luke'])
+
+    def test_close(self):
+        """ Closing should send pending batches and refuse new messages. """
+        digest = Digest(self.sender, window=60, max_size=10, max_latency=60)
+        callback = MagicMock()
+        digest.add(_payload('@luke', 'one'), callback)
+        digest.close()
+
+        callback.assert_called_once_with(True)
+        self.assertFalse(digest.add(_payload('@luke', 'two')))
+
+    def test_failed_send(self):
+        """ Callbacks should hear that slack did not accept the digest. """
+        self.sender.side_effect = ValueError('boom')
+        digest = Digest(self.sender, window=60, max_size=10, max_latency=60)
+        callback = MagicMock()
+        digest.add(_payload('@luke', 'one'), callback)
+        with self.assertLogs('app.digest', level='ERROR'):
+            digest.close()
+        callback.assert_called_once_with(False)
+
+
+class CombinePayloadsTest(TestCase):
+    """ Test merging messages into one. """
+
+    def test_single_payload(self):
+        payload = _payload('@luke', 'one')
+        self.assertIs(combine_payloads([payload]), payload)
+
+    def test_texts_are_deduplicated(self):
+        """ Identical texts should be combined once, keeping every attachment. """
+        combined = combine_payloads([
+            _payload('#general', 'one', '@luke! Lucky you!'),
+            _payload('#general', 'two', '@leia! Lucky you!'),
+            _payload('#general', 'three', '@luke! Lucky you!'),
+        ])
+        self.assertEqual(combined['text'], '@luke! Lucky you!\n@leia! Lucky you!')
+        self.assertEqual(len(combined['attachments']), 3)
+        self.assertEqual(combined['channel'], '#general')
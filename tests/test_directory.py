@@ -0,0 +1,357 @@
+# pylint: disable=protected-access
+""" Tests for the slack directory cache. """
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import requests
+
+from app.directory import SlackDirectory
+from app.directory import SlackDirectoryIndex
+from app.directory import SlackDirectoryUnavailable
+from app.directory import SlackMember
+from app.directory import _add_entry
+from app.directory import _deep_sizeof
+from app.directory import _discard_entry
+from app.directory import iter_slack_member_pages
+from tests.test_github import FULL_NAME
+from tests.test_github import GENERIC_USERNAME
+
+MEMBERS = [{'name': GENERIC_USERNAME, 'real_name': 'Bob Barker'}]
+RECORDS = [SlackMember(GENERIC_USERNAME, GENERIC_USERNAME, GENERIC_USERNAME, None, 'bob barker')]
+
+
+class SlackDirectoryTest(TestCase):
+    """ Test the slack directory cache. """
+
+    def setUp(self):
+        self.loader = MagicMock(return_value=[MEMBERS])
+        self.directory = SlackDirectory(loader=self.loader, ttl=60)
+
+    def test_get_members_is_cached(self):
+        """ Only one users.list call should be made per ttl window. """
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        self.assertEqual(self.loader.call_count, 1)
+
+        stats = self.directory.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['members'], 1)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_get_index(self):
+        """ The match index should be built from the cached snapshot. """
+        self.assertEqual(self.directory.get_index().match_username(GENERIC_USERNAME), GENERIC_USERNAME)
+        self.assertIs(self.directory.get_index(), self.directory.get_index())
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_get_members_refreshes_when_stale(self):
+        """ A stale directory should be fetched again. """
+        self.directory._ttl = 0
+        self.directory.get_members()
+        self.directory.get_members()
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_invalidate(self):
+        """ Invalidating the directory should force a fresh fetch. """
+        self.directory.get_members()
+        self.directory.invalidate()
+        self.assertEqual(self.directory.stats()['members'], 0)
+        self.directory.get_members()
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_failed_fetch_is_not_cached(self):
+        """ A failed fetch should serve the last good copy and retry next time. """
+        self.directory.get_members()
+        self.directory._ttl = 0
+        self.loader.return_value = None
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        self.loader.side_effect = SlackDirectoryUnavailable('ratelimited')
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        self.assertEqual(self.directory.stats()['errors'], 2)
+
+        self.directory.invalidate()
+        self.assertEqual(self.directory.get_members(), [])
+
+    def test_raising_loader_serves_stale_copy(self):
+        """ A users.list call that timed out or returned bad json should serve the last good copy. """
+        self.directory.get_index()
+        self.directory._ttl = 0
+        for error in (requests.ConnectTimeout('timed out'), ValueError('No JSON object could be decoded')):
+            self.loader.side_effect = error
+            with self.assertLogs('app.directory', level='WARNING'):
+                self.assertEqual(self.directory.get_index().match_username(GENERIC_USERNAME), GENERIC_USERNAME)
+        self.assertEqual(self.directory.stats()['errors'], 2)
+
+    @patch('app.directory.time.monotonic')
+    def test_failed_fetch_backs_off(self, monotonic):
+        """ After a failed fetch, lookups should serve the stale copy until the retry interval has passed. """
+        monotonic.return_value = 1000
+        self.directory.get_members()
+        self.loader.side_effect = SlackDirectoryUnavailable('ratelimited')
+        monotonic.return_value = 1060
+        for _ in range(3):
+            self.assertEqual(self.directory.get_members(), RECORDS)
+        self.assertEqual(self.loader.call_count, 2)
+
+        monotonic.return_value = 1089
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        self.assertEqual(self.loader.call_count, 2)
+        monotonic.return_value = 1090
+        self.directory.get_members()
+        self.assertEqual(self.loader.call_count, 3)
+
+    def test_single_flight_refresh(self):
+        """ Concurrent lookups should share one in-flight fetch. """
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_loader():
+            started.set()
+            release.wait(5)
+            return [MEMBERS]
+
+        self.loader.side_effect = slow_loader
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.directory.get_members())) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertEqual(results, [RECORDS] * 5)
+
+    def test_stale_copy_served_during_refresh(self):
+        """ Lookups during a refresh should be served the stale copy rather than wait for it. """
+        self.directory.get_members()
+        self.directory._ttl = 0
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_loader():
+            started.set()
+            release.wait(5)
+            return [MEMBERS + [{'name': 'leia'}]]
+
+        self.loader.side_effect = slow_loader
+        refresh = threading.Thread(target=self.directory.get_members)
+        refresh.start()
+        started.wait(5)
+        self.assertEqual(self.directory.get_members(), RECORDS)
+        release.set()
+        refresh.join(5)
+        self.assertEqual(self.loader.call_count, 2)
+        self.assertEqual(len(self.directory.get_cached_index().members), 2)
+
+    def test_apply_member_during_refresh(self):
+        """ A member event that arrives while users.list is being walked should not be lost. """
+        def loader():
+            self.assertTrue(self.directory.apply_member({'id': 'U2', 'name': 'leia'}))
+            return [MEMBERS]
+
+        self.loader.side_effect = loader
+        self.assertEqual(self.directory.get_index().match_username('leia'), 'leia')
+        self.assertEqual(len(self.directory.get_members()), 2)
+
+        self.directory.invalidate()
+        self.directory.begin_refresh()
+        self.directory.apply_member({'id': 'U3', 'name': 'luke'})
+        self.assertEqual(self.directory.replace(SlackDirectoryIndex(MEMBERS)).match_username('luke'), 'luke')
+
+    def test_apply_member(self):
+        """ A member event should patch the cached directory without fetching it again. """
+        self.assertFalse(self.directory.apply_member({'id': 'U2', 'name': 'leia'}))
+        self.directory.get_members()
+
+        self.assertTrue(self.directory.apply_member({'id': 'U2', 'name': 'leia'}))
+        self.assertTrue(self.directory.apply_member({'id': 'U2', 'name': 'leia', 'real_name': 'Leia Organa'}))
+        self.assertFalse(self.directory.apply_member(None))
+
+        self.assertEqual(self.directory.get_index().match_full_name('leia organa'), 'leia')
+        self.assertEqual(len(self.directory.get_members()), 2)
+        self.assertEqual(self.directory.stats()['members'], 2)
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_members_are_compacted(self):
+        """ Only the member fields used for matching should be kept, normalized. """
+        self.loader.return_value = [[{'id': 'U1', 'name': 'bob', 'real_name': ' Bob Barker ', 'is_bot': False,
+                                      'profile': {'display_name': 'Bobby', 'image_512': 'http://'}}]]
+        self.assertEqual(self.directory.get_members(), [SlackMember('U1', 'bob', 'bob', 'bobby', 'bob barker')])
+
+    def test_listeners(self):
+        """ Listeners should be called when the members change, but not for a refresh that changed nothing. """
+        listener = MagicMock()
+        self.directory.add_listener(listener)
+        self.directory.get_members()
+        self.assertEqual(listener.call_count, 1)
+
+        self.directory.invalidate()
+        self.directory.get_members()
+        self.assertEqual(listener.call_count, 1)
+
+        self.directory.apply_member({'id': 'U2', 'name': 'leia'})
+        self.assertEqual(listener.call_count, 2)
+        self.directory.apply_member({'id': 'U2', 'name': 'leia'})
+        self.assertEqual(listener.call_count, 2)
+
+    @patch('app.directory.slack_api_call')
+    def test_fetch_slack_members(self, slack_client):
+        """ Test the default users.list loader. """
+        slack_client.return_value = {'ok': True, 'members': MEMBERS}
+        self.assertEqual(SlackDirectory().get_members(), RECORDS)
+
+        slack_client.return_value = {'ok': False, 'error': 'not_authed'}
+        with self.assertLogs('app.directory', level='WARNING'):
+            self.assertEqual(SlackDirectory().get_members(), [])
+
+    @patch('app.directory.time.sleep')
+    @patch('app.directory.slack_api_call')
+    def test_iter_slack_member_pages(self, slack_client, sleep):
+        """ Every page should be fetched, waiting out rate limits between them. """
+        slack_client.side_effect = [
+            {'ok': True, 'members': MEMBERS[:1], 'response_metadata': {'next_cursor': 'page2'}},
+            {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '2'}},
+            {'ok': True, 'members': [{'name': 'leia'}], 'response_metadata': {'next_cursor': ''}},
+        ]
+        pages = list(iter_slack_member_pages(limit=1))
+
+        self.assertEqual(pages, [MEMBERS[:1], [{'name': 'leia'}]])
+        self.assertEqual(slack_client.call_args_list[0][1], {'limit': 1})
+        self.assertEqual(slack_client.call_args[1], {'limit': 1, 'cursor': 'page2'})
+        sleep.assert_called_once_with(2)
+
+    @patch('app.directory.time.sleep')
+    @patch('app.directory.slack_api_call')
+    def test_iter_pages_intermittent_ratelimits(self, slack_client, _sleep):
+        """ Each page should get its own retries, so rate limits spread over a long walk do not fail it. """
+        ratelimited = {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '0'}}
+        responses = []
+        for number in range(6):
+            responses.append(ratelimited)
+            responses.append({'ok': True, 'members': [{'name': 'member.{}'.format(number)}],
+                              'response_metadata': {'next_cursor': str(number + 1) if number < 5 else ''}})
+        slack_client.side_effect = responses
+
+        directory = SlackDirectory()
+        self.assertEqual(len(directory.get_members()), 6)
+        self.assertEqual(directory.stats()['errors'], 0)
+        self.assertEqual([call[1].get('cursor') for call in slack_client.call_args_list][-2:], ['5', '5'])
+
+
+class SlackDirectoryIndexTest(TestCase):
+    """ Test the slack directory match index. """
+
+    USERS = [{
+        'real_name': FULL_NAME.upper(),
+        'name': GENERIC_USERNAME,
+    }]
+
+    def test_match_username(self):
+        """ Test matching a slack and github username. """
+        index = SlackDirectoryIndex(self.USERS)
+        self.assertEqual(index.match_username(GENERIC_USERNAME), GENERIC_USERNAME)
+        self.assertEqual(index.match_username(GENERIC_USERNAME.upper()), GENERIC_USERNAME)
+        self.assertIsNone(index.match_username(None))
+
+        index = SlackDirectoryIndex([])
+        self.assertIsNone(index.match_username(GENERIC_USERNAME))
+
+    def test_match_username_by_display_name(self):
+        """ Test matching a github username to a slack display name. """
+        index = SlackDirectoryIndex(['not a member', {'name': 'bob', 'profile': {'display_name': GENERIC_USERNAME}}])
+        self.assertEqual(index.match_username(GENERIC_USERNAME), 'bob')
+
+    def test_match_username_first_match_wins(self):
+        """ The first member in users.list order should win, whichever field matched. """
+        users = [
+            {'name': 'bob', 'profile': {'display_name': GENERIC_USERNAME}},
+            {'name': GENERIC_USERNAME},
+        ]
+        self.assertEqual(SlackDirectoryIndex(users).match_username(GENERIC_USERNAME), 'bob')
+        self.assertEqual(SlackDirectoryIndex(users[::-1]).match_username(GENERIC_USERNAME), GENERIC_USERNAME)
+
+    def test_match_full_name(self):
+        """ Test matching a slack and github user by full name. """
+        index = SlackDirectoryIndex(self.USERS)
+        self.assertEqual(index.match_full_name(FULL_NAME), GENERIC_USERNAME)
+        self.assertEqual(index.match_full_name(' {} '.format(FULL_NAME)), GENERIC_USERNAME)
+        self.assertIsNone(index.match_full_name(''))
+
+        index = SlackDirectoryIndex([])
+        self.assertIsNone(index.match_full_name(FULL_NAME))
+
+    def test_upsert(self):
+        """ Members should be added, renamed and deleted without rebuilding the index. """
+        index = SlackDirectoryIndex([{'id': 'U1', 'name': 'bob', 'profile': {'display_name': GENERIC_USERNAME}}])
+        self.assertEqual(index.upsert({'id': 'U2', 'name': GENERIC_USERNAME, 'real_name': FULL_NAME}), 1)
+        self.assertEqual(index.match_username(GENERIC_USERNAME), 'bob')
+        self.assertEqual(index.match_full_name(FULL_NAME), GENERIC_USERNAME)
+
+        self.assertEqual(index.upsert({'id': 'U1', 'name': 'bob', 'profile': {'display_name': 'bobo'}}), 0)
+        self.assertEqual(index.match_username(GENERIC_USERNAME), GENERIC_USERNAME)
+        self.assertEqual(index.match_username('bobo'), 'bob')
+
+        self.assertEqual(index.upsert({'id': 'U2', 'name': GENERIC_USERNAME, 'deleted': True}), 1)
+        self.assertIsNone(index.match_username(GENERIC_USERNAME))
+        self.assertIsNone(index.match_full_name(FULL_NAME))
+        self.assertIsNone(index.upsert({'id': 'U3'}))
+
+    def test_upsert_shared_name(self):
+        """ When the first of two members sharing a name changes, the other should match it. """
+        index = SlackDirectoryIndex([{'id': 'U1', 'name': 'bob', 'real_name': FULL_NAME},
+                                     {'id': 'U2', 'name': 'rob', 'real_name': FULL_NAME}])
+        self.assertEqual(index.match_full_name(FULL_NAME), 'bob')
+        index.upsert({'id': 'U1', 'name': 'bob', 'real_name': 'Robert Barker'})
+        self.assertEqual(index.match_full_name(FULL_NAME), 'rob')
+        index.upsert({'id': 'U1', 'name': 'bob', 'real_name': FULL_NAME})
+        self.assertEqual(index.match_full_name(FULL_NAME), 'bob')
+
+    def test_upsert_never_misses(self):
+        """ A match running while a member changes should find the member before, during and after the change. """
+        index = SlackDirectoryIndex([{'id': 'U1', 'name': 'bob', 'profile': {'display_name': 'bobo'}}])
+        seen = []
+
+        def check(function):
+            def wrapper(*args):
+                seen.append((index.match_username('bob'), index.match_username('bobo') or index.match_username('rob')))
+                return function(*args)
+            return wrapper
+
+        with patch('app.directory._add_entry', check(_add_entry)), \
+                patch('app.directory._discard_entry', check(_discard_entry)):
+            index.upsert({'id': 'U1', 'name': 'bob', 'profile': {'display_name': 'rob'}})
+        self.assertEqual(seen, [('bob', 'bob'), ('bob', 'bob')])
+        self.assertEqual(index.match_username('rob'), 'bob')
+        self.assertIsNone(index.match_username('bobo'))
+
+    def test_footprint(self):
+        """ The index should take a fraction of the memory of the users.list members it was built from. """
+        members = [{
+            'id': 'U{:08d}'.format(number),
+            'team_id': 'T00000001',
+            'name': 'member.{}'.format(number),
+            'real_name': 'Member Number {}'.format(number),
+            'tz': 'America/Denver',
+            'tz_label': 'Mountain Daylight Time',
+            'updated': 1500000000 + number,
+            'profile': {
+                'display_name': 'member.{}'.format(number),
+                'real_name': 'Member Number {}'.format(number),
+                'email': 'member.{}@example.com'.format(number),
+                'status_text': 'Working',
+                'image_72': 'https://example.com/{}_72.png'.format(number),
+                'image_512': 'https://example.com/{}_512.png'.format(number),
+            },
+        } for number in range(100)]
+        index = SlackDirectoryIndex(members)
+        self.assertLess(index.footprint(), _deep_sizeof(members, set()) / 2)
+
+        footprint = index.footprint()
+        index.upsert({'id': 'U1', 'name': 'leia'})
+        self.assertGreater(index.footprint(), footprint)
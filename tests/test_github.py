@@ -1,6 +1,10 @@
 # pylint: disable=invalid-name,protected-access
 """ Tests for the github module. """
+import copy
+import math
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 from unittest import skipUnless
 from unittest.mock import patch
@@ -8,10 +12,15 @@ from unittest.mock import patch
 import responses
 from werkzeug.exceptions import BadRequest
 
+from app.cache import EtagCache
 from app.github import GithubWebhookPayloadParser
+from app.github import PullRequestEvent
+from app.github import expand_team_event
 from app.github import get_recipient_github_username_by_action
 from app.github import is_valid_pull_request
 from app.github import lookup_github_full_name
+from app.github import lookup_github_team_members
+from app.metrics import UPSTREAM_RATELIMITED
 
 FULL_NAME = 'Bob Barker'
 GENERIC_USERNAME = 'big_daddy_bob'
@@ -36,6 +45,17 @@ SAMPLE_GITHUB_PAYLOAD = {
 }
 
 
+def patch_cache(test, target, namespace):
+    """ Replace a github cache with an empty one in a temporary directory for the duration of a test. """
+    tmpdir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmpdir, True)
+    cache = EtagCache(namespace, path=os.path.join(tmpdir, 'github-cache.sqlite3'))
+    patcher = patch(target, cache)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return cache
+
+
 class GithubReviewRequestTest(TestCase):
     """ Test the github review request functions. """
 
@@ -98,6 +118,7 @@ class GeneralGithubTest(TestCase):
     def setUp(self):
         self.gh_username = 'gidgidonihah'
         self.gh_full_name = 'Jason Weir'
+        self.name_cache = patch_cache(self, 'app.github.NAME_CACHE', 'users')
 
     def test_get_recipient_github_username_by_action_review_request(self):
         """ Should return the requested reviewers username """
@@ -121,6 +142,37 @@ class GeneralGithubTest(TestCase):
             del payload['action']
             get_recipient_github_username_by_action(payload)
 
+    def test_pull_request_event_from_payload(self):
+        """ Should extract everything a notification needs from the payload, parsing it once. """
+        with patch('app.github.GithubWebhookPayloadParser', wraps=GithubWebhookPayloadParser) as parser:
+            event = PullRequestEvent.from_payload(SAMPLE_GITHUB_PAYLOAD)
+        parser.assert_called_once_with(SAMPLE_GITHUB_PAYLOAD)
+        self.assertEqual(event, PullRequestEvent(
+            action='review_requested',
+            recipient=GENERIC_USERNAME,
+            reviewer=GENERIC_USERNAME,
+            url='http://www.example.com',
+            title='PR Title',
+            repo='Example Repository',
+            number=1,
+            author=GENERIC_USERNAME,
+            author_image='https://github.com/apple-touch-icon-180x180.png',
+            description='An example pull request.',
+        ))
+        self.assertEqual(PullRequestEvent(**event._asdict()), event)
+
+    def test_pull_request_event_defaults(self):
+        """ Missing pull request details should fall back to placeholders. """
+        event = PullRequestEvent.from_payload({'action': 'assigned', 'assignee': {'login': GENERIC_USERNAME}})
+        self.assertEqual(event.recipient, GENERIC_USERNAME)
+        self.assertIsNone(event.reviewer)
+        self.assertEqual(event.title, 'Unknown Title')
+        self.assertEqual(event.repo, 'Unknown')
+        self.assertEqual(event.number, math.pi)
+
+        with self.assertRaises(BadRequest):
+            PullRequestEvent.from_payload({})
+
     def test_lookup_github_fullname(self):
         """ Test lookup_github_full_name. """
         with responses.RequestsMock() as rsps:
@@ -129,6 +181,51 @@ class GeneralGithubTest(TestCase):
             name = lookup_github_full_name(self.gh_username)
             self.assertEqual(name, self.gh_full_name)
 
+    def test_lookup_github_fullname_cached(self):
+        """ A cached name should be served without asking github again. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', 'https://api.github.com/users/{}'.format(self.gh_username),
+                     json={"name": self.gh_full_name}, status=200, headers={'ETag': '"abc"'})
+            lookup_github_full_name(self.gh_username)
+            name = lookup_github_full_name(self.gh_username.upper())
+            self.assertEqual(name, self.gh_full_name)
+            self.assertEqual(len(rsps.calls), 1)
+        self.assertEqual(self.name_cache.stats(), {'hits': 1, 'misses': 1, 'revalidations': 0})
+
+    def test_lookup_github_fullname_revalidated(self):
+        """ A stale name should be revalidated with the cached ETag. """
+        self.name_cache._ttl = 0
+        with responses.RequestsMock() as rsps:
+            url = 'https://api.github.com/users/{}'.format(self.gh_username)
+            rsps.add('GET', url, json={"name": self.gh_full_name}, status=200, headers={'ETag': '"abc"'})
+            rsps.add('GET', url, status=304)
+            lookup_github_full_name(self.gh_username)
+            name = lookup_github_full_name(self.gh_username)
+            self.assertEqual(name, self.gh_full_name)
+            self.assertEqual(rsps.calls[1].request.headers.get('If-None-Match'), '"abc"')
+        self.assertEqual(self.name_cache.stats()['revalidations'], 1)
+
+    def test_lookup_github_fullname_errors(self):
+        """ An error should not be parsed as a user or cached, while an unknown login should be cached. """
+        with responses.RequestsMock() as rsps:
+            url = 'https://api.github.com/users/{}'.format(self.gh_username)
+            rsps.add('GET', url, json={'message': 'Server Error'}, status=502)
+            rsps.add('GET', url, json={'message': 'Not Found'}, status=404)
+            self.assertIsNone(lookup_github_full_name(self.gh_username))
+            self.assertIsNone(self.name_cache.get(self.gh_username))
+            self.assertEqual(lookup_github_full_name(self.gh_username), '')
+            self.assertEqual(lookup_github_full_name(self.gh_username), '')
+            self.assertEqual(len(rsps.calls), 2)
+
+    def test_lookup_github_fullname_null_name(self):
+        """ A user github knows but who has no name should be cached with an empty name, not as a failure. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', 'https://api.github.com/users/dependabot', json={'login': 'dependabot', 'name': None})
+            self.assertEqual(lookup_github_full_name('dependabot'), '')
+            self.assertEqual(lookup_github_full_name('dependabot'), '')
+            self.assertEqual(self.name_cache.get('dependabot').value, '')
+            self.assertEqual(len(rsps.calls), 1)
+
     @skipUnless(os.environ.get('GITHUB_API_USER') and os.environ.get('GITHUB_API_TOKEN'), "valid github tokens needed")
     @skipUnless(os.environ.get('TEST_ON_NETWORK'), "Network tests ignored")
     def test_network_lookup_github_fullname(self):
@@ -141,53 +238,160 @@ class GithubWebhookPayloadParserTest(TestCase):
     """ Testcase for the Github webhook parser. """
 
     def setUp(self):
-        self.parser = GithubWebhookPayloadParser(SAMPLE_GITHUB_PAYLOAD)
+        self.payload = copy.deepcopy(SAMPLE_GITHUB_PAYLOAD)
+        self.parser = GithubWebhookPayloadParser(self.payload)
+
+    def reparse(self):
+        """ Parse the modified payload with a fresh parser. """
+        return GithubWebhookPayloadParser(self.payload)
 
     def test_init(self):
         self.parser = GithubWebhookPayloadParser()
         self.assertEqual(self.parser._data, {})
 
+    def test_read_only_view(self):
+        """ The parser should not copy or modify the payload. """
+        self.assertEqual(self.parser._data, self.payload)
+        self.assertIs(self.parser._data['pull_request'], self.payload['pull_request'])
+        with self.assertRaises(TypeError):
+            self.parser._data['number'] = 2
+
+    def test_lookups_are_cached(self):
+        """ Each element should only be looked up once. """
+        self.assertEqual(self.parser.get_pull_request_title(), 'PR Title')
+        self.payload['pull_request']['title'] = 'Changed Title'
+        self.assertEqual(self.parser.get_pull_request_title(), 'PR Title')
+
     def test_get_request_reviewer_username(self):
         self.assertEqual(self.parser.get_request_reviewer_username(), GENERIC_USERNAME)
-        del self.parser._data['requested_reviewer']['login']
-        self.assertIsNone(self.parser.get_request_reviewer_username())
+        del self.payload['requested_reviewer']['login']
+        self.assertIsNone(self.reparse().get_request_reviewer_username())
+
+    def test_get_requested_team(self):
+        """ The requested team should be qualified with the organization, or the repository owner. """
+        self.assertIsNone(self.parser.get_requested_team())
+        self.payload['requested_team'] = {'slug': 'jedi'}
+        self.payload['repository']['owner'] = {'login': 'rebels'}
+        self.assertEqual(self.reparse().get_requested_team(), 'rebels/jedi')
+        self.payload['organization'] = {'login': 'alliance'}
+        self.assertEqual(self.reparse().get_requested_team(), 'alliance/jedi')
 
     def test_get_assignee_username(self):
         self.assertIsNone(self.parser.get_assignee_username())
-        self.parser._data['assignee'] = {'login': GENERIC_USERNAME}
-        self.assertEqual(self.parser.get_assignee_username(), GENERIC_USERNAME)
+        self.payload['assignee'] = {'login': GENERIC_USERNAME}
+        self.assertEqual(self.reparse().get_assignee_username(), GENERIC_USERNAME)
 
     def test_get_pull_request_title(self):
         self.assertEqual(self.parser.get_pull_request_title(), 'PR Title')
-        del self.parser._data['pull_request']['title']
-        self.assertIsNone(self.parser.get_pull_request_title())
+        del self.payload['pull_request']['title']
+        self.assertIsNone(self.reparse().get_pull_request_title())
 
     def test_get_pull_request_url(self):
         self.assertEqual(self.parser.get_pull_request_url(), 'http://www.example.com')
-        del self.parser._data['pull_request']['html_url']
-        self.assertIsNone(self.parser.get_pull_request_url())
+        del self.payload['pull_request']['html_url']
+        self.assertIsNone(self.reparse().get_pull_request_url())
 
     def test_get_pull_request_repo(self):
         self.assertEqual(self.parser.get_pull_request_repo(), 'Example Repository')
-        del self.parser._data['repository']['full_name']
-        self.assertIsNone(self.parser.get_pull_request_repo())
+        del self.payload['repository']['full_name']
+        self.assertIsNone(self.reparse().get_pull_request_repo())
 
     def test_get_pull_request_number(self):
         self.assertEqual(self.parser.get_pull_request_number(), 1)
-        del self.parser._data['number']
-        self.assertIsNone(self.parser.get_pull_request_number())
+        del self.payload['number']
+        self.assertIsNone(self.reparse().get_pull_request_number())
 
     def test_get_pull_request_author(self):
         self.assertEqual(self.parser.get_pull_request_author(), GENERIC_USERNAME)
-        del self.parser._data['pull_request']['user']['login']
-        self.assertIsNone(self.parser.get_pull_request_author())
+        del self.payload['pull_request']['user']['login']
+        self.assertIsNone(self.reparse().get_pull_request_author())
 
     def test_get_pull_request_author_image(self):
         self.assertEqual(self.parser.get_pull_request_author_image(), 'https://github.com/apple-touch-icon-180x180.png')
-        del self.parser._data['pull_request']['user']['avatar_url']
-        self.assertIsNone(self.parser.get_pull_request_author_image())
+        del self.payload['pull_request']['user']['avatar_url']
+        self.assertIsNone(self.reparse().get_pull_request_author_image())
 
     def test_get_pull_request_description(self):
         self.assertEqual(self.parser.get_pull_request_description(), 'An example pull request.')
-        del self.parser._data['pull_request']['body']
-        self.assertIsNone(self.parser.get_pull_request_description())
+        del self.payload['pull_request']['body']
+        self.assertIsNone(self.reparse().get_pull_request_description())
+
+
+class GithubTeamTest(TestCase):
+    """ Test expanding team review requests to the team's members. """
+
+    URL = 'https://api.github.com/orgs/rebels/teams/jedi/members'
+    EVENT = PullRequestEvent(action='review_requested', author='luke', team='rebels/jedi')
+
+    def setUp(self):
+        self.team_cache = patch_cache(self, 'app.github.TEAM_CACHE', 'teams')
+
+    def test_lookup_github_team_members(self):
+        """ Every page of members should be listed and cached. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', self.URL, json=[{'login': 'luke'}, {'login': 'leia'}], status=200,
+                     headers={'ETag': '"abc"', 'Link': '<{}?page=2>; rel="next"'.format(self.URL)})
+            rsps.add('GET', self.URL, json=[{'login': 'yoda'}], status=200)
+            self.assertEqual(lookup_github_team_members('rebels/jedi'), ['luke', 'leia', 'yoda'])
+            self.assertEqual(lookup_github_team_members('rebels/jedi'), ['luke', 'leia', 'yoda'])
+            self.assertEqual(len(rsps.calls), 2)
+        self.assertEqual(self.team_cache.get('rebels/jedi').value[0]['etag'], '"abc"')
+
+    def test_lookup_github_team_members_revalidated(self):
+        """ A stale membership should be revalidated with the cached ETag. """
+        self.team_cache._ttl = 0
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', self.URL, json=[{'login': 'leia'}], status=200, headers={'ETag': '"abc"'})
+            rsps.add('GET', self.URL, status=304)
+            lookup_github_team_members('rebels/jedi')
+            self.assertEqual(lookup_github_team_members('rebels/jedi'), ['leia'])
+            self.assertEqual(rsps.calls[1].request.headers.get('If-None-Match'), '"abc"')
+
+    def test_lookup_github_team_members_revalidates_every_page(self):
+        """ A later page should be revalidated and refreshed even when the first page did not change. """
+        self.team_cache._ttl = 0
+        link = {'Link': '<{}?page=2>; rel="next"'.format(self.URL)}
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', self.URL, json=[{'login': 'luke'}], status=200, headers=dict(link, ETag='"p1"'))
+            rsps.add('GET', self.URL, json=[{'login': 'yoda'}], status=200, headers={'ETag': '"p2"'})
+            rsps.add('GET', self.URL, status=304, headers=link)
+            rsps.add('GET', self.URL, json=[{'login': 'rey'}], status=200, headers={'ETag': '"p2b"'})
+            lookup_github_team_members('rebels/jedi')
+            self.assertEqual(lookup_github_team_members('rebels/jedi'), ['luke', 'rey'])
+            self.assertEqual(rsps.calls[3].request.headers.get('If-None-Match'), '"p2"')
+        self.assertEqual(self.team_cache.get('rebels/jedi').value[1]['etag'], '"p2b"')
+
+    def test_lookup_github_team_members_later_page_ratelimited(self):
+        """ A rate limited later page should be counted and fall back to the stale membership. """
+        self.team_cache._ttl = 0
+        link = {'Link': '<{}?page=2>; rel="next"'.format(self.URL)}
+        before = UPSTREAM_RATELIMITED.value('github')
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', self.URL, json=[{'login': 'luke'}], status=200, headers=dict(link, ETag='"p1"'))
+            rsps.add('GET', self.URL, json=[{'login': 'yoda'}], status=200, headers={'ETag': '"p2"'})
+            rsps.add('GET', self.URL, status=304, headers=link)
+            rsps.add('GET', self.URL, json={'message': 'API rate limit exceeded'}, status=403,
+                     headers={'X-RateLimit-Remaining': '0'})
+            lookup_github_team_members('rebels/jedi')
+            with self.assertLogs('app.github', level='WARNING'):
+                self.assertEqual(lookup_github_team_members('rebels/jedi'), ['luke', 'yoda'])
+        self.assertEqual(UPSTREAM_RATELIMITED.value('github'), before + 1)
+
+    @patch('app.github.lookup_github_team_members')
+    def test_expand_team_event(self, lookup):
+        """ Each member but the author should get an event. """
+        lookup.return_value = ['luke', 'leia', 'yoda']
+        events = expand_team_event(self.EVENT)
+        self.assertEqual([event.recipient for event in events], ['leia', 'yoda'])
+        self.assertEqual([event.reviewer for event in events], ['leia', 'yoda'])
+        self.assertEqual(events[0].team, 'rebels/jedi')
+
+    def test_expand_team_event_unknown_team(self):
+        """ A team that can't be listed should fall through to the default channel. """
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', self.URL, status=404)
+            self.assertEqual(expand_team_event(self.EVENT), [self.EVENT])
+
+    def test_expand_event_without_team(self):
+        event = PullRequestEvent(action='assigned', recipient='luke')
+        self.assertEqual(expand_team_event(event), [event])
@@ -0,0 +1,84 @@
+# pylint: disable=protected-access
+""" Tests for the static identity map. """
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest import skipIf
+
+from app import identities
+from app.identities import IdentityMap
+from app.identities import load_identities
+
+
+class IdentityMapTest(TestCase):
+    """ Test loading and reloading the identity map. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _write_json(self, mapping, name='identities.json', mtime=None):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as output:
+            json.dump(mapping, output)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_lookup(self):
+        """ Logins should be matched case insensitively, without a leading @ on the username. """
+        identity_map = IdentityMap(self._write_json({'OctoCat': '@mona', 'hubot': ''}), interval=60)
+        self.addCleanup(identity_map.stop)
+        self.assertEqual(identity_map.lookup('octocat'), 'mona')
+        self.assertIsNone(identity_map.lookup('hubot'))
+        self.assertIsNone(identity_map.lookup(None))
+        self.assertEqual(identity_map.stats(), {'entries': 1, 'reloads': 1, 'errors': 0})
+
+    def test_reload_when_changed(self):
+        """ The map should only be read again once its file changed, and kept if it can not be read. """
+        path = self._write_json({'octocat': 'mona'}, mtime=1500000000)
+        identity_map = IdentityMap(path)
+        self.assertTrue(identity_map.reload())
+        self.assertFalse(identity_map.reload())
+
+        self._write_json({'octocat': 'leia'}, mtime=1500000060)
+        self.assertTrue(identity_map.reload())
+        self.assertEqual(identity_map._identities, {'octocat': 'leia'})
+
+        with open(path, 'w') as output:
+            output.write('not json')
+        with self.assertLogs('app.identities', level='WARNING'):
+            self.assertFalse(identity_map.reload())
+        self.assertEqual(identity_map._identities, {'octocat': 'leia'})
+        self.assertEqual(identity_map.stats()['errors'], 1)
+
+    def test_missing_file(self):
+        """ A missing file should be reported once and map nobody. """
+        identity_map = IdentityMap(os.path.join(self.tmpdir.name, 'missing.json'))
+        with self.assertLogs('app.identities', level='WARNING'):
+            self.assertFalse(identity_map.reload())
+        self.assertFalse(identity_map.reload())
+
+    def test_load_sqlite(self):
+        """ Identities should be read from the identities table of a sqlite database. """
+        path = os.path.join(self.tmpdir.name, 'identities.sqlite3')
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute('CREATE TABLE identities (github_login TEXT PRIMARY KEY, slack_username TEXT)')
+            conn.execute("INSERT INTO identities VALUES ('octocat', 'mona')")
+        conn.close()
+        self.assertEqual(load_identities(path), {'octocat': 'mona'})
+
+    @skipIf(identities.yaml is None, 'PyYAML is not installed')
+    def test_load_yaml(self):
+        """ Identities should be read from a YAML mapping. """
+        path = os.path.join(self.tmpdir.name, 'identities.yaml')
+        with open(path, 'w') as output:
+            output.write('octocat: mona\n')
+        self.assertEqual(load_identities(path), {'octocat': 'mona'})
+
+    def test_load_invalid(self):
+        with self.assertRaises(ValueError):
+            load_identities(self._write_json(['octocat']))
@@ -0,0 +1,107 @@
+# pylint: disable=protected-access
+""" Tests for the in-process metrics. """
+import os
+import threading
+from unittest import TestCase
+
+from app.metrics import Counter
+from app.metrics import Histogram
+from app.metrics import Registry
+
+
+class CounterTest(TestCase):
+    """ Test counting from many threads. """
+
+    def test_shards_are_summed(self):
+        """ Counts recorded by different threads should be added up. """
+        counter = Counter('test_total', 'A test counter', ['action'])
+
+        def record():
+            for _ in range(1000):
+                counter.inc('assigned')
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('review_requested', amount=2)
+
+        self.assertEqual(counter.value('assigned'), 4000)
+        self.assertEqual(counter.values(), {('assigned',): 4000, ('review_requested',): 2})
+
+    def test_dead_thread_shards_are_folded(self):
+        """ The shards of threads that exited should be folded in rather than kept forever. """
+        counter = Counter('test_total', 'A test counter', ['action'])
+        for _ in range(10):
+            thread = threading.Thread(target=counter.inc, args=('assigned',))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(counter.value('assigned'), 10)
+        self.assertEqual(len(counter._shards), 1)
+        counter.inc('assigned')
+        self.assertEqual(counter.value('assigned'), 11)
+
+
+class HistogramTest(TestCase):
+    """ Test bucketing and timing observations. """
+
+    def test_snapshot(self):
+        """ Observations should be counted in every bucket they fit and summed. """
+        histogram = Histogram('test_seconds', 'A test histogram', ['stage'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, 'render')
+
+        snapshot = histogram.snapshot('render')
+        self.assertEqual([count for _bound, count in snapshot['buckets']], [1, 2, 3])
+        self.assertEqual(snapshot['count'], 3)
+        self.assertAlmostEqual(snapshot['sum'], 5.55)
+        self.assertEqual(histogram.snapshot('other')['count'], 0)
+
+    def test_time(self):
+        """ Timing a block or a decorated function should record one observation each. """
+        histogram = Histogram('test_seconds', 'A test histogram', ['stage'])
+
+        @histogram.time('decorated')
+        def decorated():
+            return 'done'
+
+        with histogram.time('block'):
+            pass
+        self.assertEqual(decorated(), 'done')
+        self.assertEqual(histogram.snapshot('block')['count'], 1)
+        self.assertEqual(histogram.snapshot('decorated')['count'], 1)
+
+
+class RegistryTest(TestCase):
+    """ Test rendering the Prometheus text format. """
+
+    def test_render(self):
+        """ Metrics and collected gauges should be rendered with their help, type and escaped labels. """
+        registry = Registry()
+        counter = registry.register(Counter('test_total', 'A test counter', ['action', 'outcome']))
+        histogram = registry.register(Histogram('test_seconds', 'A test histogram', buckets=(1,)))
+        registry.register_collector(lambda: [('test_ratio', 'gauge', 'A test gauge', [({'cache': 'x"y'}, 0.5)])])
+        counter.inc('assigned', 'sent')
+        counter.inc(None, 'ignored')
+        histogram.observe(2.0)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{action="assigned",outcome="sent"} 1', lines)
+        self.assertIn('test_total{action="None",outcome="ignored"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 0', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('test_seconds_sum 2', lines)
+        self.assertIn('test_ratio{cache="x\\"y"} 0.5', lines)
+
+    def test_process_label(self):
+        """ A process label should be added to the samples of every metric and collector. """
+        registry = Registry(process_label='pid')
+        registry.register(Counter('test_total', 'A test counter', ['action'])).inc('assigned')
+        registry.register_collector(lambda: [('test_ratio', 'gauge', 'A test gauge', [({}, 0.5)])])
+
+        lines = registry.render().splitlines()
+        self.assertIn('test_total{{action="assigned",pid="{}"}} 1'.format(os.getpid()), lines)
+        self.assertIn('test_ratio{{pid="{}"}} 0.5'.format(os.getpid()), lines)
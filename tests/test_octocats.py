@@ -1,14 +1,18 @@
 # pylint: disable=protected-access
 """ Tests for the github module. """
 import datetime
-import io
 import os
 from unittest import TestCase
 from unittest import skipUnless
 from unittest.mock import patch
 
+from requests.exceptions import ConnectionError as RequestsConnectionError
+import responses
+
 import app.octocats
+from app.octocats import OCTOCAT_POOL
 from app.octocats import RSS_FILE
+from app.octocats import RSS_URL
 
 
 class OctocatTest(TestCase):
@@ -19,31 +23,95 @@ class OctocatTest(TestCase):
     def setUp(self):
         if os.path.exists(RSS_FILE):
             os.remove(RSS_FILE)
+        OCTOCAT_POOL.clear()
+        app.octocats._REFRESH['attempted_at'] = None
 
+    @responses.activate
     @patch('feedparser.parse')
-    @patch('urllib.request.urlopen')
-    def test_get_random_octocat_image_offline(self, request, parser):
+    def test_get_random_octocat_image_offline(self, parser):
         """ Full integration test of getting an octocat image. """
-        request.return_value = io.BytesIO(b"Octocats")
+        responses.add('GET', RSS_URL, body='Octocats')
         parser.return_value = {'entries': [{'summary': self.OCTOCAT}]}
         cat = app.octocats.get_random_octocat_image()
         self.assertRegex(cat, r"https?://octodex.github.com/images/[^\/]*\.[png|jpg|gif]")
 
+        app.octocats._REFRESH['thread'].join(5)
+        self.assertEqual(app.octocats.get_random_octocat_image(), self.OCTOCAT)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_get_random_octocat_image_fallback(self):
+        """ The bundled octocats should be used when the feed can not be downloaded. """
+        responses.add('GET', RSS_URL, body=RequestsConnectionError('offline'))
+        with self.assertLogs('app.octocats', level='WARNING'):
+            cat = app.octocats.get_random_octocat_image()
+            app.octocats._REFRESH['thread'].join(5)
+        self.assertIn(cat, app.octocats.FALLBACK_OCTOCATS)
+        self.assertIn(app.octocats.get_random_octocat_image(), app.octocats.FALLBACK_OCTOCATS)
+        self.assertFalse(os.path.exists(RSS_FILE))
+
+        # A failed download should not be retried on every message
+        self.assertFalse(app.octocats._REFRESH['thread'].is_alive())
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @patch('feedparser.parse')
+    def test_octocat_pool_is_parsed_once(self, parser):
+        """ The RSS file should only be parsed again when it changes. """
+        responses.add('GET', RSS_URL, body='Octocats')
+        parser.return_value = {'entries': [{'summary': self.OCTOCAT}]}
+        app.octocats._retrieve_rss_file()
+        app.octocats.get_random_octocat_image()
+        app.octocats.get_random_octocat_image()
+        self.assertEqual(parser.call_count, 1)
+        self.assertEqual(OCTOCAT_POOL.get_octocats(), (self.OCTOCAT,))
+
+        modified_time = os.path.getmtime(RSS_FILE) - 60
+        os.utime(RSS_FILE, (modified_time, modified_time))
+        app.octocats.get_random_octocat_image()
+        self.assertEqual(parser.call_count, 2)
+
+    @patch('feedparser.parse')
+    def test_octocat_pool_parses_its_path(self, parser):
+        """ A pool should parse its own file rather than the default one. """
+        parser.return_value = {'entries': [{'summary': self.OCTOCAT}]}
+        path = RSS_FILE + '.pool'
+        with open(path, 'w') as file:
+            file.write('Octocats')
+        self.addCleanup(os.remove, path)
+        self.assertEqual(app.octocats.OctocatPool(path).get_octocats(), (self.OCTOCAT,))
+        parser.assert_called_once_with(path)
+
     @skipUnless(os.environ.get('TEST_ON_NETWORK'), "Network tests ignored")
     def test_get_random_octocat_image(self):
         """ Full integration test of getting an octocat image. """
         cat = app.octocats.get_random_octocat_image()
         self.assertRegex(cat, r"https?://octodex.github.com/images/[^\/]*\.[png|jpg|gif]")
 
-    @patch('urllib.request.urlopen')
-    def test_retrieve_rss_file(self, request):
+    @responses.activate
+    def test_retrieve_rss_file(self):
         """ Test downloading the rss file. """
-        request.return_value = io.BytesIO(b"Octocats")
+        responses.add('GET', RSS_URL, body='Octocats')
         app.octocats._retrieve_rss_file()
         self.assertTrue(os.path.exists(RSS_FILE))
         with open(RSS_FILE) as file:
             self.assertEqual(file.read(), 'Octocats')
 
+    @responses.activate
+    def test_retrieve_rss_file_failure(self):
+        """ A failed download should leave the old file in place and no temporary file behind. """
+        with open(RSS_FILE, 'w') as file:
+            file.write('Old octocats')
+        responses.add('GET', RSS_URL, status=503)
+        files = os.listdir(os.path.dirname(RSS_FILE))
+
+        with self.assertLogs('app.octocats', level='WARNING'):
+            app.octocats._retrieve_rss_file()
+        new_files = [name for name in os.listdir(os.path.dirname(RSS_FILE)) if name not in files]
+        self.assertFalse([name for name in new_files if name.startswith('tmp')])
+        with open(RSS_FILE) as file:
+            self.assertEqual(file.read(), 'Old octocats')
+
     @patch('os.path.getmtime')
     @patch('os.path.exists')
     def test_should_retrieve_rss_file(self, path_exists, mtimecheck):
@@ -0,0 +1,70 @@
+# pylint: disable=protected-access
+""" Tests for the slack rate limiter. """
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.ratelimit import RateLimiter
+from app.ratelimit import TokenBucket
+
+
+class TokenBucketTest(TestCase):
+    """ Test the token bucket. """
+
+    def test_reserve(self):
+        """ Tokens within the burst capacity should not wait. """
+        bucket = TokenBucket(rate=1, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1, places=1)
+        self.assertAlmostEqual(bucket.reserve(), 2, places=1)
+
+    def test_pause(self):
+        """ A paused bucket should make every caller wait. """
+        bucket = TokenBucket(rate=100, capacity=100)
+        bucket.pause(5)
+        self.assertAlmostEqual(bucket.reserve(), 5, places=1)
+
+    def test_pause_spreads_waits(self):
+        """ Tokens reserved during a pause should be spread out at the bucket's rate after it. """
+        bucket = TokenBucket(rate=1, capacity=3)
+        bucket.pause(30)
+        waits = [bucket.reserve() for _ in range(20)]
+        for wait, expected in zip(waits, [30, 30, 30] + list(range(31, 48))):
+            self.assertAlmostEqual(wait, expected, places=1)
+
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.reserve()
+        bucket.reserve()
+        bucket.pause(5)
+        self.assertAlmostEqual(bucket.reserve(), 7, places=1)
+
+
+@patch('app.ratelimit.time.sleep')
+class RateLimiterTest(TestCase):
+    """ Test the per channel and global rate limiter. """
+
+    def test_acquire_per_channel(self, sleep):
+        """ Each channel should have its own bucket. """
+        limiter = RateLimiter(channel_rate=1, channel_burst=1, global_rate=100, global_burst=100)
+        self.assertEqual(limiter.acquire('@luke'), 0)
+        self.assertEqual(limiter.acquire('@leia'), 0)
+        self.assertGreater(limiter.acquire('@luke'), 0)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(limiter.wait_time.snapshot()['count'], 3)
+
+    def test_acquire_global(self, sleep):
+        """ The global bucket should apply to every channel. """
+        limiter = RateLimiter(channel_rate=100, channel_burst=100, global_rate=1, global_burst=1)
+        limiter.acquire('@luke')
+        self.assertGreater(limiter.acquire('@leia'), 0)
+        sleep.assert_called_once()
+
+    def test_pause(self, sleep):
+        """ A Retry-After pause should hold back every channel. """
+        limiter = RateLimiter()
+        limiter.pause(2)
+        self.assertAlmostEqual(limiter.acquire('@luke'), 2, places=1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 2, places=1)
+
+        limiter.pause(3, channel='@leia')
+        self.assertAlmostEqual(limiter.acquire('@leia'), 3, places=1)
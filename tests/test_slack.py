@@ -1,17 +1,28 @@
 # pylint: disable=invalid-name, too-many-arguments, protected-access
 """ Test for the slack module. """
 import datetime
+import hashlib
+import hmac
 import os
+import threading
 from unittest import TestCase
 from unittest import skipUnless
 from unittest.mock import patch
 
+import responses
 from werkzeug.exceptions import BadRequest
 
 from app import slack
+from app.directory import DIRECTORY
+from app.github import PullRequestEvent
+from app.ratelimit import RateLimiter
+from app.unmatched import UNMATCHED
 from tests.test_github import FULL_NAME
 from tests.test_github import GENERIC_USERNAME
 from tests.test_github import SAMPLE_GITHUB_PAYLOAD
+from tests.test_github import patch_cache
+
+SAMPLE_EVENT = PullRequestEvent.from_payload(SAMPLE_GITHUB_PAYLOAD)
 
 
 class SlackTest(TestCase):
@@ -27,6 +38,10 @@ class SlackTest(TestCase):
         'name': GENERIC_USERNAME,
     }]
 
+    def setUp(self):
+        DIRECTORY.invalidate()
+        UNMATCHED.invalidate()
+
     @skipUnless(os.environ.get('GITHUB_API_USER')
                 and os.environ.get('GITHUB_API_TOKEN')
                 and os.environ.get('SLACK_BOT_TOKEN'),
@@ -35,19 +50,21 @@ class SlackTest(TestCase):
     def test_notify_recipient_on_network(self):
         """ Full integration test on the network. """
         with self.assertLogs('app.slack', level='INFO'):
-            slack.notify_recipient({})
+            slack.notify_recipient(SAMPLE_EVENT)
 
     @patch('app.slack.get_random_octocat_image')
     @patch('app.slack.lookup_github_full_name')
-    @patch('slackclient.SlackClient.api_call')
-    def test_notify_recipient(self, slack_client, get_name, get_octocat):
+    @patch('app.directory.slack_api_call')
+    @patch('app.slack.slack_api_call')
+    def test_notify_recipient(self, slack_client, slack_directory, get_name, get_octocat):
         """ Full integration test. """
         slack_client.return_value = {'ok': False, 'error': 'not_authed'}
+        slack_directory.return_value = {'ok': False, 'error': 'not_authed'}
         get_name.return_value = FULL_NAME
         get_octocat.return_value = 'octocat'
 
         with self.assertLogs('app.slack', level='WARNING'):
-            slack.notify_recipient(SAMPLE_GITHUB_PAYLOAD)
+            slack.notify_recipient(SAMPLE_EVENT)
 
     @patch('os.environ.get')
     @patch('app.slack.get_random_octocat_image')
@@ -63,7 +80,7 @@ class SlackTest(TestCase):
         get_octocat.return_value = 'octocat'
         get_env.return_value = '#default-channel'
 
-        payload = slack._create_slack_message_payload(SAMPLE_GITHUB_PAYLOAD)
+        payload = slack.create_slack_message_payload(SAMPLE_EVENT)
 
         self.assertEqual(payload.get('text'), "You've been asked by @obiwan to review a pull request. Lucky you!")
         self.assertTrue(payload.get('as_user'))
@@ -97,10 +114,9 @@ class SlackTest(TestCase):
         get_octocat.return_value = 'octocat'
         get_env.return_value = '#default-channel'
 
-        request_payload = SAMPLE_GITHUB_PAYLOAD.copy()
-        request_payload['action'] = 'assigned'
+        event = SAMPLE_EVENT._replace(action='assigned')
 
-        payload = slack._create_slack_message_payload(request_payload)
+        payload = slack.create_slack_message_payload(event)
         self.assertEqual(payload.get('text'), "You've been assigned a pull request by @obiwan. Lucky you!")
 
     @patch('os.environ.get')
@@ -115,7 +131,7 @@ class SlackTest(TestCase):
         get_octocat.return_value = 'octocat'
         get_env.return_value = '#default-channel'
 
-        payload = slack._create_slack_message_payload(SAMPLE_GITHUB_PAYLOAD)
+        payload = slack.create_slack_message_payload(SAMPLE_EVENT)
         self.assertEqual(payload.get('channel'), get_env.return_value)
 
     @patch('os.environ.get')
@@ -130,43 +146,71 @@ class SlackTest(TestCase):
         get_unbygh.return_value = None
 
         with self.assertRaises(BadRequest):
-            slack._create_slack_message_payload({})
+            slack.create_slack_message_payload(PullRequestEvent.from_payload({}))
 
     @patch('os.environ.get')
     def test_get_message(self, get_env):
         """ Should test all permutations of messages. """
 
-        pinged_message = slack._get_message({}, {})
+        pinged_message = slack._get_message({}, PullRequestEvent())
         self.assertEqual("You've been pinged. Lucky you!", pinged_message)
 
-        review_message = slack._get_message({'author': GENERIC_USERNAME}, {'action': 'review_requested'})
+        review_message = slack._get_message({'author': GENERIC_USERNAME}, PullRequestEvent(action='review_requested'))
         expected_message = "You've been asked by big_daddy_bob to review a pull request. Lucky you!"
         self.assertEqual(expected_message, review_message)
 
-        assigned_message = slack._get_message({'author': GENERIC_USERNAME}, {'action': 'assigned'})
+        team_message = slack._get_message({'author': GENERIC_USERNAME},
+                                          PullRequestEvent(action='review_requested', team='rebels/jedi'))
+        expected_message = "You've been asked by big_daddy_bob to review a pull request for rebels/jedi. Lucky you!"
+        self.assertEqual(expected_message, team_message)
+
+        assigned_message = slack._get_message({'author': GENERIC_USERNAME}, PullRequestEvent(action='assigned'))
         expected_message = "You've been assigned a pull request by big_daddy_bob. Lucky you!"
         self.assertEqual(expected_message, assigned_message)
 
         get_env.return_value = '#hello'
         pr_metadata = {'author': GENERIC_USERNAME, 'channel': get_env.return_value}
-        default_channel_message = slack._get_message(pr_metadata, {'action': 'review_requested'})
+        default_channel_message = slack._get_message(pr_metadata, PullRequestEvent(action='review_requested'))
         expected_message = "Hey you, tech people!" \
             " You've been asked by big_daddy_bob to review a pull request. Lucky you!"
         self.assertEqual(expected_message, default_channel_message)
 
+    @patch('app.slack._get_slack_username_by_github_username')
+    def test_get_pull_request_metadata(self, username_getter):
+        """ The recipient and author should both be resolved. """
+        username_getter.side_effect = lambda github_username: {GENERIC_USERNAME: 'bob'}.get(github_username)
+        pr_metadata = slack._get_pull_request_metadata(SAMPLE_EVENT._replace(recipient='unknown'))
+        self.assertEqual(pr_metadata, {'channel': os.environ.get('DEFAULT_NOTIFICATION_CHANNEL'), 'author': '@bob'})
+
+    @patch('app.slack.RESOLUTION_DEADLINE', 0.05)
+    @patch('app.slack._get_pull_request_author')
+    @patch('app.slack._get_notification_channel')
+    def test_get_pull_request_metadata_deadline(self, get_channel, get_author):
+        """ Lookups that run late or fail should fall back to the defaults. """
+        release = threading.Event()
+        get_channel.side_effect = lambda event: release.wait(5) and '#late'
+        get_author.side_effect = ValueError('boom')
+
+        with self.assertLogs('app.slack', level='WARNING') as logs:
+            pr_metadata = slack._get_pull_request_metadata(SAMPLE_EVENT)
+        release.set()
+
+        self.assertEqual(pr_metadata, {'channel': os.environ.get('DEFAULT_NOTIFICATION_CHANNEL'), 'author': 'someone'})
+        self.assertEqual(len(logs.records), 2)
+
     @patch('app.slack._get_slack_username_by_github_username')
     def test_get_notification_channel(self, username_getter):
         """ Test getting the notification channel. """
         username_getter.return_value = GENERIC_USERNAME
-        channel = slack._get_notification_channel(SAMPLE_GITHUB_PAYLOAD)
+        channel = slack._get_notification_channel(SAMPLE_EVENT)
         self.assertEqual(channel, '@{}'.format(GENERIC_USERNAME))
 
         username_getter.return_value = None
-        channel = slack._get_notification_channel(SAMPLE_GITHUB_PAYLOAD)
+        channel = slack._get_notification_channel(SAMPLE_EVENT)
         self.assertIsNone(channel)
 
     @patch('app.slack.lookup_github_full_name')
-    @patch('slackclient.SlackClient.api_call')
+    @patch('app.directory.slack_api_call')
     def test_get_slack_username_by_github_username_with_match(self, slack_client, name_lookup):
         """ Test getting a matching slack and github username. """
         slack_client.return_value = {'members': self.USERS}
@@ -175,7 +219,7 @@ class SlackTest(TestCase):
         self.assertEqual(username, GENERIC_USERNAME)
 
     @patch('app.slack.lookup_github_full_name')
-    @patch('slackclient.SlackClient.api_call')
+    @patch('app.directory.slack_api_call')
     def test_get_slack_username_by_github_username_without_match(self, slack_client, name_lookup):
         """ Test getting a slack username without a match from github. """
         different_username = 'gibberish'
@@ -188,7 +232,7 @@ class SlackTest(TestCase):
         self.assertEqual(username, different_username)
 
     @patch('app.slack.lookup_github_full_name')
-    @patch('slackclient.SlackClient.api_call')
+    @patch('app.directory.slack_api_call')
     def test_get_slack_username_by_github_username_without_username(self, slack_client, name_lookup):
         """ Test getting a slack username without a name passed in. """
         slack_client.return_value = {'members': self.USERS}
@@ -197,40 +241,133 @@ class SlackTest(TestCase):
         username = slack._get_slack_username_by_github_username(None)
         self.assertIsNone(username)
 
-    def test_match_slack_github_username(self):
-        """ Test matching a slack and github username. """
-        name = slack._match_slack_github_username(self.USERS, GENERIC_USERNAME)
-        self.assertEqual(name, GENERIC_USERNAME)
+    @patch('app.slack.IDENTITIES')
+    @patch('app.slack.lookup_github_full_name')
+    @patch('app.directory.slack_api_call')
+    def test_get_slack_username_by_github_username_mapped(self, slack_client, name_lookup, identity_map):
+        """ A login in the identity map should be resolved without calling slack or github. """
+        identity_map.lookup.return_value = 'mona'
+        self.assertEqual(slack._get_slack_username_by_github_username(GENERIC_USERNAME), 'mona')
+        slack_client.assert_not_called()
+        name_lookup.assert_not_called()
+
+        identity_map.lookup.return_value = None
+        slack_client.return_value = {'members': self.USERS}
+        self.assertEqual(slack._get_slack_username_by_github_username(GENERIC_USERNAME), GENERIC_USERNAME)
 
-        users = []
-        name = slack._match_slack_github_username(users, GENERIC_USERNAME)
-        self.assertIsNone(name)
+    @patch('app.slack.lookup_github_full_name')
+    @patch('app.directory.slack_api_call')
+    def test_get_slack_username_by_github_username_unmatched_is_cached(self, slack_client, name_lookup):
+        """ A login that matched nobody should skip the directory and github until the directory changes. """
+        slack_client.return_value = {'members': self.USERS}
+        name_lookup.return_value = 'Dependabot'
+        self.assertIsNone(slack._get_slack_username_by_github_username('dependabot'))
+        self.assertIsNone(slack._get_slack_username_by_github_username('dependabot'))
+        name_lookup.assert_called_once_with('dependabot')
 
-    def test_match_slack_un_by_fullname(self):
-        """ Test matching a slack and github user by full name. """
-        name = slack._match_slack_un_by_fullname(self.USERS, FULL_NAME)
-        self.assertEqual(name, GENERIC_USERNAME)
+        DIRECTORY.apply_member({'name': 'dependabot'})
+        self.assertEqual(slack._get_slack_username_by_github_username('dependabot'), 'dependabot')
 
-        users = []
-        name = slack._match_slack_un_by_fullname(users, FULL_NAME)
-        self.assertIsNone(name)
+    @patch('app.slack.lookup_github_full_name')
+    @patch('app.directory.slack_api_call')
+    def test_get_slack_username_by_github_username_github_error_not_cached(self, slack_client, name_lookup):
+        """ A login whose name github could not be asked for should be looked up again next time. """
+        slack_client.return_value = {'members': self.USERS}
+        name_lookup.return_value = None
+        self.assertIsNone(slack._get_slack_username_by_github_username('dependabot'))
+        self.assertIsNone(slack._get_slack_username_by_github_username('dependabot'))
+        self.assertEqual(name_lookup.call_count, 2)
+
+    @patch('app.directory.slack_api_call')
+    def test_get_slack_username_by_github_username_null_name_is_cached(self, slack_client):
+        """ A login github has no name for should be remembered as matching nobody. """
+        patch_cache(self, 'app.github.NAME_CACHE', 'users')
+        slack_client.return_value = {'members': self.USERS}
+        with responses.RequestsMock() as rsps:
+            rsps.add('GET', 'https://api.github.com/users/dependabot', json={'login': 'dependabot', 'name': None})
+            self.assertIsNone(slack._get_slack_username_by_github_username('dependabot'))
+        self.assertTrue(UNMATCHED.contains('dependabot'))
 
     def test_get_unmatched_username(self):
         """ Test getting an unmatched username. """
-        name = slack._get_unmatched_username(SAMPLE_GITHUB_PAYLOAD)
+        name = slack._get_unmatched_username(SAMPLE_EVENT)
         self.assertEqual(name, '@{}'.format(GENERIC_USERNAME))
 
-        name = slack._get_unmatched_username({})
+        name = slack._get_unmatched_username(PullRequestEvent())
         self.assertEqual(name, 'Hey you, tech people')
 
-    @patch('slackclient.SlackClient.api_call')
+
+class SlackSendTest(TestCase):
+    """ Test posting messages to slack and retrying them. """
+
+    @patch('app.slack.slack_api_call')
     def test_send_slack_message(self, slack_client):
         slack_client.return_value = {'ok': False, 'error': 'not_authed'}
         with self.assertLogs('app.slack', level='WARNING'):
-            slack._send_slack_message({})
+            self.assertFalse(slack.send_slack_message({}))
 
-    @patch('slackclient.SlackClient.api_call')
+    @patch('app.slack.slack_api_call')
     def test_send_slack_message_success(self, slack_client):
         slack_client.return_value = {'ok': True}
         with self.assertLogs('app.slack', level='INFO'):
-            slack._send_slack_message({})
+            self.assertTrue(slack.send_slack_message({}))
+
+    @patch('app.slack.RATE_LIMITER', RateLimiter())
+    @patch('app.ratelimit.time.sleep')
+    @patch('app.slack.slack_api_call')
+    def test_send_slack_message_ratelimited(self, slack_client, sleep):
+        """ A rate limited message should be retried after the Retry-After delay. """
+        slack_client.side_effect = [
+            {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '1'}},
+            {'ok': True},
+        ]
+        with self.assertLogs('app.slack', level='INFO'):
+            self.assertTrue(slack.send_slack_message({'channel': '#retry-channel'}))
+        self.assertEqual(slack_client.call_count, 2)
+        self.assertGreaterEqual(sleep.call_args[0][0], 0.9)
+        # Only the rate limited channel was held back
+        self.assertEqual(slack.RATE_LIMITER.reserve('#other-channel'), 0)
+
+    @patch('app.slack.SLACK_SEND_RETRIES', 1)
+    @patch('app.slack.RATE_LIMITER')
+    @patch('app.slack.slack_api_call')
+    def test_send_slack_message_retries_exhausted(self, slack_client, _rate_limiter):
+        """ A message should be given up on after the configured retries. """
+        slack_client.return_value = {'ok': False, 'error': 'ratelimited'}
+        with self.assertLogs('app.slack', level='WARNING'):
+            self.assertFalse(slack.send_slack_message({}))
+        self.assertEqual(slack_client.call_count, 2)
+
+    def test_get_retry_delay(self):
+        """ The retry delay should be at least the Retry-After header. """
+        self.assertGreaterEqual(slack.get_retry_delay({'headers': {'Retry-After': '3'}}, 0), 3)
+        self.assertLessEqual(slack.get_retry_delay({}, 0), slack.SLACK_RETRY_BACKOFF)
+        self.assertLessEqual(slack.get_retry_delay({'headers': {'Retry-After': 'soon'}}, 1),
+                             slack.SLACK_RETRY_BACKOFF * 2)
+
+
+class SlackEventsTest(TestCase):
+    """ Test verifying and handling slack Events API requests. """
+
+    def test_verify_slack_signature(self):
+        """ Only recent requests signed with the signing secret should be accepted. """
+        body = b'{"type": "event_callback"}'
+        signature = 'v0=' + hmac.new(b'secret', b'v0:1500000000:' + body, hashlib.sha256).hexdigest()
+        self.assertTrue(slack.verify_slack_signature('secret', '1500000000', body, signature, now=1500000060))
+        self.assertFalse(slack.verify_slack_signature('other', '1500000000', body, signature, now=1500000060))
+        self.assertFalse(slack.verify_slack_signature('secret', '1500000000', body + b' ', signature, now=1500000060))
+        self.assertFalse(slack.verify_slack_signature('secret', '1500000000', body, signature, now=1500001000))
+        self.assertFalse(slack.verify_slack_signature('secret', 'soon', body, signature))
+        self.assertFalse(slack.verify_slack_signature(None, '1500000000', body, signature, now=1500000060))
+
+    @patch('app.slack.DIRECTORY')
+    def test_handle_slack_event(self, directory):
+        """ Member events should patch the directory, and url verification echo the challenge. """
+        self.assertEqual(slack.handle_slack_event({'type': 'url_verification', 'challenge': 'abc'}), 'abc')
+
+        member = {'id': 'U1', 'name': GENERIC_USERNAME}
+        slack.handle_slack_event({'type': 'event_callback', 'event': {'type': 'user_change', 'user': member}})
+        directory.apply_member.assert_called_once_with(member)
+
+        slack.handle_slack_event({'type': 'event_callback', 'event': {'type': 'message', 'text': 'hi'}})
+        directory.apply_member.assert_called_once_with(member)
@@ -0,0 +1,101 @@
+# pylint: disable=protected-access
+""" Tests for the notification spool. """
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.spool import Spool
+
+
+class SpoolTest(TestCase):
+    """ Test the write-ahead notification spool. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'spool.jsonl')
+        self.spool = Spool(self.path, fsync_interval=0, compact_threshold=3)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmpdir.cleanup()
+
+    def test_record_and_mark_done(self):
+        """ Recorded jobs should be pending until they are marked done. """
+        job_id = self.spool.record({'action': 'assigned'})
+        self.assertEqual(self.spool.pending(), [(job_id, {'action': 'assigned'})])
+        self.spool.mark_done(job_id)
+        self.spool.mark_done(job_id)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_replay_after_restart(self):
+        """ Jobs that were not done should be pending in a new spool on the same file. """
+        done_id = self.spool.record({'number': 1})
+        pending_id = self.spool.record({'number': 2})
+        self.spool.mark_done(done_id)
+        self.spool.close()
+
+        with open(self.path, 'a') as spool_file:
+            spool_file.write('{"id": "torn')
+
+        with self.assertLogs('app.spool', level='WARNING'):
+            restarted = Spool(self.path)
+            self.assertEqual(restarted.pending(), [(pending_id, {'number': 2})])
+        restarted.close()
+
+    def test_compaction(self):
+        """ The spool should be rewritten with only pending jobs once enough are done. """
+        pending_id = self.spool.record({'number': 0})
+        for number in range(1, 4):
+            self.spool.mark_done(self.spool.record({'number': number}))
+
+        with open(self.path) as spool_file:
+            lines = spool_file.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(self.spool.pending(), [(pending_id, {'number': 0})])
+
+    def test_group_commit(self):
+        """ Concurrent writers should all be durable after sharing fsyncs. """
+        self.spool._fsync_interval = 0.01
+        threads = [threading.Thread(target=self.spool.record, args=({'number': number},)) for number in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(self.spool.pending()), 10)
+        self.assertEqual(self.spool._durable, self.spool._written)
+
+    def test_failed_job_is_dropped(self):
+        """ A job that keeps failing should be dropped once it used up its attempts, even across restarts. """
+        spool = Spool(self.path, fsync_interval=0, max_attempts=3)
+        job_id = spool.record({'channel': 'not-a-channel'})
+        self.assertFalse(spool.mark_failed(job_id))
+        self.assertFalse(spool.mark_failed(job_id))
+        spool.close()
+
+        restarted = Spool(self.path, fsync_interval=0, max_attempts=3)
+        self.assertEqual(restarted.pending(), [(job_id, {'channel': 'not-a-channel'})])
+        with self.assertLogs('app.spool', level='WARNING'):
+            self.assertTrue(restarted.mark_failed(job_id))
+        self.assertEqual(restarted.pending(), [])
+        restarted.close()
+        self.assertEqual(Spool(self.path).pending(), [])
+
+    @patch('app.spool.time.time')
+    def test_old_job_is_dropped(self, now):
+        """ A job recorded more than the max age ago should not be replayed. """
+        now.return_value = 1000
+        spool = Spool(self.path, fsync_interval=0, max_age=60)
+        old_id = spool.record({'number': 1})
+        now.return_value = 1050
+        new_id = spool.record({'number': 2})
+        spool.close()
+
+        now.return_value = 1070
+        restarted = Spool(self.path, fsync_interval=0, max_age=60)
+        with self.assertLogs('app.spool', level='WARNING'):
+            self.assertEqual(restarted.pending(), [(new_id, {'number': 2})])
+        self.assertFalse(restarted.mark_failed(old_id))
+        restarted.close()
@@ -0,0 +1,57 @@
+# pylint: disable=protected-access
+""" Tests for the cache of unmatched github logins. """
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.unmatched import UnmatchedCache
+
+
+class UnmatchedCacheTest(TestCase):
+    """ Test remembering github logins that matched no slack user. """
+
+    def test_contains(self):
+        """ Logins should be matched case insensitively and counted. """
+        cache = UnmatchedCache(ttl=60)
+        self.assertFalse(cache.contains('dependabot'))
+        cache.add('Dependabot')
+        self.assertTrue(cache.contains('dependabot'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'invalidations': 0, 'size': 1})
+
+    @patch('app.dedupe.time.monotonic')
+    def test_expiry(self, monotonic):
+        """ Logins should be forgotten after the ttl. """
+        monotonic.return_value = 100
+        cache = UnmatchedCache(ttl=60)
+        cache.add('dependabot')
+        monotonic.return_value = 130
+        cache.add('renovate')
+        self.assertEqual(cache.entries(), [{'login': 'dependabot', 'expires_in': 30},
+                                           {'login': 'renovate', 'expires_in': 60}])
+
+        monotonic.return_value = 160
+        self.assertFalse(cache.contains('dependabot'))
+        self.assertTrue(cache.contains('renovate'))
+
+    def test_max_entries(self):
+        """ The oldest logins should be evicted once the cache is full. """
+        cache = UnmatchedCache(ttl=60, max_entries=2)
+        for login in ('dependabot', 'renovate', 'hubot'):
+            cache.add(login)
+        self.assertEqual([entry['login'] for entry in cache.entries()], ['renovate', 'hubot'])
+
+    def test_discard_and_invalidate(self):
+        """ Logins should be forgotten one at a time, whatever their case, or all at once. """
+        cache = UnmatchedCache(ttl=60)
+        cache.add('dependabot')
+        cache.add('renovate')
+        self.assertTrue(cache.discard('Dependabot'))
+        self.assertFalse(cache.discard('dependabot'))
+        cache.invalidate()
+        self.assertFalse(cache.contains('renovate'))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_disabled(self):
+        """ A ttl of 0 should disable the cache. """
+        cache = UnmatchedCache(ttl=0)
+        cache.add('dependabot')
+        self.assertFalse(cache.contains('dependabot'))
@@ -1,28 +1,133 @@
 """ Tests for the main server file. """
+import hashlib
+import hmac
+import json
+import os
+import time
 from unittest import TestCase
 from unittest.mock import patch
 
+from app import APP
 from app import views
+from app.dedupe import CONTENT
+from app.dedupe import DELIVERIES
+from app.unmatched import UNMATCHED
+from tests.test_github import SAMPLE_GITHUB_PAYLOAD
 
 
 class ViewsTestCase(TestCase):
     """ Our main server testcase. """
 
+    def setUp(self):
+        DELIVERIES.clear()
+        CONTENT.clear()
+        UNMATCHED.invalidate()
+
     def test_ping(self):
         self.assertEqual(views.ping(None, None), 'pong')
 
-    @patch('app.views.notify_recipient')
+    @patch('app.views.dispatch')
     @patch('app.views.is_valid_pull_request')
-    def test_valid_pull_request(self, validator, notifier):
+    def test_valid_pull_request(self, validator, dispatcher):
         """ Should notify upon a valid pull request. """
         validator.return_value = True
-        notifier.return_value = True
-        result = views.pull_request({}, None)
+        dispatcher.return_value = False
+        result = views.pull_request(SAMPLE_GITHUB_PAYLOAD, None)
         self.assertEqual(result, 'Recipient Notified')
 
+    @patch('app.views.dispatch')
+    @patch('app.views.is_valid_pull_request')
+    def test_valid_pull_request_queued(self, validator, dispatcher):
+        """ Should return a 202 when the notification was queued. """
+        validator.return_value = True
+        dispatcher.return_value = True
+        result = views.pull_request(SAMPLE_GITHUB_PAYLOAD, None)
+        self.assertEqual(result, ('Recipient Queued', 202))
+        self.assertEqual(dispatcher.call_args[0][0].action, 'review_requested')
+
     @patch('app.views.is_valid_pull_request')
     def test_invalid_pull_request(self, validator):
         """ Should ignore an invalid pull request. """
         validator.return_value = False
         result = views.pull_request({}, None)
         self.assertRegex(result, 'ignored')
+
+    @patch('app.views.dispatch')
+    def test_redelivery(self, dispatcher):
+        """ A delivery github sent before should not notify again. """
+        dispatcher.return_value = False
+        views.pull_request(SAMPLE_GITHUB_PAYLOAD, 'guid-1')
+        result = views.pull_request(SAMPLE_GITHUB_PAYLOAD, 'guid-1')
+        self.assertEqual(result, 'Duplicate delivery ignored')
+        dispatcher.assert_called_once()
+
+    @patch('app.views.dispatch')
+    def test_failed_delivery_can_be_retried(self, dispatcher):
+        """ A delivery that failed should be handled when github retries it. """
+        dispatcher.side_effect = [ValueError('boom'), False]
+        with self.assertRaises(ValueError):
+            views.pull_request(SAMPLE_GITHUB_PAYLOAD, 'guid-1')
+        self.assertEqual(views.pull_request(SAMPLE_GITHUB_PAYLOAD, 'guid-1'), 'Recipient Notified')
+
+    @patch('app.views.dispatch')
+    @patch('app.github.lookup_github_team_members')
+    def test_team_review_request(self, lister, dispatcher):
+        """ A review requested from a team should be dispatched once, without listing the team. """
+        dispatcher.return_value = True
+        payload = dict(SAMPLE_GITHUB_PAYLOAD, action='review_requested', requested_team={'slug': 'jedi'})
+        result = views.pull_request(payload, 'guid-1')
+        self.assertEqual(result, ('Recipient Queued', 202))
+        dispatcher.assert_called_once()
+        lister.assert_not_called()
+
+    def test_metrics(self):
+        """ Metrics should be exposed in the Prometheus text format. """
+        views.pull_request({'action': 'closed', 'pull_request': {'html_url': 'http://www.example.com'}}, None)
+        response = APP.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        pid = os.getpid()
+        self.assertIn('notifier_hooks_total{{action="closed",outcome="ignored",pid="{}"}}'.format(pid).encode(),
+                      response.data)
+        self.assertIn('notifier_cache_hit_ratio{{cache="slack_directory",pid="{}"}}'.format(pid).encode(),
+                      response.data)
+        self.assertIn(b'notifier_slack_directory_bytes', response.data)
+        self.assertIn(b'# TYPE notifier_http_connections_reused_total counter', response.data)
+
+    @patch('app.views.handle_slack_event')
+    def test_slack_events(self, handler):
+        """ Only slack events signed with the signing secret should be handled. """
+        handler.return_value = 'abc'
+        body = json.dumps({'type': 'url_verification', 'challenge': 'abc'}).encode()
+        timestamp = str(int(time.time()))
+        signature = 'v0=' + hmac.new(b'secret', 'v0:{}:'.format(timestamp).encode() + body, hashlib.sha256).hexdigest()
+        headers = {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signature}
+
+        with patch('app.views.SLACK_SIGNING_SECRET', 'secret'):
+            response = APP.test_client().post('/slack/events', data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'abc')
+        handler.assert_called_once_with({'type': 'url_verification', 'challenge': 'abc'})
+
+        with patch('app.views.SLACK_SIGNING_SECRET', None):
+            response = APP.test_client().post('/slack/events', data=body, headers=headers)
+        self.assertEqual(response.status_code, 403)
+        handler.assert_called_once()
+
+    def test_admin_unmatched(self):
+        """ The unmatched logins should only be listed and cleared with the admin token. """
+        client = APP.test_client()
+        UNMATCHED.add('dependabot')
+        with patch('app.admin.ADMIN_TOKEN', None):
+            self.assertEqual(client.get('/admin/unmatched').status_code, 404)
+
+        with patch('app.admin.ADMIN_TOKEN', 'secret'):
+            response = client.get('/admin/unmatched', headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(response.status_code, 401)
+
+            headers = {'Authorization': 'Bearer secret'}
+            response = client.get('/admin/unmatched', headers=headers)
+            self.assertEqual([entry['login'] for entry in json.loads(response.data.decode())['logins']],
+                             ['dependabot'])
+
+            self.assertEqual(client.delete('/admin/unmatched/Dependabot', headers=headers).status_code, 204)
+            self.assertFalse(UNMATCHED.contains('dependabot'))